@@ -0,0 +1,478 @@
+# loadtest.py
+# Offline load test: synthetic updates through Bot/BotHandlers against a fake Telegram Bot API
+# and a fake assistant backend, without any network access or credentials
+#
+# Usage: python benchmarks/loadtest.py --bots 1,4 --users 10,1000,10000 [--messages 3] [--assistant-latency 0.5]
+#
+# Every combination of --bots and --users runs in a fresh process with its own database, so the
+# shared caches and counters of one run do not leak into the next. Settings not given on the
+# command line are read from the environment like in production (e.g. STREAM_REPLIES=0).
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Settings of a run unless set in the environment; quotas and send limits are off so that
+# the bots' own code is measured (see --telegram-limits)
+DEFAULT_ENV = {
+    "CLIENT_API_KEY": "loadtest",
+    "OWNER_CHAT_ID": "1",
+    "START_MESSAGE_STICKER": "loadtest-sticker",
+    "START_MESSAGE_TEXT": "Hello!",
+    "HELP_MESSAGE_TEXT": "Ask me anything.",
+    "ERROR_MESSAGE_TEXT": "Something went wrong.",
+    "USER_CALLBACK_CONFIRMATION_TEXT": "Please leave your phone number",
+    "USER_CALLBACK_SUCCEED_TEXT": "Thank you, we will call you.",
+    "USER_CALLBACK_REQUEST_TEXT": "Callback request:",
+    "USER_CALLBACK_REQUEST_SUMMARY_TEXT": "Summary:",
+    "USER_DID_NOT_SEND_PHONE_TEXT": "Please send your phone number.",
+    "CHAT_OWNER_DIALOG_SUMMARY_REQUEST": "Summarize this dialog: ",
+    "CHAT_OWNER_READY_TO_BUY_DIALOG_ESTIMATION_REQUEST": "Estimate: ",
+    "CHAT_OWNER_READY_TO_BUY_DIALOG_DISKOUNT_MARKER": "DISCOUNT",
+    "USER_DISCOUNT_PROVIDED_NOTIFICATIION": "A discount for you, ",
+    "CHAT_OWNER_DISCOUNT_PROVIDED_NOTIFICATIION": "Discount offered to ",
+    "PROMOCODE_DETAILS": "",
+    "DAILY_MESSAGE_LIMIT": "0",
+    "BOT_DAILY_MESSAGE_LIMIT": "0",
+    "USER_DAILY_MESSAGE_LIMIT": "0",
+    "USER_RATE_LIMIT": "0",
+    "INACTIVITY_TIMEOUT": "3600",
+    "ASSISTANT_POLL_INTERVAL": "0.05",
+}
+NO_SEND_LIMITS = {"SEND_CHAT_RATE": "0", "SEND_BOT_RATE": "0"}
+
+# How much longer the slow runs of a degraded fake backend take
+SLOW_FACTOR = 20
+
+FAQ = [
+    "What are your opening hours on weekends",
+    "How much does delivery to Moscow cost",
+    "Do you have the blue model in stock",
+    "Can I pay by card on delivery",
+]
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summarize_latencies(values) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+class FakeTelegram:
+    """Answers the Bot API methods the bots use and accepts CRM leads, after `latency` seconds."""
+
+    def __init__(self, latency: float, error_text: str):
+        self.latency = latency
+        self.error_text = error_text
+        self.requests = {}
+        self.errors = 0
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.port = None
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_post("/crm", self.crm)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def bot_api(self, request):
+        from aiohttp import web
+
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.requests[method] = self.requests.get(method, 0) + 1
+        if method == "getUpdates":
+            await asyncio.sleep(1)
+            return web.json_response({"ok": True, "result": []})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Load", "username": "load_bot"}})
+
+        await asyncio.sleep(self.latency)
+        if data.get("text") == self.error_text:
+            self.errors += 1
+        if method in ("sendMessage", "editMessageText", "sendSticker"):
+            chat = {"id": int(data.get("chat_id") or 0), "type": "private"}
+            message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat, "text": data.get("text", "")}
+            return web.json_response({"ok": True, "result": message})
+        return web.json_response({"ok": True, "result": True})
+
+    async def crm(self, request):
+        from aiohttp import web
+
+        await request.read()
+        self.requests["crm"] = self.requests.get("crm", 0) + 1
+        await asyncio.sleep(self.latency)
+        return web.json_response({"result": next(self._message_ids)})
+
+
+class FakeAssistant:
+    """
+    Stands in for AsyncOpenAI's beta.threads API; runs complete after `latency` seconds. A degraded
+    backend fails a share `failure_rate` of its runs and takes SLOW_FACTOR times longer for `slow_rate`.
+    """
+
+    def __init__(self, latency: float, answer_chars: int, chunks: int, confirmation: str,
+                 failure_rate: float = 0.0, slow_rate: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.answer_chars = answer_chars
+        self.chunks = chunks
+        self.confirmation = confirmation
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.rng = random.Random(seed)
+        self.runs = {"completed": 0, "failed": 0, "cancelled": 0}
+        self._ids = itertools.count()
+        self._last_message = {}  # thread id -> last user message
+        self._runs = {}          # run id -> (time it completes, final status)
+        self.beta = types.SimpleNamespace(threads=types.SimpleNamespace(
+            create=self.create_thread,
+            messages=types.SimpleNamespace(create=self.create_message, list=self.list_messages),
+            runs=types.SimpleNamespace(create=self.create_run, retrieve=self.retrieve_run, cancel=self.cancel_run, stream=self.stream_run),
+        ))
+
+    def answer(self, thread_id: str) -> str:
+        question = self._last_message.get(thread_id, "")
+        text = f"Here is what I know about {question[-60:]} [1]. "
+        if "order" in question:
+            text += self.confirmation + ". "
+        return (text + "Lorem ipsum dolor sit amet. " * (self.answer_chars // 28 + 1))[: max(self.answer_chars, len(text))]
+
+    async def create_thread(self, **kwargs):
+        return types.SimpleNamespace(id=f"thread_{next(self._ids)}")
+
+    async def create_message(self, thread_id, role, content, **kwargs):
+        self._last_message[thread_id] = content
+
+    async def list_messages(self, thread_id, limit=20, **kwargs):
+        text = types.SimpleNamespace(value=self.answer(thread_id))
+        return types.SimpleNamespace(data=[types.SimpleNamespace(content=[types.SimpleNamespace(text=text)])])
+
+    def outcome(self):
+        """Seconds the next run takes and the status it ends with."""
+        latency = self.latency * (SLOW_FACTOR if self.rng.random() < self.slow_rate else 1)
+        return latency, "failed" if self.rng.random() < self.failure_rate else "completed"
+
+    def run(self, run_id: str, status: str):
+        self.runs[status] += 1
+        error = types.SimpleNamespace(code="server_error", message="fake failure") if status == "failed" else None
+        return types.SimpleNamespace(id=run_id, status=status, last_error=error)
+
+    async def create_run(self, thread_id, assistant_id, **kwargs):
+        run_id = f"run_{next(self._ids)}"
+        latency, status = self.outcome()
+        self._runs[run_id] = (time.monotonic() + latency, status)
+        return types.SimpleNamespace(id=run_id, status="queued")
+
+    async def retrieve_run(self, run_id, thread_id, **kwargs):
+        done_at, status = self._runs[run_id]
+        if time.monotonic() < done_at:
+            return types.SimpleNamespace(id=run_id, status="in_progress")
+        del self._runs[run_id]
+        return self.run(run_id, status)
+
+    async def cancel_run(self, run_id, thread_id, **kwargs):
+        if self._runs.pop(run_id, None) is not None:
+            self.runs["cancelled"] += 1
+
+    def stream_run(self, thread_id, assistant_id, **kwargs):
+        return FakeRunStream(self, thread_id)
+
+
+class FakeRunStream:
+    def __init__(self, assistant: FakeAssistant, thread_id: str):
+        self.assistant = assistant
+        self.thread_id = thread_id
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __aiter__(self):
+        return self.events()
+
+    async def events(self):
+        ns = types.SimpleNamespace
+        run = ns(id=f"run_{next(self.assistant._ids)}", status="queued")
+        latency, status = self.assistant.outcome()
+        yield ns(event="thread.run.created", data=run)
+        text = self.assistant.answer(self.thread_id)
+        size = max(1, len(text) // self.assistant.chunks)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(latency / self.assistant.chunks)
+            if status == "failed":
+                break
+            block = ns(type="text", text=ns(value=text[start:start + size]))
+            yield ns(event="thread.message.delta", data=ns(delta=ns(content=[block])))
+        yield ns(event=f"thread.run.{status}", data=self.assistant.run(run.id, status))
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task sleeping `interval` seconds."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+
+def storage_size(db_path: str) -> int:
+    """Size of the database with its write-ahead log folded in."""
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return os.path.getsize(db_path)
+
+
+def make_update(bot, update_id: int, user_id: int, text: str):
+    from telegram import Update
+
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+def user_script(user_id: int, messages: int, faq_ratio: float, lead: bool, rng: random.Random) -> list:
+    """The (kind, text) updates one user sends, in order."""
+    script = [("start", "/start")]
+    for index in range(messages):
+        if rng.random() < faq_ratio:
+            script.append(("message", rng.choice(FAQ)))
+        else:
+            script.append(("message", f"Question {index} from user {user_id} about model {rng.randint(1, 500)}"))
+    if rng.random() < 0.05:
+        script.append(("help", "/help"))
+    if lead:
+        script.append(("message", "I want to order the blue model"))
+        script.append(("lead", f"Ivan +7 999 {user_id % 1000:03d}-{user_id // 1000 % 100:02d}-67"))
+    return script
+
+
+async def run_once(args) -> dict:
+    """One load test run in this process; returns the report."""
+    fake_telegram = FakeTelegram(args.telegram_latency, os.environ["ERROR_MESSAGE_TEXT"])
+    await fake_telegram.start()
+    os.environ["CRM_WEBHOOK"] = f"http://127.0.0.1:{fake_telegram.port}/crm"
+
+    # The package reads its settings on import, so it is imported only now
+    sys.path.insert(0, ROOT)
+    from telegram_openai_assistant import backends
+    from telegram_openai_assistant.bot import Bot
+    from telegram_openai_assistant.config import DB_PATH, USER_CALLBACK_CONFIRMATION_TEXT
+    from telegram_openai_assistant.logs import output_handler, setup_logging, stop_logging
+    from telegram_openai_assistant.quota import get_quota_counter
+    from telegram_openai_assistant.sender import get_message_scheduler
+    from telegram_openai_assistant.utils import get_dialog_store
+    from telegram_openai_assistant.writebehind import close_writers
+
+    # Logging as in production (LOG_LEVEL, LOG_SAMPLING), written to a file of the run's directory
+    log_file = open("loadtest.log", "w")
+    setup_logging(handler=output_handler(stream=log_file))
+
+    # The first key is the degraded one
+    fakes = {
+        f"key{index}": FakeAssistant(
+            args.assistant_latency, args.answer_chars, args.chunks, USER_CALLBACK_CONFIRMATION_TEXT,
+            failure_rate=args.failure_rate if index == 0 else 0.0,
+            slow_rate=args.slow_rate if index == 0 else 0.0,
+            seed=args.seed + index,
+        )
+        for index in range(args.keys)
+    }
+    backends._pool = backends.BackendPool(fakes)
+    base_url = f"http://127.0.0.1:{fake_telegram.port}"
+    bots = [Bot(f"{100000 + index}:loadtest", f"asst_{index}", base_url=base_url) for index in range(args.bots)]
+    await asyncio.gather(*(bot.start() for bot in bots))
+    storage_before = storage_size(DB_PATH)
+
+    rng = random.Random(args.seed)
+    update_ids = itertools.count(1)
+    latencies = {}
+    in_flight = asyncio.Semaphore(args.concurrency)
+    monitor = LoopLagMonitor()
+
+    async def simulate_user(bot: Bot, user_id: int, script: list):
+        for kind, text in script:
+            update = make_update(bot.application.bot, next(update_ids), user_id, text)
+            async with in_flight:
+                started = time.perf_counter()
+                await bot.application.process_update(update)
+                latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    users = []
+    for user_id in range(1000, 1000 + args.users):
+        script = user_script(user_id, args.messages, args.faq_ratio, rng.random() < args.lead_ratio, rng)
+        users.append((bots[user_id % len(bots)], user_id, script))
+
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(*user) for user in users))
+    duration = time.perf_counter() - started
+    await monitor.stop()
+
+    await asyncio.gather(*(bot.stop() for bot in bots))
+    await get_message_scheduler().stop()
+    get_quota_counter().close()
+    close_writers()
+    turns = sum([await get_dialog_store().count(bot.handlers.summaries.bot, user_id) for bot, user_id, _ in users])
+    get_dialog_store().close()
+    storage_after = storage_size(DB_PATH)
+    await fake_telegram.stop()
+    stop_logging()
+    log_file.close()
+
+    updates = sum(len(values) for values in latencies.values())
+    return {
+        "bots": args.bots,
+        "users": args.users,
+        "updates": updates,
+        "duration_s": duration,
+        "throughput_per_s": updates / duration if duration else 0.0,
+        "handlers": {kind: summarize_latencies(values) for kind, values in sorted(latencies.items())},
+        "loop_lag": {
+            "p50_ms": percentile(monitor.lags, 50) * 1000,
+            "p99_ms": percentile(monitor.lags, 99) * 1000,
+            "max_ms": max(monitor.lags, default=0.0) * 1000,
+        },
+        "storage": {
+            "growth_bytes": storage_after - storage_before,
+            "turns": turns,
+            "bytes_per_turn": (storage_after - storage_before) / turns if turns else 0.0,
+        },
+        "log_bytes": os.path.getsize("loadtest.log"),
+        "telegram_requests": fake_telegram.requests,
+        "errors": fake_telegram.errors,
+        "assistant_runs": {name: fake.runs for name, fake in fakes.items()},
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(report: dict):
+    print(
+        f"{report['bots']} bot(s), {report['users']} users: {report['updates']} updates in {report['duration_s']:.1f} s, "
+        f"{report['throughput_per_s']:.1f} updates/s, {report['errors']} errors, max RSS {report['max_rss_mb']:.0f} MB"
+    )
+    for kind, stats in report["handlers"].items():
+        print(f"  {kind:<8} n={stats['count']:<7} p50 {stats['p50_ms']:8.1f} ms  p95 {stats['p95_ms']:8.1f} ms  p99 {stats['p99_ms']:8.1f} ms")
+    lag = report["loop_lag"]
+    print(f"  loop lag p50 {lag['p50_ms']:.1f} ms  p99 {lag['p99_ms']:.1f} ms  max {lag['max_ms']:.1f} ms")
+    storage = report["storage"]
+    print(f"  storage +{storage['growth_bytes'] / 1024:.0f} KB for {storage['turns']} turns ({storage['bytes_per_turn']:.0f} bytes/turn)")
+    print(f"  telegram requests {report['telegram_requests']}, {report['log_bytes'] / 1024:.0f} KB of logs")
+    print(f"  assistant runs per key {report['assistant_runs']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the Telegram assistant bots.")
+    parser.add_argument("--bots", default="1", help="comma separated numbers of bots to run, e.g. 1,4")
+    parser.add_argument("--users", default="10,1000", help="comma separated numbers of users, e.g. 10,1000,10000")
+    parser.add_argument("--messages", type=int, default=3, help="questions per user")
+    parser.add_argument("--concurrency", type=int, default=200, help="updates processed at the same time")
+    parser.add_argument("--assistant-latency", type=float, default=0.5, help="seconds the fake assistant takes per run")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="seconds the fake Bot API takes per request")
+    parser.add_argument("--answer-chars", type=int, default=400, help="length of the fake answers")
+    parser.add_argument("--chunks", type=int, default=8, help="chunks a streamed fake answer arrives in")
+    parser.add_argument("--keys", type=int, default=1, help="fake assistant backends (API keys)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of failed runs on the first key")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help=f"share of runs on the first key taking {SLOW_FACTOR}x longer")
+    parser.add_argument("--faq-ratio", type=float, default=0.2, help="share of questions repeated across users")
+    parser.add_argument("--lead-ratio", type=float, default=0.1, help="share of users leaving a phone number")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the Telegram send rate limits on")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the reports to this file")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # A child run: one configuration, report as JSON on the last line
+        args.bots, args.users = int(args.bots), int(args.users)
+        report = asyncio.run(run_once(args))
+        print(json.dumps(report))
+        return
+
+    reports = []
+    for bots in [int(value) for value in args.bots.split(",")]:
+        for users in [int(value) for value in args.users.split(",")]:
+            with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+                env = dict(os.environ)
+                for key, value in DEFAULT_ENV.items():
+                    env.setdefault(key, value)
+                if not args.telegram_limits:
+                    env.update(NO_SEND_LIMITS)
+                env["DB_PATH"] = os.path.join(workdir, "assistant.db")
+                argv = [sys.executable, os.path.abspath(__file__), "--single", "--bots", str(bots), "--users", str(users)]
+                for name in ("messages", "concurrency", "assistant_latency", "telegram_latency", "answer_chars", "chunks",
+                             "keys", "failure_rate", "slow_rate", "faq_ratio", "lead_ratio", "seed"):
+                    argv += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+                result = subprocess.run(argv, cwd=workdir, env=env, stdout=subprocess.PIPE, text=True)
+                if result.returncode != 0:
+                    sys.exit(f"Run with {bots} bot(s) and {users} users failed")
+                report = json.loads(result.stdout.strip().splitlines()[-1])
+            print_report(report)
+            reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
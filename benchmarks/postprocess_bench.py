@@ -0,0 +1,53 @@
+# postprocess_bench.py
+# Throughput of the answer post-processing on large assistant outputs
+#
+# Usage: python benchmarks/postprocess_bench.py [size in KB ...]
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram_openai_assistant.postprocess import ResponsePipeline  # noqa: E402
+
+PARAGRAPH = (
+    "### Delivery\n"
+    "The **blue** model costs *12 000* rubles 【4:0†catalog.pdf】 and ships in 2 days [3]. "
+    "See [the catalog](https://example.com/catalog) or [https://example.com/faq] for details, "
+    "use the code `SPRING` at checkout. ~~Old price~~ is no longer valid. 😀\n"
+)
+
+
+def legacy_clean(response: str) -> str:
+    """parse_and_clean_response as it was before the pipeline, for comparison."""
+    def replacer(match):
+        text = match.group(1)
+        if re.match(r'^(https?://)', text, re.IGNORECASE):
+            return f'[{text}]'
+        return ''
+
+    return re.sub(r'\[(.*?)\]', replacer, response)
+
+
+def measure(label: str, func, text: str, repeat: int = 5):
+    runs = max(1, 2_000_000 // len(text))
+    best = min(timeit.repeat(lambda: func(text), number=runs, repeat=repeat)) / runs
+    print(f"  {label:<28} {best * 1000:9.3f} ms  {len(text.encode('utf-8')) / best / 1e6:8.1f} MB/s")
+
+
+def main(sizes):
+    citations = ResponsePipeline(["citations"])
+    full = ResponsePipeline(["citations", "markdown", "split"])
+    for size in sizes:
+        text = PARAGRAPH * max(1, size * 1024 // len(PARAGRAPH.encode("utf-8")))
+        print(f"{size} KB answer, {len(full.process(text).parts)} messages:")
+        measure("legacy clean", legacy_clean, text)
+        measure("pipeline clean (citations)", citations.clean, text)
+        measure("pipeline clean (all)", full.clean, text)
+        measure("pipeline process (all)", full.process, text)
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [4, 64, 1024])
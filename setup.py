@@ -4,16 +4,24 @@ setup(
     name='telegram_openai_assistant',
     version='0.1',
     packages=find_packages(),
+    python_requires='>=3.11',
     install_requires=[
         'python-telegram-bot==20.6',  # Make sure to specify the correct versions
-        'openai',
+        'openai>=1.0',
         'python-dotenv',
         'phonenumbers',
+        'httpx',
         # Add other dependencies here
     ],
+    extras_require={
+        'webhooks': ['aiohttp'],
+        'tokenizer': ['tiktoken'],
+    },
     entry_points={
         'console_scripts': [
             'chatbot = telegram_openai_assistant.bot:main',
+            'chatbot-migrate = telegram_openai_assistant.migrate:main',
+            'chatbot-maintain = telegram_openai_assistant.maintenance:main',
         ],
     },
 )
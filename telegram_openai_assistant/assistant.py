@@ -0,0 +1,321 @@
+# assistant.py
+# Non-blocking access to the OpenAI assistants API
+
+import asyncio
+import logging
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable
+from openai import AsyncOpenAI
+from .backends import Backend, BackendPool, BackendUnavailable, RunFailed, get_backend_pool, is_retryable
+from .config import (
+    ASSISTANT_MAX_PROMPT_TOKENS,
+    ASSISTANT_POLL_INTERVAL,
+    ASSISTANT_POLL_MAX_INTERVAL,
+    ASSISTANT_POLL_BACKOFF,
+    ASSISTANT_RUN_TIMEOUT,
+    ASSISTANT_RETRIES,
+    ASSISTANT_HEDGE_DELAY,
+)
+from .metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# Run states in which the assistant is still working on the answer
+PENDING_RUN_STATES = ("queued", "in_progress", "cancelling")
+# Stream events after which a run produces no answer
+FAILED_RUN_EVENTS = (
+    "thread.run.failed",
+    "thread.run.cancelled",
+    "thread.run.expired",
+    "thread.run.incomplete",
+    "thread.run.requires_action",
+)
+
+
+class AssistantClient:
+    """
+    Runs assistant requests without blocking the event loop, on the backends of a pool.
+    Each request has a deadline of `run_timeout` seconds. Requests bound to a thread stay on
+    the backend of the thread, where only a run that failed for a passing reason is started
+    again, since the message must not be posted twice. The others are retried on another
+    backend after a backend failure, and hedged with a second request when the first is still
+    running after `hedge_delay` seconds, the first answer winning.
+    """
+
+    def __init__(
+        self,
+        assistant_id: str,
+        pool: BackendPool = None,
+        poll_interval: float = ASSISTANT_POLL_INTERVAL,
+        poll_max_interval: float = ASSISTANT_POLL_MAX_INTERVAL,
+        poll_backoff: float = ASSISTANT_POLL_BACKOFF,
+        run_timeout: float = ASSISTANT_RUN_TIMEOUT,
+        max_prompt_tokens: int = ASSISTANT_MAX_PROMPT_TOKENS,
+        retries: int = ASSISTANT_RETRIES,
+        hedge_delay: float = ASSISTANT_HEDGE_DELAY,
+        bot: str = "",
+    ):
+        # One id per backend separated by "|" when the backends are different projects, else one for all
+        self.assistant_id = assistant_id
+        self._assistant_ids = assistant_id.split("|")
+        self.pool = pool or get_backend_pool()
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        self.poll_backoff = poll_backoff
+        self.run_timeout = run_timeout
+        self.max_prompt_tokens = max_prompt_tokens
+        self.retries = retries
+        self.hedge_delay = hedge_delay
+        # Label of the bot in the metrics
+        self.bot = bot
+        self.metrics = get_metrics()
+        # The backends that have this assistant
+        self.backends = [backend for backend in self.pool.backends if self.assistant_on(backend)]
+
+    def assistant_on(self, backend: Backend) -> str:
+        """The id of the assistant on a backend; empty if the backend does not have it."""
+        if len(self._assistant_ids) == 1:
+            return self._assistant_ids[0]
+        return self._assistant_ids[backend.index].strip() if backend.index < len(self._assistant_ids) else ""
+
+    async def create_thread(self) -> str:
+        """Create an empty thread on the best backend and return its id."""
+        async def create(backend: Backend, deadline: float) -> str:
+            thread = await asyncio.wait_for(backend.client.beta.threads.create(), timeout=deadline - asyncio.get_running_loop().time())
+            return self.pool.thread_id(backend, thread.id)
+        return await self._on_any_backend(create, hedge=False)
+
+    async def get_answer(self, message_str: str, thread_id: str = None) -> str:
+        """
+        Append a message to a thread and wait for the assistant's reply.
+        Without a thread_id the message is sent to a new, one-off thread.
+        """
+        if thread_id is None:
+            return await self._on_any_backend(lambda backend, deadline: self._ask(backend, message_str, None, deadline, reruns=0))
+
+        deadline = asyncio.get_running_loop().time() + self.run_timeout
+        backend, upstream_id = await self._thread_backend(thread_id, deadline)
+        with self.pool.using(backend):
+            return await self._ask(backend, message_str, upstream_id, deadline, reruns=self.retries)
+
+    async def stream_answer(self, message_str: str, thread_id: str) -> AsyncIterator[str]:
+        """
+        Append a message to a thread and yield the assistant's reply in text chunks
+        as the run streams them, instead of polling until the run completes.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.run_timeout
+        backend, upstream_id = await self._thread_backend(thread_id, deadline)
+        with self.pool.using(backend):
+            with self.metrics.timer("assistant_phase_seconds", bot=self.bot, phase="create"):
+                await asyncio.wait_for(
+                    backend.client.beta.threads.messages.create(thread_id=upstream_id, role="user", content=message_str),
+                    timeout=deadline - loop.time(),
+                )
+            for rerun in range(self.retries, -1, -1):
+                streamed = False
+                try:
+                    # The stream replaces both polling and listing, so it is timed as a phase of its own
+                    with self.metrics.timer("assistant_phase_seconds", bot=self.bot, phase="stream"):
+                        async with aclosing(self._stream_run(backend, upstream_id, deadline)) as chunks:
+                            async for chunk in chunks:
+                                streamed = True
+                                yield chunk
+                    return
+                except RunFailed as e:
+                    # Nothing shown yet: the message is on the thread, a new run can still answer it
+                    if streamed or not rerun or not e.retryable or loop.time() >= deadline:
+                        raise
+                    self._rerun(backend, e)
+
+    async def _thread_backend(self, thread_id: str, deadline: float):
+        """The backend of a thread, once it can take a request; fails at once if its breaker is open."""
+        backend, upstream_id = self.pool.backend_of(thread_id)
+        if backend not in self.backends:
+            raise BackendUnavailable(f"thread {thread_id} lives on a backend without assistant {self.assistant_id}")
+        return await self.pool.acquire(deadline, [backend]), upstream_id
+
+    async def _ask(self, backend: Backend, message_str: str, thread_id: str, deadline: float, reruns: int) -> str:
+        """
+        One request on one backend; a one-off thread is created when there is no thread_id.
+        A run failing for a passing reason is started again on the thread, up to `reruns` times.
+        """
+        loop = asyncio.get_running_loop()
+        client = backend.client
+        with self.metrics.timer("assistant_phase_seconds", bot=self.bot, phase="create"):
+            thread_id, run = await asyncio.wait_for(self._create_run(backend, message_str, thread_id), timeout=deadline - loop.time())
+
+        while True:
+            run = await self._wait(client, thread_id, run, deadline)
+            if run.status == "completed":
+                break
+            if run.status == "requires_action":
+                # The assistant wants tool outputs this bot cannot give; until the run is cancelled
+                # it keeps the thread locked
+                await self.cancel_run(client, thread_id, run.id)
+            failure = RunFailed.of(run)
+            if not reruns or not failure.retryable or loop.time() >= deadline:
+                raise failure
+            reruns -= 1
+            self._rerun(backend, failure)
+            run = await asyncio.wait_for(self._start_run(client, backend, thread_id), timeout=deadline - loop.time())
+
+        with self.metrics.timer("assistant_phase_seconds", bot=self.bot, phase="list"):
+            messages = await asyncio.wait_for(
+                client.beta.threads.messages.list(thread_id=thread_id, limit=1), timeout=deadline - loop.time()
+            )
+        return messages.data[0].content[0].text.value
+
+    async def _wait(self, client: AsyncOpenAI, thread_id: str, run, deadline: float):
+        """Wait until a run ends, cancelling it when the deadline passes or nobody waits any more."""
+        loop = asyncio.get_running_loop()
+        try:
+            with self.metrics.timer("assistant_phase_seconds", bot=self.bot, phase="poll"):
+                run = await asyncio.wait_for(
+                    self.wait_for_run(client, thread_id, run), timeout=deadline - loop.time()
+                )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self.metrics.inc("assistant_runs_total", bot=self.bot, status="timeout" if isinstance(e, asyncio.TimeoutError) else "abandoned")
+            # Don't leave the run burning tokens once nobody waits for it
+            await self.cancel_run(client, thread_id, run.id)
+            raise
+
+        self.metrics.inc("assistant_runs_total", bot=self.bot, status=run.status)
+        return run
+
+    def _rerun(self, backend: Backend, failure: RunFailed):
+        # Not recorded on the backend: the request's outcome is, once, when it ends
+        logger.warning("Starting the run again on backend %s: %s", backend.name, failure)
+        self.metrics.inc("assistant_retries_total", bot=self.bot, reason="rerun")
+
+    async def _create_run(self, backend: Backend, message_str: str, thread_id: str):
+        client = backend.client
+        if thread_id is None:
+            thread_id = (await client.beta.threads.create()).id
+        await client.beta.threads.messages.create(thread_id=thread_id, role="user", content=message_str)
+        return thread_id, await self._start_run(client, backend, thread_id)
+
+    async def _start_run(self, client: AsyncOpenAI, backend: Backend, thread_id: str):
+        return await client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=self.assistant_on(backend),
+            max_prompt_tokens=self.max_prompt_tokens,
+        )
+
+    async def _on_any_backend(self, attempt: Callable[[Backend, float], Awaitable], hedge: bool = True):
+        """
+        Run `attempt(backend, deadline)` on the best backend. After a backend failure it is
+        started again on another backend, up to `retries` times; with `hedge`, it is also
+        started again when it runs longer than `hedge_delay`. The first result wins and the
+        attempts still running are cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.run_timeout
+        running = {}  # task -> backend
+        tried = []
+        starts = 1 + max(0, self.retries)
+        next_start = loop.time()
+        error = None
+        try:
+            while True:
+                if starts and next_start <= loop.time() and loop.time() < deadline:
+                    if running:
+                        backend = self.pool.pick(self.backends, avoid=tried)
+                    else:
+                        try:
+                            backend = await self.pool.acquire(deadline, self.backends, avoid=tried)
+                        except (BackendUnavailable, asyncio.TimeoutError):
+                            if error is not None:
+                                raise error from None
+                            raise
+                    if backend is not None:
+                        if tried:
+                            self.metrics.inc("assistant_retries_total", bot=self.bot, reason="hedge" if running else "retry")
+                        starts -= 1
+                        tried.append(backend)
+                        task = asyncio.create_task(self._attempt(backend, attempt, deadline))
+                        # Released once done, even when cancelled before it started
+                        task.add_done_callback(lambda _, backend=backend: self.pool.release(backend))
+                        running[task] = backend
+                    next_start = loop.time() + self.hedge_delay if hedge and self.hedge_delay > 0 else deadline
+                if not running:
+                    raise error or asyncio.TimeoutError()
+
+                timeout = next_start - loop.time() if starts and next_start < deadline else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend = running.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        if not is_retryable(e):
+                            raise
+                        logger.warning("Assistant request failed on backend %s: %s", backend.name, str(e) or type(e).__name__)
+                        error = e
+                        next_start = loop.time()
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    async def _attempt(self, backend: Backend, attempt, deadline: float):
+        with self.pool.using(backend, release=False):
+            return await attempt(backend, deadline)
+
+    async def _stream_run(self, backend: Backend, thread_id: str, deadline: float) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        client = backend.client
+        run_id = None
+        async with client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=self.assistant_on(backend),
+            max_prompt_tokens=self.max_prompt_tokens,
+        ) as stream:
+            events = stream.__aiter__()
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.__anext__(), timeout=deadline - loop.time())
+                except StopAsyncIteration:
+                    return
+                except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                    self.metrics.inc("assistant_runs_total", bot=self.bot, status="timeout" if isinstance(e, asyncio.TimeoutError) else "abandoned")
+                    if run_id is not None:
+                        await self.cancel_run(client, thread_id, run_id)
+                    raise
+
+                if event.event == "thread.run.created":
+                    run_id = event.data.id
+                elif event.event == "thread.message.delta":
+                    for block in event.data.delta.content or ():
+                        if block.type == "text" and block.text and block.text.value:
+                            yield block.text.value
+                elif event.event == "thread.run.completed":
+                    self.metrics.inc("assistant_runs_total", bot=self.bot, status="completed")
+                elif event.event in FAILED_RUN_EVENTS:
+                    self.metrics.inc("assistant_runs_total", bot=self.bot, status=event.data.status)
+                    if event.data.status == "requires_action":
+                        await self.cancel_run(client, thread_id, event.data.id)
+                    raise RunFailed.of(event.data)
+                elif event.event == "error":
+                    # The server failed mid-stream
+                    logger.warning("Assistant stream failed: %s", event.data)
+                    raise RunFailed(run_id, "failed", getattr(event.data, "code", None) or "server_error")
+
+    async def wait_for_run(self, client: AsyncOpenAI, thread_id: str, run):
+        """Poll a run until it leaves the pending states, backing off between polls."""
+        interval = self.poll_interval
+        while run.status in PENDING_RUN_STATES:
+            await asyncio.sleep(interval)
+            interval = min(interval * self.poll_backoff, self.poll_max_interval)
+            run = await client.beta.threads.runs.retrieve(run.id, thread_id=thread_id)
+        return run
+
+    async def cancel_run(self, client: AsyncOpenAI, thread_id: str, run_id: str):
+        """Best-effort cancellation of an abandoned run."""
+        try:
+            await asyncio.shield(
+                client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+            )
+        except Exception as e:
+            logger.warning("Failed to cancel run %s: %s", run_id, e)
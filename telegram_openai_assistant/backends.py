@@ -0,0 +1,292 @@
+# backends.py
+# The API keys assistant requests are spread over, each with its own rate limit and circuit breaker
+
+import asyncio
+import hashlib
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+import openai
+from openai import AsyncOpenAI
+from .config import (
+    client_api_keys,
+    ASSISTANT_API_URL,
+    ASSISTANT_KEY_RATE,
+    ASSISTANT_KEY_BURST,
+    ASSISTANT_BREAKER_FAILURES,
+    ASSISTANT_BREAKER_COOLDOWN,
+)
+from .metrics import get_metrics
+from .quota import TokenBucket
+from .sender import refill
+
+logger = logging.getLogger(__name__)
+
+# Pause (seconds) of a key rate limited upstream without saying for how long
+DEFAULT_RETRY_AFTER = 1.0
+
+# Run statuses and error codes of failed runs that say more about the backend than about the request
+RETRYABLE_RUN_STATUSES = ("expired",)
+RETRYABLE_RUN_ERRORS = ("server_error", "rate_limit_exceeded")
+
+# Errors after which the backend is considered unhealthy
+BACKEND_ERRORS = (
+    asyncio.TimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+)
+
+
+class RunFailed(RuntimeError):
+    """An assistant run ended without an answer."""
+
+    def __init__(self, run_id: str, status: str, code: str = None):
+        super().__init__(f"Assistant run {run_id} ended with status '{status}'" + (f" ({code})" if code else ""))
+        self.run_id = run_id
+        self.status = status
+        self.code = code
+
+    @classmethod
+    def of(cls, run) -> "RunFailed":
+        error = getattr(run, "last_error", None)
+        return cls(run.id, run.status, getattr(error, "code", None))
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_RUN_STATUSES or (self.status == "failed" and self.code in RETRYABLE_RUN_ERRORS)
+
+
+class BackendUnavailable(RuntimeError):
+    """No backend can take the request: their breakers are open, or the one a thread lives on is gone."""
+
+
+def is_backend_failure(e: BaseException) -> bool:
+    """Whether an error counts against the backend's health; the request may then be retried on another."""
+    if isinstance(e, RunFailed):
+        return e.retryable
+    return isinstance(e, BACKEND_ERRORS)
+
+
+def is_retryable(e: BaseException) -> bool:
+    return is_backend_failure(e) or isinstance(e, (openai.RateLimitError, BackendUnavailable))
+
+
+class CircuitBreaker:
+    """
+    Closed while requests succeed; opens after `failures` failures in a row and then refuses
+    requests for `cooldown` seconds, after which a single probe decides whether it closes again.
+    """
+    __slots__ = ("failures", "cooldown", "_failed", "_opened_at", "_probing")
+
+    def __init__(self, failures: int = ASSISTANT_BREAKER_FAILURES, cooldown: float = ASSISTANT_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failed = 0
+        self._opened_at = None
+        self._probing = False
+
+    def state(self, now: float) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if now - self._opened_at >= self.cooldown else "open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self._probing)
+
+    def begin(self, now: float):
+        if self.state(now) == "half_open":
+            self._probing = True
+
+    def success(self):
+        self._failed = 0
+        self._opened_at = None
+        self._probing = False
+
+    def failure(self, now: float):
+        self._failed += 1
+        if self._probing or (self.failures > 0 and self._failed >= self.failures):
+            self._opened_at = now
+        self._probing = False
+
+    def release(self):
+        """The request ended without telling anything about the backend, e.g. it was cancelled."""
+        self._probing = False
+
+
+class Backend:
+    """One API key: its client, requests in flight, rate bucket and breaker."""
+    __slots__ = ("name", "index", "client", "breaker", "bucket", "in_flight", "not_before")
+
+    def __init__(self, name: str, index: int, client: AsyncOpenAI, breaker: CircuitBreaker, burst: float):
+        self.name = name
+        self.index = index
+        self.client = client
+        self.breaker = breaker
+        self.bucket = TokenBucket(burst, time.monotonic())
+        self.in_flight = 0
+        # Set from rate limit errors; no request is started before that time
+        self.not_before = 0.0
+
+
+def key_name(api_key: str) -> str:
+    """A stable name of a key for thread ids and metrics that does not reveal it."""
+    return "k" + hashlib.sha256(api_key.encode()).hexdigest()[:8]
+
+
+class BackendPool:
+    """
+    Picks the backend of each assistant request: the least busy one whose breaker is closed
+    and whose rate allows another request. Threads live on the backend that created them, so
+    their ids carry its name, except on the first backend, whose ids are left as they are.
+    """
+
+    def __init__(
+        self,
+        clients: dict,
+        rate: float = ASSISTANT_KEY_RATE,
+        burst: int = ASSISTANT_KEY_BURST,
+        breaker_failures: int = ASSISTANT_BREAKER_FAILURES,
+        breaker_cooldown: float = ASSISTANT_BREAKER_COOLDOWN,
+    ):
+        if not clients:
+            raise ValueError("no assistant backends configured")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.backends = [
+            Backend(name, index, client, CircuitBreaker(breaker_failures, breaker_cooldown), self.burst)
+            for index, (name, client) in enumerate(clients.items())
+        ]
+        self._by_name = {backend.name: backend for backend in self.backends}
+        self.metrics = get_metrics()
+        for backend in self.backends:
+            self.metrics.gauge("assistant_backend_up", lambda backend=backend: int(backend.breaker.state(time.monotonic()) != "open"), backend=backend.name)
+
+    def thread_id(self, backend: Backend, thread_id: str) -> str:
+        return thread_id if backend.index == 0 else f"{backend.name}/{thread_id}"
+
+    def backend_of(self, thread_id: str):
+        """The backend a thread lives on and the thread's id there."""
+        name, _, upstream_id = thread_id.rpartition("/")
+        if not name:
+            return self.backends[0], thread_id
+        backend = self._by_name.get(name)
+        if backend is None:
+            raise BackendUnavailable(f"thread {thread_id} lives on a key that is no longer configured")
+        return backend, upstream_id
+
+    def pick(self, candidates: Iterable[Backend] = None, avoid: Iterable[Backend] = ()) -> Optional[Backend]:
+        """
+        Take a request token of the best available backend, preferring those not in `avoid`;
+        None if none can start a request right now. The request counts as in flight until `release`.
+        """
+        now = time.monotonic()
+        best = None
+        for backend in candidates if candidates is not None else self.backends:
+            if now < backend.not_before or not backend.breaker.available(now) or refill(backend.bucket, self.rate, self.burst, now) > 0:
+                continue
+            rank = (backend in avoid, backend.in_flight, backend.index)
+            if best is None or rank < best[0]:
+                best = (rank, backend)
+        if best is None:
+            return None
+        backend = best[1]
+        if self.rate > 0:
+            backend.bucket.tokens -= 1
+        backend.breaker.begin(now)
+        backend.in_flight += 1
+        return backend
+
+    def release(self, backend: Backend):
+        backend.in_flight -= 1
+        backend.breaker.release()
+
+    async def acquire(self, deadline: float, candidates: Iterable[Backend] = None, avoid: Iterable[Backend] = ()) -> Backend:
+        """Wait until one of `candidates` can start a request; fails at once if all their breakers are open."""
+        candidates = list(candidates if candidates is not None else self.backends)
+        loop = asyncio.get_running_loop()
+        while True:
+            backend = self.pick(candidates, avoid)
+            if backend is not None:
+                return backend
+            now = time.monotonic()
+            if not any(candidate.breaker.available(now) for candidate in candidates):
+                raise BackendUnavailable("the circuit breakers of the assistant backends are open")
+            if loop.time() >= deadline:
+                raise asyncio.TimeoutError()
+            self.metrics.inc("assistant_backend_waits_total")
+            wait = min(
+                max(candidate.not_before - now, refill(candidate.bucket, self.rate, self.burst, now))
+                for candidate in candidates
+                if candidate.breaker.available(now)
+            )
+            await asyncio.sleep(min(max(wait, 0.01), deadline - loop.time()))
+
+    @contextmanager
+    def using(self, backend: Backend, release: bool = True):
+        """Record the outcome of a request on a picked backend and, with `release`, release it afterwards."""
+        try:
+            yield backend
+        except (asyncio.CancelledError, GeneratorExit):
+            backend.breaker.release()
+            raise
+        except Exception as e:
+            self.record(backend, e)
+            raise
+        else:
+            self.record(backend)
+        finally:
+            if release:
+                self.release(backend)
+
+    def record(self, backend: Backend, error: Exception = None):
+        """Feed the outcome of a request, None for a success, into the backend's breaker and rate limit."""
+        now = time.monotonic()
+        if error is None:
+            if backend.breaker.state(now) != "closed":
+                logger.info("Assistant backend %s recovered", backend.name)
+            backend.breaker.success()
+            outcome = "ok"
+        elif isinstance(error, openai.RateLimitError):
+            backend.breaker.release()
+            backend.not_before = now + _retry_after(error)
+            outcome = "rate_limited"
+        elif is_backend_failure(error):
+            closed = backend.breaker.state(now) == "closed"
+            backend.breaker.failure(now)
+            if closed and backend.breaker.state(now) == "open":
+                logger.warning("Assistant backend %s is failing, its circuit breaker opened: %s", backend.name, error)
+            outcome = "failure"
+        else:
+            # The backend works, it refused this request
+            backend.breaker.success()
+            outcome = "rejected"
+        self.metrics.inc("assistant_attempts_total", backend=backend.name, outcome=outcome)
+
+
+def _retry_after(e: openai.RateLimitError) -> float:
+    headers = getattr(e.response, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+_pool = None
+
+
+def get_backend_pool() -> BackendPool:
+    """Return the process-wide backend pool, with a client per configured API key."""
+    global _pool
+    if _pool is None:
+        clients = {
+            key_name(api_key or ""): AsyncOpenAI(api_key=api_key, base_url=ASSISTANT_API_URL or None)
+            for api_key in client_api_keys or [None]
+        }
+        _pool = BackendPool(clients)
+    return _pool
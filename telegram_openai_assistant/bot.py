@@ -1,76 +1,368 @@
+import argparse
 import asyncio
+import logging
+import os
+import signal
+from functools import wraps
+from telegram.error import InvalidToken
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
-from .config import telegram_token_bots, assistant_id_bots
+from .config import (
+    TELEGRAM_API_URL,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PORT,
+    WEBHOOK_MAX_CONNECTIONS,
+    WORKERS,
+    METRICS_PORT,
+    PENDING_UPDATES,
+    CONFIG_RELOAD_INTERVAL,
+    BOT_START_CONCURRENCY,
+    BOT_START_TIMEOUT,
+    BOT_HEALTH_INTERVAL,
+)
+from .botconfig import BotConfig, get_bot_config_source, shard_of
 from .handlers import BotHandlers
+from .logs import log_context, setup_logging
+from .metrics import MetricsServer, get_metrics, get_profiler, bot_label
+from .phoneNumberUtil import extract_phone
+from .quota import get_quota_counter
+from .response_cache import get_response_cache
+from .sender import get_message_scheduler
+from .utils import get_history_cache
+from .writebehind import get_write_behind, close_writers
+from .supervisor import run_supervisor, MAX_RESTART_DELAY
+from .webhook import WebhookServer, webhook_path, webhook_secret
+
+logger = logging.getLogger(__name__)
 
 class Bot:
-    def __init__(self, token: str, assistant_id: str):
-        """Initialize the bot application with a token and assistant_id"""
-        self.application = ApplicationBuilder().token(token).build()
+    def __init__(self, token: str, assistant_id: str, base_url: str = TELEGRAM_API_URL, config: BotConfig = None):
+        """
+        Initialize the bot application with a token and assistant_id, optionally against another Bot API server.
+        `config` carries the bot's own settings from the bots file.
+        """
+        # The dispatcher keeps each user's updates in order, so the application may take in many at once
+        builder = ApplicationBuilder().token(token).concurrent_updates(PENDING_UPDATES)
+        if base_url:
+            builder = builder.base_url(f"{base_url.rstrip('/')}/bot")
+        self.application = builder.build()
+        self.token = token
         self.assistant_id = assistant_id
-        self.handlers = BotHandlers(self.assistant_id, token, self.application)
+        self.webhook_server = None
+        # Whether the last health check (or the start) succeeded
+        self.healthy = False
+        self.handlers = BotHandlers(self.assistant_id, token, self.application, config)
         self.setup_handlers()
 
     def setup_handlers(self):
-        """Sets up the command and message handlers."""
-        self.application.add_handler(CommandHandler("start", self.handlers.start))
-        self.application.add_handler(CommandHandler("help", self.handlers.help_command))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handlers.process_message))
+        """Sets up the command and message handlers, each user's updates handled in order by the dispatcher."""
+        dispatcher = self.handlers.dispatcher
+        self.application.add_handler(CommandHandler("start", self.instrument("start", dispatcher.wrap(self.handlers.start))))
+        self.application.add_handler(CommandHandler("help", self.instrument("help", dispatcher.wrap(self.handlers.help_command))))
+        self.application.add_handler(MessageHandler(
+            filters.TEXT & ~filters.COMMAND,
+            self.instrument("message", dispatcher.wrap(self.handlers.process_message, messages=True)),
+        ))
         self.application.add_error_handler(self.handlers.error_handler)
 
+    def instrument(self, handler: str, callback):
+        """Time a handler in the metrics and tag what it logs with the bot and the user."""
+        bot = bot_label(self.token)
+        timed = get_metrics().timed("update_seconds", bot=bot, handler=handler)(callback)
+
+        @wraps(callback)
+        async def instrumented(update, context):
+            user = update.effective_user.id if update.effective_user else None
+            with log_context(bot=bot, user=user):
+                await timed(update, context)
+        return instrumented
+
     async def send_message(self, message: str):
         """Send a message to the specified chat_id"""
         await self.application.bot.send_message(chat_id=self.chat_id, text=message)
 
-    async def start(self):
-        """Start the bot."""
-        self.handlers.reset_state()
+    async def start(self, webhook_server: WebhookServer = None, webhook_url: str = WEBHOOK_URL):
+        """Start the bot, polling for updates or receiving them through the webhook server."""
         await self.application.initialize()
         await self.application.start()
-        await self.application.updater.start_polling()
+        await self.handlers.startup()
+        if webhook_server is None:
+            await self.application.updater.start_polling()
+            return
+
+        self.webhook_server = webhook_server
+        path = webhook_path(self.token)
+        secret = webhook_secret(self.token)
+        webhook_server.add_bot(self.application, path, secret, self.handlers.dispatcher.pending)
+        await self.application.bot.set_webhook(
+            url=f"{webhook_url.rstrip('/')}/{path}",
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+
+    async def check_health(self, timeout: float = BOT_START_TIMEOUT) -> bool:
+        """Ask the Bot API who the bot is; False if it fails or takes longer than `timeout` seconds."""
+        try:
+            await asyncio.wait_for(self.application.bot.get_me(), timeout)
+        except Exception as e:
+            if self.healthy:
+                logger.warning("Bot %s failed its health check: %s", bot_label(self.token), e)
+            self.healthy = False
+        else:
+            if not self.healthy:
+                logger.info("Bot %s is healthy again", bot_label(self.token))
+            self.healthy = True
+        return self.healthy
 
     async def stop(self):
         """Stop the bot."""
-        self.handlers.reset_state()
-        await self.application.updater.stop()
-        await self.application.stop()
+        if self.webhook_server is not None:
+            self.webhook_server.remove_bot(webhook_path(self.token))
+        if self.application.updater.running:
+            await self.application.updater.stop()
+        await self.handlers.shutdown()
+        # Commit the dialogs, sessions and counters the bot queued before it goes away
+        await get_write_behind().flush()
+        # Deliver what is still queued for this bot, e.g. the owner digest, while it can send
+        await get_message_scheduler().drain(self.application.bot)
+        if self.application.running:  # Not if the start failed halfway
+            await self.application.stop()
         await self.application.shutdown()
 
 
-async def start_bots():
-    """Runs all bot applications concurrently."""
-    bots = [
-        Bot(token, assistant_id)
-        for token, assistant_id in zip(telegram_token_bots, assistant_id_bots)
-    ]
-    
-    # Start all bots concurrently
-    start_tasks = [bot.start() for bot in bots]
-    await asyncio.gather(*start_tasks)
+def watch_shared_state():
+    """Report the queues and caches shared by all bots of the process as metrics."""
+    metrics, sender = get_metrics(), get_message_scheduler()
+    metrics.gauge("queue_depth", lambda: sender.stats()["queued"], queue="send")
+    metrics.gauge("queue_depth", lambda: sender.stats()["in_flight"], queue="send_in_flight")
+    metrics.gauge("queue_depth", lambda: get_write_behind().pending(), queue="writes")
+    metrics.gauge("cache_entries", lambda: get_history_cache().stats()["users"], cache="history")
+    metrics.gauge("cache_entries", lambda: get_response_cache().stats()["entries"], cache="response")
+    metrics.gauge("cache_entries", lambda: extract_phone.cache_info().currsize, cache="phone")
+
+
+class BotManager:
+    """
+    Runs a changing set of bots. Every bot is started in a task of its own, at most
+    `start_concurrency` at once, so the first bots serve while the others are still starting,
+    and a bot that fails to start or hangs is retried with backoff without holding up the rest.
+    A started bot is checked with getMe every `health_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        webhook_server: WebhookServer = None,
+        webhook_url: str = WEBHOOK_URL,
+        start_concurrency: int = BOT_START_CONCURRENCY,
+        start_timeout: float = BOT_START_TIMEOUT,
+        health_interval: float = BOT_HEALTH_INTERVAL,
+    ):
+        self.webhook_server = webhook_server
+        self.webhook_url = webhook_url
+        self.start_timeout = start_timeout
+        self.health_interval = health_interval
+        self._starting = asyncio.Semaphore(max(1, start_concurrency))
+        self._configs = {}  # token -> BotConfig
+        self._tasks = {}    # token -> task running the bot
+        self._bots = {}     # token -> Bot, once started
+
+    def running(self) -> list:
+        """The bots that are started."""
+        return list(self._bots.values())
+
+    async def apply(self, configs: list):
+        """Start the bots that are new, stop those that are gone and restart those whose settings changed."""
+        wanted = {config.token: config for config in configs}
+        stale = [token for token, config in self._configs.items() if wanted.get(token) != config]
+        new = [config for token, config in wanted.items() if token not in self._configs or token in stale]
+        if stale:
+            logger.info("Stopping %s bot(s): %s", len(stale), ", ".join(bot_label(token) for token in stale))
+            await asyncio.gather(*(self._stop(token) for token in stale))
+        if new:
+            logger.info("Starting %s bot(s): %s", len(new), ", ".join(bot_label(config.token) for config in new))
+        for config in new:
+            self._configs[config.token] = config
+            self._tasks[config.token] = asyncio.create_task(self._run(config))
+
+    async def stop(self):
+        await asyncio.gather(*(self._stop(token) for token in list(self._tasks)))
+
+    async def _stop(self, token: str):
+        self._configs.pop(token, None)
+        task = self._tasks.pop(token, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self, config: BotConfig):
+        label = bot_label(config.token)
+        delay = 1
+        with log_context(bot=label):
+            while True:
+                bot = None
+                try:
+                    async with self._starting:
+                        bot = Bot(config.token, config.assistant_id, config=config)
+                        await asyncio.wait_for(bot.start(self.webhook_server, self.webhook_url), self.start_timeout)
+                except asyncio.CancelledError:
+                    if bot is not None:
+                        await self._shutdown(bot)
+                    raise
+                except InvalidToken as e:
+                    # Retrying cannot help; the bot starts again once its entry is changed
+                    logger.error("Bot %s was rejected by Telegram: %s", label, e)
+                    return
+                except Exception as e:
+                    logger.warning("Failed to start bot %s, retrying in %ss: %r", label, delay, e)
+                    if bot is not None:
+                        await self._shutdown(bot)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RESTART_DELAY)
+                    continue
+                break
+
+            bot.healthy = True
+            self._bots[config.token] = bot
+            get_metrics().gauge("bot_up", lambda: bot.healthy, bot=label)
+            logger.info("Bot %s started", label)
+            try:
+                while True:
+                    await asyncio.sleep(self.health_interval)
+                    await bot.check_health(self.start_timeout)
+            finally:
+                del self._bots[config.token]
+                get_metrics().remove_gauge("bot_up", bot=label)
+                await self._shutdown(bot)
+
+    @staticmethod
+    async def _shutdown(bot: Bot):
+        try:
+            await bot.stop()
+        except Exception:
+            # E.g. a bot whose start failed halfway
+            logger.warning("Failed to stop bot %s cleanly", bot_label(bot.token), exc_info=True)
 
-    try:
-        # Keep the event loop running until interrupted
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        print("Bots shutting down...")
-    finally:
-        # Stop polling for all bots
-        stop_tasks = [bot.application.updater.stop() for bot in bots]
-        await asyncio.gather(*stop_tasks)
 
-        # Stop all applications
-        stop_tasks = [bot.application.stop() for bot in bots]
-        await asyncio.gather(*stop_tasks)
+_manager = None
 
-        # Shutdown all applications
-        shutdown_tasks = [bot.application.shutdown() for bot in bots]
-        await asyncio.gather(*shutdown_tasks)
+
+def get_bot_manager() -> BotManager:
+    """Return the process-wide manager of the running bots."""
+    global _manager
+    if _manager is None:
+        _manager = BotManager()
+    return _manager
+
+
+def check_settings():
+    """Refuse settings the bots cannot start with, before any bot or worker process is started."""
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise ValueError("BOT_MODE=webhook needs WEBHOOK_URL, the public HTTPS URL Telegram posts the updates to")
+
+
+async def start_bots(bot_configs=None, worker: int = None, workers: int = 1):
+    """
+    Runs the bots until SIGINT or SIGTERM.
+    `bot_configs` is a fixed list of BotConfig or (token, assistant_id) pairs; by default the
+    configured bots are run and reloaded when the bots file changes or on SIGHUP. `worker`
+    is the index of the supervisor worker running them out of `workers`, if any; a worker
+    runs the configured bots of its shard only.
+    """
+    check_settings()
+    source = get_bot_config_source() if bot_configs is None else None
+    if bot_configs is not None:
+        bot_configs = [config if isinstance(config, BotConfig) else BotConfig(config[0], assistant_id=config[1]) for config in bot_configs]
+
+    def selected(configs: list) -> list:
+        return [config for config in configs if worker is None or shard_of(config.token, workers) == worker]
+
+    webhook_server = None
+    webhook_url = WEBHOOK_URL
+    if BOT_MODE == "webhook":
+        port = WEBHOOK_PORT
+        if worker is not None:
+            # Every worker runs its own server; the proxy routes WEBHOOK_URL/w<N>/ to port + N
+            port += worker
+            webhook_url = f"{WEBHOOK_URL.rstrip('/')}/w{worker}"
+        webhook_server = WebhookServer(port=port)
+        await webhook_server.start()
+
+    # Workers count messages in the same table, so the limits must be enforced by the database
+    get_quota_counter().shared = workers > 1
+    get_quota_counter().start()
+    watch_shared_state()
+    metrics_server = None
+    if METRICS_PORT:
+        # Like the webhook servers, every worker serves its metrics on a port of its own
+        metrics_server = MetricsServer(get_metrics(), get_profiler(), port=METRICS_PORT + (worker or 0))
+        await metrics_server.start()
+
+    manager = get_bot_manager()
+    manager.webhook_server = webhook_server
+    manager.webhook_url = webhook_url
+
+    wakeup = asyncio.Event()
+    requests = set()
+
+    def request(what: str):
+        requests.add(what)
+        wakeup.set()
+
+    loop = asyncio.get_running_loop()
+    for sig, what in ((signal.SIGINT, "stop"), (signal.SIGTERM, "stop"), (getattr(signal, "SIGHUP", None), "reload")):
+        try:
+            if sig is not None:
+                loop.add_signal_handler(sig, request, what)
+        except NotImplementedError:
+            pass  # Not supported on Windows, KeyboardInterrupt still stops the loop
+
+    try:
+        # The bots start in the background; the first ones serve while the rest are starting
+        await manager.apply(selected(source.configs() if source is not None else bot_configs))
+        while "stop" not in requests:
+            try:
+                await asyncio.wait_for(wakeup.wait(), CONFIG_RELOAD_INTERVAL or None)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            reload_requested = "reload" in requests
+            requests.discard("reload")
+            if source is not None and "stop" not in requests and (reload_requested or source.changed()):
+                logger.info("Reloading the bot configuration")
+                await manager.apply(selected(source.reload()))
+        logger.info("Bots shutting down")
+    finally:
+        # Stop receiving updates, stop and shut down all applications
+        await manager.stop()
+        if webhook_server is not None:
+            await webhook_server.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await get_message_scheduler().stop()
+        await get_quota_counter().stop()
+        get_quota_counter().close()
+        close_writers()
 
 
 def main():
-    """Main function to run the bots."""
-    asyncio.run(start_bots())
+    """Main function to run the bots, in this process or sharded across worker processes."""
+    parser = argparse.ArgumentParser(description="Run the Telegram assistant bots.")
+    parser.add_argument(
+        "--workers", default=WORKERS,
+        help="number of worker processes, or 'auto' for one per CPU core (default: WORKERS or 1)",
+    )
+    args = parser.parse_args()
+    try:
+        check_settings()
+    except ValueError as e:
+        parser.error(str(e))
+
+    workers = os.cpu_count() if args.workers == "auto" else int(args.workers)
+    if workers > 1:
+        run_supervisor(workers)
+    else:
+        setup_logging()
+        asyncio.run(start_bots())
 
 
 if __name__ == "__main__":
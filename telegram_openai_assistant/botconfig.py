@@ -0,0 +1,147 @@
+# botconfig.py
+# Settings of each bot: the environment's defaults with per-bot overrides from BOTS_FILE
+
+import json
+import logging
+import os
+import re
+import zlib
+from pathlib import Path
+from . import config
+from .metrics import bot_label
+
+logger = logging.getLogger(__name__)
+
+# Settings a bot can override, with their types; the defaults are the settings of the same name in upper case
+FIELDS = {
+    "assistant_id": str,
+    "owner_chat_id": str,
+    "bot_daily_message_limit": int,
+    "user_daily_message_limit": int,
+    "start_message_sticker": str,
+    "start_message_text": str,
+    "help_message_text": str,
+    "error_message_text": str,
+    "user_callback_confirmation_text": str,
+    "user_callback_succeed_text": str,
+    "user_callback_request_text": str,
+    "user_callback_request_summary_text": str,
+    "user_did_not_send_phone_text": str,
+    "chat_owner_dialog_summary_request": str,
+    "chat_owner_ready_to_buy_dialog_estimation_request": str,
+    "chat_owner_ready_to_buy_dialog_diskount_marker": str,
+    "user_discount_provided_notificatiion": str,
+    "chat_owner_discount_provided_notificatiion": str,
+}
+
+TOKEN_PATTERN = re.compile(r"\d+:[A-Za-z0-9_-]+")
+
+
+class BotConfig:
+    """The settings of one bot; those not given fall back to the environment."""
+    __slots__ = ("token", *FIELDS)
+
+    def __init__(self, token: str, **settings):
+        if not TOKEN_PATTERN.fullmatch(token or ""):
+            raise ValueError("not a bot token")
+        self.token = token
+        for name, kind in FIELDS.items():
+            value = settings.pop(name, None)
+            if value is None:
+                value = _default(name)
+            elif not isinstance(value, kind) or isinstance(value, bool):
+                try:
+                    value = kind(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"{name} must be of type {kind.__name__}") from None
+            setattr(self, name, value)
+        if settings:
+            raise ValueError("unknown settings " + ", ".join(sorted(settings)))
+        if not self.assistant_id:
+            raise ValueError("no assistant_id")
+
+    def __eq__(self, other):
+        return isinstance(other, BotConfig) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"BotConfig({bot_label(self.token)}, assistant_id={self.assistant_id!r})"
+
+
+def _default(name: str):
+    return config.owner_chat_id if name == "owner_chat_id" else getattr(config, name.upper(), None)
+
+
+def shard_of(token: str, workers: int) -> int:
+    """The supervisor worker running a bot; stable across restarts and reloads."""
+    return zlib.crc32(token.encode()) % workers
+
+
+class BotConfigSource:
+    """
+    The configured bots: the TELEGRAM_TOKEN_BOT / ASSISTANT_ID_BOT pairs of the environment and
+    the bots of `path`, a JSON file {"defaults": {...}, "bots": [{"token": ..., ...}, ...]} whose
+    entries override the environment's settings. Read when first asked for and again by `reload`.
+    """
+
+    def __init__(self, path=config.BOTS_FILE):
+        self.path = Path(path) if path else None
+        self._configs = None
+        self._mtime = None
+
+    def configs(self) -> list:
+        if self._configs is None:
+            self.reload()
+        return self._configs
+
+    def changed(self) -> bool:
+        """Whether the file was modified since it was last read."""
+        return self.path is not None and _mtime(self.path) != self._mtime
+
+    def reload(self) -> list:
+        """
+        Read the bots again. Invalid entries are logged and left out, so one typo does not
+        stop the other bots; an unreadable file keeps the previous configuration.
+        """
+        entries = {token: {"assistant_id": assistant_id} for token, assistant_id in zip(config.telegram_token_bots, config.assistant_id_bots)}
+        defaults = {}
+        if self.path is not None:
+            self._mtime = _mtime(self.path)
+            try:
+                with open(self.path, encoding="utf-8") as file:
+                    data = json.load(file)
+                defaults = dict(data.get("defaults", {}))
+                for entry in data.get("bots", []):
+                    entry = dict(entry)
+                    token = str(entry.pop("token", ""))
+                    entries[token] = {**entries.get(token, {}), **entry}
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.error("Failed to read the bots file %s: %s", self.path, e)
+                if self._configs is not None:
+                    return self._configs
+
+        configs = []
+        for token, settings in entries.items():
+            try:
+                configs.append(BotConfig(token, **{**defaults, **settings}))
+            except ValueError as e:
+                logger.error("Skipping bot %s: %s", bot_label(token) or "without a token", e)
+        self._configs = configs
+        return configs
+
+
+def _mtime(path: Path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+_source = None
+
+
+def get_bot_config_source() -> BotConfigSource:
+    """Return the process-wide source of bot configurations."""
+    global _source
+    if _source is None:
+        _source = BotConfigSource()
+    return _source
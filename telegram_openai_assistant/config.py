@@ -7,22 +7,156 @@ load_dotenv()
 
 # Retrieve TELEGRAM_TOKEN as a comma-separated string and split it into a list
 telegram_token_bots = os.getenv("TELEGRAM_TOKEN_BOT", "").split(",")
+# Bot API server, e.g. a local telegram-bot-api instance (http://127.0.0.1:8081); empty for api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 # Retrieve ASSISTANT_ID as a comma-separated string and split it into a list
 assistant_id_bots = os.getenv("ASSISTANT_ID_BOT", "").split(",")
 client_api_key = os.getenv("CLIENT_API_KEY")
+# CLIENT_API_KEY may list several comma-separated keys the assistant requests are spread over; when they belong
+# to different projects, an assistant id lists its id in each project separated by "|", in the order of the keys
+client_api_keys = [key.strip() for key in (client_api_key or "").split(",") if key.strip()]
+# OpenAI-compatible API server, e.g. a local fake backend for tests; empty for api.openai.com
+ASSISTANT_API_URL = os.getenv("ASSISTANT_API_URL", "")
 owner_chat_id = os.getenv("OWNER_CHAT_ID")
+# JSON file with more bots and per-bot settings (assistant, owner chat, texts, limits), read in
+# addition to the lists above and reloaded when it changes every N seconds (0: only on SIGHUP)
+BOTS_FILE = os.getenv("BOTS_FILE", "")
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "10"))
+# Bots started at once, seconds a start may take before it is retried, and seconds between health checks
+BOT_START_CONCURRENCY = int(os.getenv("BOT_START_CONCURRENCY", "8"))
+BOT_START_TIMEOUT = float(os.getenv("BOT_START_TIMEOUT", "30"))
+BOT_HEALTH_INTERVAL = float(os.getenv("BOT_HEALTH_INTERVAL", "60"))
+
+# How bots receive updates: "polling" (one long-poll loop per bot) or "webhook" (one shared server)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Public base URL Telegram posts to; the server listens locally, usually behind a reverse proxy
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Secret used to derive each bot's webhook secret token; random per start if unset
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Parallel connections Telegram may open per bot, and updates per bot not handled yet before refusing more
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "100"))
+
+# Worker processes the bots are spread over ("auto": one per CPU core), heartbeat and shutdown grace in seconds
+WORKERS = os.getenv("WORKERS", "1").strip()
+SUPERVISOR_HEARTBEAT_INTERVAL = float(os.getenv("SUPERVISOR_HEARTBEAT_INTERVAL", "30"))
+SUPERVISOR_SHUTDOWN_TIMEOUT = float(os.getenv("SUPERVISOR_SHUTDOWN_TIMEOUT", "30"))
+
+# Assistant run settings: prompt budget and adaptive polling of run status (seconds)
+ASSISTANT_MAX_PROMPT_TOKENS = int(os.getenv("ASSISTANT_MAX_PROMPT_TOKENS", "8192"))
+ASSISTANT_POLL_INTERVAL = float(os.getenv("ASSISTANT_POLL_INTERVAL", "0.25"))
+ASSISTANT_POLL_MAX_INTERVAL = float(os.getenv("ASSISTANT_POLL_MAX_INTERVAL", "2"))
+ASSISTANT_POLL_BACKOFF = float(os.getenv("ASSISTANT_POLL_BACKOFF", "1.5"))
+ASSISTANT_RUN_TIMEOUT = float(os.getenv("ASSISTANT_RUN_TIMEOUT", "120"))
+# Assistant backends (API keys): requests each may start per second (0: no limit) and its burst, failures in a row
+# that open its circuit breaker and seconds it stays open, retries of requests not bound to a thread on another key,
+# and seconds after which such a request is hedged with a second one (0: never)
+ASSISTANT_KEY_RATE = float(os.getenv("ASSISTANT_KEY_RATE", "0"))
+ASSISTANT_KEY_BURST = int(os.getenv("ASSISTANT_KEY_BURST", "10"))
+ASSISTANT_BREAKER_FAILURES = int(os.getenv("ASSISTANT_BREAKER_FAILURES", "5"))
+ASSISTANT_BREAKER_COOLDOWN = float(os.getenv("ASSISTANT_BREAKER_COOLDOWN", "30"))
+ASSISTANT_RETRIES = int(os.getenv("ASSISTANT_RETRIES", "2"))
+ASSISTANT_HEDGE_DELAY = float(os.getenv("ASSISTANT_HEDGE_DELAY", "20"))
+# Streamed replies: show the answer while it is generated, editing the message at most every N seconds
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1").strip().lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Outgoing Telegram requests: per chat and per bot token rates (per second, 0 disables), requests in flight,
+# seconds owner notifications are collected into one digest and seconds to wait for queued requests on shutdown
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_BOT_RATE = float(os.getenv("SEND_BOT_RATE", "25"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "16"))
+OWNER_DIGEST_INTERVAL = float(os.getenv("OWNER_DIGEST_INTERVAL", "5"))
+SEND_DRAIN_TIMEOUT = float(os.getenv("SEND_DRAIN_TIMEOUT", "10"))
+# Updates: each user's are handled one at a time in order; users handled at once per bot, assistant runs
+# at once per assistant (0: no limit), updates a bot takes in before it stops fetching, and whether messages
+# that arrive while a user's previous one is answered are answered together, waiting up to N more seconds for them
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "128"))
+ASSISTANT_CONCURRENCY = int(os.getenv("ASSISTANT_CONCURRENCY", "64"))
+PENDING_UPDATES = int(os.getenv("PENDING_UPDATES", "1024"))
+COALESCE_MESSAGES = os.getenv("COALESCE_MESSAGES", "1").strip().lower() in ("1", "true", "yes")
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))
+# Local HTTP endpoint with /metrics and the profiler switches (port 0 disables it), and the profiler's sampling interval
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+# Logging: level of the bot's own records, format (json or text) and the fraction of
+# high-volume events kept, as event=rate pairs (message: handled messages, prompt and history: debug records)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+LOG_SAMPLING = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLING", "message=0.1,prompt=0.01,history=0.01").split(","))
+    if name.strip()
+}
+# Post-processing of answers, comma separated: citations, markdown (to Telegram formatting), split (4096 chars)
+RESPONSE_FILTERS = [name.strip() for name in os.getenv("RESPONSE_FILTERS", "citations,markdown,split").split(",") if name.strip()]
+
+# SQLite database shared by the persistent stores
+DB_PATH = os.getenv("DB_PATH", "assistant.db")
+# Writes are committed by a background thread: statements queued at most (0 writes synchronously),
+# statements per transaction, and seconds a bot waits on shutdown for its writes
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "10000"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_TIMEOUT = float(os.getenv("WRITE_FLUSH_TIMEOUT", "10"))
+
+# Per-user assistant threads: idle lifetime in seconds and number kept in memory
+THREAD_TTL = float(os.getenv("THREAD_TTL", str(7 * 24 * 3600)))
+THREAD_CACHE_SIZE = int(os.getenv("THREAD_CACHE_SIZE", "10000"))
+
+# Per-user conversation state: idle lifetime in seconds and whether it survives restarts
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+SESSION_PERSIST = os.getenv("SESSION_PERSIST", "1").strip().lower() in ("1", "true", "yes")
+
+# In-memory dialog history cache: turns kept per user, users kept, and memory cap in bytes
+HISTORY_CACHE_TURNS = int(os.getenv("HISTORY_CACHE_TURNS", "50"))
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "10000"))
+HISTORY_CACHE_BYTES = int(os.getenv("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Prompt assembly: token budget of the verbatim history and of the digest of older questions,
+# characters kept per answer and per digested question, and users whose digests are cached
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "1500"))
+PROMPT_DIGEST_TOKENS = int(os.getenv("PROMPT_DIGEST_TOKENS", "300"))
+PROMPT_ANSWER_CHARS = int(os.getenv("PROMPT_ANSWER_CHARS", "500"))
+PROMPT_DIGEST_CHARS = int(os.getenv("PROMPT_DIGEST_CHARS", "80"))
+PROMPT_CACHE_USERS = int(os.getenv("PROMPT_CACHE_USERS", "10000"))
+
+# Cache of answers to users' opening questions: lifetime in seconds (0, the default, disables it),
+# entries kept, and minimum TF-IDF cosine similarity for answering near-duplicate questions (0 disables)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "0"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+
+# Daily message limits (0 disables a limit) and per-user rate limit in messages per second
+DAILY_MESSAGE_LIMIT = int(os.getenv("DAILY_MESSAGE_LIMIT", "100"))
+BOT_DAILY_MESSAGE_LIMIT = int(os.getenv("BOT_DAILY_MESSAGE_LIMIT", "0"))
+USER_DAILY_MESSAGE_LIMIT = int(os.getenv("USER_DAILY_MESSAGE_LIMIT", "0"))
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", "0"))
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "5"))
+# Message counters are written to the database every N messages or every N seconds
+QUOTA_FLUSH_EVERY = int(os.getenv("QUOTA_FLUSH_EVERY", "20"))
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "10"))
 # Optional: Clean up whitespace from each item in the lists
 telegram_token_bots = [token.strip() for token in telegram_token_bots if token.strip()]
 assistant_id_bots = [aid.strip() for aid in assistant_id_bots if aid.strip()]
 
-# Debugging print to verify the lists (remove in production)
-print("Telegram Tokens:", telegram_token_bots)
-print("Assistant IDs:", assistant_id_bots)
-print("Client API Key:", client_api_key)
-print("Owner chat id:", owner_chat_id)
-
 CRM_WEBHOOK = os.getenv("CRM_WEBHOOK")
+# CRM lead delivery: request timeout and first retry delay in seconds, attempts, queue size and workers
+CRM_TIMEOUT = float(os.getenv("CRM_TIMEOUT", "10"))
+CRM_MAX_ATTEMPTS = int(os.getenv("CRM_MAX_ATTEMPTS", "5"))
+CRM_RETRY_BACKOFF = float(os.getenv("CRM_RETRY_BACKOFF", "1"))
+CRM_QUEUE_SIZE = int(os.getenv("CRM_QUEUE_SIZE", "100"))
+CRM_WORKERS = int(os.getenv("CRM_WORKERS", "2"))
+# Seconds after which the leads still undelivered after all attempts are tried again
+CRM_REDELIVERY_INTERVAL = float(os.getenv("CRM_REDELIVERY_INTERVAL", "60"))
+
+# Seconds of user inactivity before the discount estimation, its worker pool and queue size
+INACTIVITY_TIMEOUT = float(os.getenv("INACTIVITY_TIMEOUT", "300"))
+TIMER_WORKERS = int(os.getenv("TIMER_WORKERS", "4"))
+TIMER_QUEUE_SIZE = int(os.getenv("TIMER_QUEUE_SIZE", "1000"))
 START_MESSAGE_STICKER = os.getenv("START_MESSAGE_STICKER")
 
 START_MESSAGE_TEXT = os.getenv("START_MESSAGE_TEXT")
@@ -40,6 +174,14 @@ USER_CALLBACK_REQUEST_TEXT = os.getenv("USER_CALLBACK_REQUEST_TEXT")
 USER_CALLBACK_REQUEST_SUMMARY_TEXT = os.getenv("USER_CALLBACK_REQUEST_SUMMARY_TEXT")
 USER_DID_NOT_SEND_PHONE_TEXT = os.getenv("USER_DID_NOT_SEND_PHONE_TEXT")
 CHAT_OWNER_DIALOG_SUMMARY_REQUEST = os.getenv("CHAT_OWNER_DIALOG_SUMMARY_REQUEST")
+# Rolling dialog summaries read by the owner summary and discount estimation: refreshed every N turns
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "6"))
+SUMMARY_REQUEST = os.getenv(
+    "SUMMARY_REQUEST",
+    "Update the summary of this customer dialog. Keep the products discussed, the customer's needs, "
+    "objections and contact details. The previous summary comes first, then the new messages. "
+    "Reply with the updated summary only.",
+)
 CHAT_OWNER_READY_TO_BUY_DIALOG_ESTIMATION_REQUEST = os.getenv("CHAT_OWNER_READY_TO_BUY_DIALOG_ESTIMATION_REQUEST")
 CHAT_OWNER_READY_TO_BUY_DIALOG_DISKOUNT_MARKER = os.getenv("CHAT_OWNER_READY_TO_BUY_DIALOG_DISKOUNT_MARKER")
 USER_DISCOUNT_PROVIDED_NOTIFICATIION = os.getenv("USER_DISCOUNT_PROVIDED_NOTIFICATIION")
@@ -0,0 +1,224 @@
+# crm.py
+# Delivers leads to the CRM webhook in the background, with retries and a durable outbox
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Awaitable, Callable, Optional
+import httpx
+from .config import (
+    DB_PATH,
+    CRM_TIMEOUT,
+    CRM_MAX_ATTEMPTS,
+    CRM_RETRY_BACKOFF,
+    CRM_QUEUE_SIZE,
+    CRM_WORKERS,
+    CRM_REDELIVERY_INTERVAL,
+)
+from .metrics import get_metrics, bot_label
+from .utils import sanitize_filename
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentDeliveryError(Exception):
+    """The CRM rejected a lead; retrying would not help."""
+
+
+class LeadOutbox:
+    """Leads waiting for delivery, kept in SQLite so they survive restarts."""
+
+    def __init__(self, db_path=DB_PATH):
+        self._conn = sqlite3.connect(str(db_path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS crm_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                delivered_text TEXT,
+                failed_text TEXT,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def add(self, bot: str, payload: dict, delivered_text: str, failed_text: str) -> int:
+        cursor = self._conn.execute(
+            "INSERT INTO crm_outbox (bot, payload, delivered_text, failed_text, created_at) VALUES (?, ?, ?, ?, ?)",
+            (bot, json.dumps(payload, ensure_ascii=False), delivered_text, failed_text, time.time()),
+        )
+        self._conn.commit()
+        return cursor.lastrowid
+
+    def get(self, lead_id: int) -> Optional[tuple]:
+        """Return (payload, delivered_text, failed_text) of a pending lead."""
+        row = self._conn.execute(
+            "SELECT payload, delivered_text, failed_text FROM crm_outbox WHERE id = ?", (lead_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def pending(self, bot: str) -> list:
+        """Return the ids of the leads of a bot that were not delivered yet."""
+        rows = self._conn.execute("SELECT id FROM crm_outbox WHERE bot = ? ORDER BY id", (bot,)).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, lead_id: int):
+        self._conn.execute("DELETE FROM crm_outbox WHERE id = ?", (lead_id,))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class LeadDelivery:
+    """
+    Bounded queue of leads drained by a few workers over one pooled HTTP client.
+    A lead is stored in the outbox before it is queued and removed only once the CRM
+    confirmed it (or rejected it for good); `notify` is then awaited with the owner message.
+    A lead the CRM did not take after `max_attempts` stays in the outbox and is tried again
+    every `redelivery_interval` seconds; the owner is told about it once, with the failure message.
+    """
+
+    def __init__(
+        self,
+        webhook_url: str,
+        telegram_id: str,
+        notify: Callable[[str], Awaitable],
+        db_path=DB_PATH,
+        timeout: float = CRM_TIMEOUT,
+        max_attempts: int = CRM_MAX_ATTEMPTS,
+        retry_backoff: float = CRM_RETRY_BACKOFF,
+        queue_size: int = CRM_QUEUE_SIZE,
+        workers: int = CRM_WORKERS,
+        redelivery_interval: float = CRM_REDELIVERY_INTERVAL,
+    ):
+        self.webhook_url = webhook_url
+        self.bot = sanitize_filename(telegram_id)
+        self.notify = notify
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.workers = workers
+        self.redelivery_interval = redelivery_interval
+        self.outbox = LeadOutbox(db_path)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._metrics = get_metrics()
+        self._label = bot_label(telegram_id)
+        self._http = None
+        self._tasks = []
+        self._parked = set()    # ids of the leads waiting for the next redelivery round
+        self._reported = set()  # ids of the undelivered leads the owner was told about
+
+    async def start(self):
+        """Open the HTTP client, start the workers and requeue leads left from a previous run."""
+        self._http = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers),
+        )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._requeue(self.outbox.pending(self.bot))))
+        self._tasks.append(asyncio.create_task(self._redeliver()))
+
+    async def stop(self):
+        """Stop the workers; undelivered leads stay in the outbox for the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        self.outbox.close()
+
+    def backlog(self) -> int:
+        """Number of leads queued for delivery."""
+        return self._queue.qsize()
+
+    async def submit(self, lead_data: dict, delivered_text: str, failed_text: str):
+        """Store a lead and queue it for delivery; waits only if the queue is full."""
+        if not self.webhook_url:
+            logger.warning("CRM webhook is not configured, lead not sent")
+            await self.notify(failed_text)
+            return
+        lead_id = self.outbox.add(self.bot, lead_data, delivered_text, failed_text)
+        await self._queue.put(lead_id)
+
+    async def _requeue(self, lead_ids):
+        for lead_id in lead_ids:
+            await self._queue.put(lead_id)
+
+    async def _redeliver(self):
+        while True:
+            await asyncio.sleep(self.redelivery_interval)
+            lead_ids, self._parked = sorted(self._parked), set()
+            await self._requeue(lead_ids)
+
+    async def _worker(self):
+        while True:
+            lead_id = await self._queue.get()
+            try:
+                await self._deliver(lead_id)
+            except Exception:
+                logger.exception("Failed to process lead %s", lead_id)
+                self._parked.add(lead_id)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, lead_id: int):
+        lead = self.outbox.get(lead_id)
+        if lead is None:
+            return
+        payload, delivered_text, failed_text = lead
+
+        delay = self.retry_backoff
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with self._metrics.timer("crm_request_seconds", bot=self._label):
+                    result = await self.post(payload)
+            except PermanentDeliveryError as e:
+                self._metrics.inc("crm_requests_total", bot=self._label, outcome="rejected")
+                logger.error("Lead %s rejected by CRM: %s", lead_id, e)
+                self.outbox.remove(lead_id)
+                if lead_id in self._reported:
+                    self._reported.discard(lead_id)  # The owner heard about it already
+                else:
+                    await self.notify(failed_text)
+                return
+            except (httpx.HTTPError, ValueError) as e:
+                self._metrics.inc("crm_requests_total", bot=self._label, outcome="failed")
+                logger.warning("Lead %s delivery attempt %s failed: %s", lead_id, attempt, e)
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                continue
+            self._metrics.inc("crm_requests_total", bot=self._label, outcome="delivered")
+            logger.info("Lead %s added to the CRM as %s", lead_id, result)
+            self.outbox.remove(lead_id)
+            self._reported.discard(lead_id)
+            await self.notify(delivered_text)
+            return
+
+        # The CRM may be down for a while; the lead waits in the outbox for the next round
+        logger.warning("Lead %s not delivered, trying again in %ss", lead_id, self.redelivery_interval)
+        self._parked.add(lead_id)
+        if lead_id not in self._reported:
+            self._reported.add(lead_id)
+            await self.notify(failed_text)
+
+    async def post(self, payload: dict):
+        """Post one lead and return the CRM result, raising on failure."""
+        response = await self._http.post(self.webhook_url, json=payload)
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PermanentDeliveryError(f"HTTP {response.status_code}")
+        response.raise_for_status()  # 5xx, 408 and 429 are retried
+        result = response.json()
+        if not isinstance(result, dict):
+            raise ValueError(f"unexpected CRM reply: {str(result)[:100]}")
+        if "result" not in result:
+            raise PermanentDeliveryError(result.get("error_description", "Unknown error"))
+        return result["result"]
@@ -0,0 +1,156 @@
+# dialog_store.py
+# Append-only storage of question/answer pairs, indexed per bot and user
+
+import sqlite3
+import time
+from typing import Iterable, List, Optional
+from .config import DB_PATH
+from .metrics import get_metrics, bot_label
+from .writebehind import WriteBehind
+
+# Longest wait (seconds) of `count` for the queued appends of the user it counts
+COUNT_WAIT = 1.0
+
+# Users with queued appends remembered before the committed ones are forgotten
+MAX_TRACKED_APPENDS = 10000
+
+
+class DialogStore:
+    """Interface of a dialog log: O(1) appends and per-user history lookups."""
+
+    # True when an appended entry shows up in the lookups some time after `append` returned
+    deferred = False
+
+    def append(self, bot: str, telegram_id: int, username, question: str, answer: str) -> int:
+        """Append one question/answer pair to the log of a user; returns a number for `persisted`."""
+        raise NotImplementedError
+
+    def persisted(self, seq: int, timeout: float = 0) -> bool:
+        """Tell whether the entry `append` returned `seq` for shows up in the lookups, waiting up to `timeout`."""
+        return True
+
+    async def wait_persisted(self, seq: int, timeout: float = 0) -> bool:
+        """`persisted` for the event loop, which it does not block while it waits."""
+        return True
+
+    def history(self, bot: str, telegram_id: int, limit: Optional[int] = None) -> List[dict]:
+        """Return the entries of a user in chronological order, optionally only the last `limit`."""
+        raise NotImplementedError
+
+    async def count(self, bot: str, telegram_id: int) -> int:
+        """Return the number of entries of a user."""
+        raise NotImplementedError
+
+    def import_entries(self, bot: str, entries: Iterable[dict], created_at: float = None, source: str = None) -> int:
+        """
+        Bulk-load legacy entries and return how many were imported.
+        A `source` name is recorded in the same transaction so it is never imported twice.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteDialogStore(DialogStore):
+    """Dialog log kept in a SQLite table in WAL mode, appended to through `writer` if given."""
+
+    def __init__(self, db_path=DB_PATH, writer: WriteBehind = None):
+        self.db_path = db_path
+        self.writer = writer
+        self.deferred = writer is not None and writer.deferred
+        self._appended = {}  # (bot, telegram_id) -> number of the last queued append
+        self._conn = sqlite3.connect(str(db_path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS dialogs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot TEXT NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                username TEXT,
+                question TEXT,
+                answer TEXT,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS dialogs_user ON dialogs (bot, telegram_id, id)"
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS dialog_imports (
+                source TEXT PRIMARY KEY,
+                entries INTEGER NOT NULL,
+                imported_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def append(self, bot, telegram_id, username, question, answer):
+        sql = "INSERT INTO dialogs (bot, telegram_id, username, question, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+        params = (bot, telegram_id, username, question, answer, time.time())
+        if self.writer is not None:
+            seq = self.writer.execute(sql, params)
+            if self.deferred:
+                if len(self._appended) >= MAX_TRACKED_APPENDS:
+                    self._appended = {key: last for key, last in self._appended.items() if not self.writer.persisted(last)}
+                self._appended[(bot, telegram_id)] = seq
+            return seq
+        with get_metrics().timer("storage_seconds", store="dialogs", op="append", bot=bot_label(bot)):
+            self._conn.execute(sql, params)
+            self._conn.commit()
+        return 0
+
+    def persisted(self, seq, timeout=0):
+        return self.writer is None or self.writer.persisted(seq, timeout)
+
+    async def wait_persisted(self, seq, timeout=0):
+        return self.writer is None or await self.writer.wait_persisted(seq, timeout)
+
+    def history(self, bot, telegram_id, limit=None):
+        with get_metrics().timer("storage_seconds", store="dialogs", op="history", bot=bot_label(bot)):
+            rows = self._conn.execute(
+                "SELECT telegram_id, username, question, answer FROM dialogs"
+                " WHERE bot = ? AND telegram_id = ? ORDER BY id DESC LIMIT ?",
+                (bot, telegram_id, -1 if limit is None else limit),
+            ).fetchall()
+        return [
+            {"telegram_id": row[0], "username": row[1], "question": row[2], "answer": row[3]}
+            for row in reversed(rows)
+        ]
+
+    async def count(self, bot, telegram_id):
+        seq = self._appended.pop((bot, telegram_id), None)
+        if seq is not None:
+            await self.writer.wait_persisted(seq, COUNT_WAIT)
+        with get_metrics().timer("storage_seconds", store="dialogs", op="count", bot=bot_label(bot)):
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM dialogs WHERE bot = ? AND telegram_id = ?", (bot, telegram_id)
+            ).fetchone()
+        return row[0]
+
+    def import_entries(self, bot, entries, created_at=None, source=None):
+        created_at = time.time() if created_at is None else created_at
+        cursor = self._conn.executemany(
+            "INSERT INTO dialogs (bot, telegram_id, username, question, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (bot, entry.get("telegram_id"), entry.get("username"), entry.get("question"), entry.get("answer"), created_at)
+                for entry in entries
+            ),
+        )
+        count = cursor.rowcount
+        if source is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dialog_imports (source, entries, imported_at) VALUES (?, ?, ?)",
+                (source, count, time.time()),
+            )
+        self._conn.commit()
+        return count
+
+    def is_imported(self, source: str) -> bool:
+        """Tell whether a legacy file was already imported."""
+        row = self._conn.execute("SELECT 1 FROM dialog_imports WHERE source = ?", (source,)).fetchone()
+        return row is not None
+
+    def close(self):
+        self._conn.close()
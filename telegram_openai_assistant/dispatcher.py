@@ -0,0 +1,186 @@
+# dispatcher.py
+# Updates of a user handled one at a time in order, different users concurrently within limits
+
+import asyncio
+import logging
+from collections import deque
+from contextlib import nullcontext
+from .config import (
+    UPDATE_CONCURRENCY,
+    ASSISTANT_CONCURRENCY,
+    COALESCE_MESSAGES,
+    COALESCE_WINDOW,
+    ASSISTANT_RUN_TIMEOUT,
+)
+from .metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Delivery:
+    __slots__ = ("callback", "update", "context", "messages", "future")
+
+    def __init__(self, callback, update, context, messages: bool, future: asyncio.Future):
+        self.callback = callback
+        self.update = update
+        self.context = context
+        self.messages = messages
+        self.future = future
+
+
+class Mailbox:
+    """The updates of one user waiting to be handled, and the task handling them."""
+    __slots__ = ("deliveries", "task")
+
+    def __init__(self):
+        self.deliveries = deque()
+        self.task = None
+
+
+class UpdateDispatcher:
+    """
+    Runs the handlers of one bot. The updates of a user are handled one at a time in the
+    order they arrived, so a dialog never races itself; different users are handled at the
+    same time, at most `concurrency` of them, and message handlers also wait for the
+    `assistant_limit` shared by the bots of one assistant. With `coalesce`, text messages
+    that pile up while a user's previous update is handled are answered as one message.
+    """
+
+    def __init__(
+        self,
+        bot: str,
+        assistant_limit: asyncio.Semaphore = None,
+        concurrency: int = UPDATE_CONCURRENCY,
+        coalesce: bool = COALESCE_MESSAGES,
+        window: float = COALESCE_WINDOW,
+    ):
+        self.bot = bot
+        self.assistant_limit = assistant_limit
+        self.coalesce = coalesce
+        self.window = window
+        self._limit = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self._mailboxes = {}  # user id -> Mailbox
+        self._pending = 0     # updates taken in and not handled yet
+
+    def wrap(self, callback, messages: bool = False):
+        """
+        The handler callback `callback` dispatched per user. `messages` marks the handler of
+        text messages: it asks the assistant and can be called with the merged `text` of several.
+        """
+        async def dispatched(update, context):
+            return await self.dispatch(callback, update, context, messages)
+        return dispatched
+
+    async def dispatch(self, callback, update, context, messages: bool = False):
+        """Queue an update behind the other updates of its user and return once it is handled."""
+        self._pending += 1
+        try:
+            return await self._dispatch(callback, update, context, messages)
+        finally:
+            self._pending -= 1
+
+    async def _dispatch(self, callback, update, context, messages: bool):
+        user = update.effective_user
+        if user is None:
+            # E.g. a channel post: nothing to keep in order with
+            return await self._handle([Delivery(callback, update, context, messages, None)])
+
+        future = asyncio.get_running_loop().create_future()
+        mailbox = self._mailboxes.get(user.id)
+        if mailbox is None:
+            mailbox = self._mailboxes[user.id] = Mailbox()
+        mailbox.deliveries.append(Delivery(callback, update, context, messages, future))
+        if mailbox.task is None:
+            mailbox.task = asyncio.create_task(self._drain(user.id, mailbox))
+        return await future
+
+    def backlog(self) -> int:
+        """Updates waiting behind an update of the same user."""
+        return sum(len(mailbox.deliveries) for mailbox in self._mailboxes.values())
+
+    def pending(self) -> int:
+        """Updates taken in and not handled yet, whether they wait or run."""
+        return self._pending
+
+    def active_users(self) -> int:
+        return len(self._mailboxes)
+
+    async def stop(self, timeout: float = ASSISTANT_RUN_TIMEOUT):
+        """Wait until the queued updates are handled, cancelling those still running after `timeout` seconds."""
+        tasks = [mailbox.task for mailbox in self._mailboxes.values() if mailbox.task is not None]
+        if not tasks:
+            return
+        _, running = await asyncio.wait(tasks, timeout=timeout)
+        if running:
+            logger.warning("Cancelled the updates of %s users still being handled", len(running))
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def _drain(self, user_id: int, mailbox: Mailbox):
+        try:
+            while mailbox.deliveries:
+                first = mailbox.deliveries.popleft()
+                if first.future.done():
+                    continue  # The caller stopped waiting for it
+                batch = [first]
+                if self.coalesce and first.messages and first.update.message is not None:
+                    if self.window > 0 and not mailbox.deliveries:
+                        await asyncio.sleep(self.window)
+                    while mailbox.deliveries and self._joins(first, mailbox.deliveries[0]):
+                        batch.append(mailbox.deliveries.popleft())
+                    batch = [delivery for delivery in batch if not delivery.future.done()]
+                    if not batch:
+                        continue
+                try:
+                    result = await self._handle(batch)
+                except asyncio.CancelledError:
+                    for delivery in batch:
+                        delivery.future.cancel()
+                    raise
+                except Exception as e:
+                    # Reported once, through the update the answer went to
+                    for delivery in batch[:-1]:
+                        delivery.future.set_result(None)
+                    batch[-1].future.set_exception(e)
+                else:
+                    for delivery in batch:
+                        if not delivery.future.done():
+                            delivery.future.set_result(result)
+        finally:
+            for delivery in mailbox.deliveries:
+                delivery.future.cancel()
+            del self._mailboxes[user_id]
+
+    @staticmethod
+    def _joins(first: Delivery, delivery: Delivery) -> bool:
+        """Whether a waiting update can be answered together with the message `first`."""
+        return (
+            delivery.messages
+            and delivery.update.message is not None
+            and delivery.update.effective_chat.id == first.update.effective_chat.id
+        )
+
+    async def _handle(self, batch: list):
+        """Run the handler for the last update of a batch, the text of all of them merged."""
+        last = batch[-1]
+        kwargs = {}
+        if len(batch) > 1:
+            kwargs["text"] = "\n".join(delivery.update.message.text for delivery in batch)
+            get_metrics().inc("updates_coalesced_total", len(batch) - 1, bot=self.bot)
+        assistant_limit = self.assistant_limit if last.messages and self.assistant_limit is not None else nullcontext()
+        async with self._limit or nullcontext(), assistant_limit:
+            return await last.callback(last.update, last.context, **kwargs)
+
+
+_assistant_limits = {}
+
+
+def get_assistant_limit(assistant_id: str, concurrency: int = ASSISTANT_CONCURRENCY):
+    """Return the limit shared by all bots of the process answering with an assistant, None if unlimited."""
+    if concurrency <= 0:
+        return None
+    limit = _assistant_limits.get(assistant_id)
+    if limit is None:
+        limit = _assistant_limits[assistant_id] = asyncio.Semaphore(concurrency)
+    return limit
@@ -1,153 +1,227 @@
-import time
-import re
-import datetime
 import logging
-import requests
+import time
 from telegram.ext import CallbackContext, ContextTypes
 from telegram import Update
-from openai import OpenAI
-from .config import client_api_key
-from .config import owner_chat_id
-from .utils import get_message_count, update_message_count, save_qa, get_dialog_history,get_dialog_history_short
-from .phoneNumberUtil import is_phone_number_exists, parse_name, parse_phone
-from .config import (
-    CRM_WEBHOOK,
-    START_MESSAGE_STICKER,
-    START_MESSAGE_TEXT,
-    HELP_MESSAGE_TEXT,
-    ERROR_MESSAGE_TEXT,
-    USER_CALLBACK_CONFIRMATION_TEXT,
-    USER_CALLBACK_SUCCEED_TEXT,
-    USER_CALLBACK_REQUEST_TEXT,
-    USER_CALLBACK_REQUEST_SUMMARY_TEXT,
-    USER_DID_NOT_SEND_PHONE_TEXT,
-    CHAT_OWNER_DIALOG_SUMMARY_REQUEST,
-    CHAT_OWNER_READY_TO_BUY_DIALOG_ESTIMATION_REQUEST,
-    CHAT_OWNER_READY_TO_BUY_DIALOG_DISKOUNT_MARKER,
-    USER_DISCOUNT_PROVIDED_NOTIFICATIION,
-    CHAT_OWNER_DISCOUNT_PROVIDED_NOTIFICATIION,
-    PROMOCODE_DETAILS
-)
-
-INACTIVITY_TIMEOUT = 300  # 5 min
-
-client = OpenAI(api_key=client_api_key)
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(telegram_id)s - %(message)s',
-    level=logging.ERROR 
-)
+from openai import NotFoundError
+from .assistant import AssistantClient
+from .backends import BackendUnavailable
+from .botconfig import BotConfig
+from .crm import LeadDelivery
+from .dispatcher import UpdateDispatcher, get_assistant_limit
+from .session import SessionStore
+from .threads import ThreadRegistry
+from .timers import InactivityTimers
+from .quota import get_quota_counter
+from .response_cache import get_response_cache
+from .prompt import PromptBuilder
+from .summaries import RollingSummaries
+from .streaming import StreamingReply
+from .postprocess import get_response_pipeline
+from .sender import get_message_scheduler, NOTICE
+from .metrics import get_metrics, bot_label
+from .logs import log_context
+from .utils import save_qa, get_recent_turns
+from .writebehind import get_write_behind
+from .phoneNumberUtil import extract_phone
+from .config import CRM_WEBHOOK, STREAM_REPLIES
+
+logger = logging.getLogger(__name__)
 
 class BotHandlers:
-    def __init__(self, assistant_id: str, telegram_id: str, application):
+    def __init__(self, assistant_id: str, telegram_id: str, application, config: BotConfig = None):
+        # Texts, owner chat and limits of this bot; the environment's unless the bots file overrides them
+        self.config = config or BotConfig(telegram_id, assistant_id=assistant_id)
         self.assistant_id = assistant_id
         self.telegram_id = telegram_id
-        self.user_agreed_policies = False
-        self.user_number_sent = False
-        self.job_queue = application.job_queue 
+        self.assistant = AssistantClient(assistant_id, bot=bot_label(telegram_id))
+        self.threads = ThreadRegistry()
+        self.prompt_builder = PromptBuilder()
+        self.summaries = RollingSummaries(telegram_id, summarize=self.get_answer)
+        self.quota = get_quota_counter()
+        self.response_cache = get_response_cache()
+        self.response_pipeline = get_response_pipeline()
+        self.sender = get_message_scheduler()
+        self.writer = get_write_behind()
+        self.application = application
+        self.crm = LeadDelivery(CRM_WEBHOOK, telegram_id, notify=self.notify_owner)
+        self.sessions = SessionStore(telegram_id)
+        self.timers = InactivityTimers(self.timeout_end)
+        self.dispatcher = UpdateDispatcher(bot_label(telegram_id), get_assistant_limit(assistant_id))
 
     async def start(self, update: Update, context: CallbackContext) -> None:
         """Sends a welcome message to the user."""
-        self.reset_state()
-        await context.bot.send_sticker(update.effective_chat.id, START_MESSAGE_STICKER)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id, text=START_MESSAGE_TEXT
-        )
+        self.reset_state(update.effective_user.id)
+        await self.sender.call(context.bot, update.effective_chat.id, "send_sticker", sticker=self.config.start_message_sticker)
+        await self.sender.send_message(context.bot, update.effective_chat.id, self.config.start_message_text)
 
-    def reset_state(self):
-        """Resets the state of the bot's flags."""
-        self.user_agreed_policies = False
-        self.user_number_sent = False
+    def reset_state(self, user_id: int):
+        """Resets the conversation state of a user."""
+        self.sessions.reset(user_id)
         
     async def help_command(self, update: Update, context: CallbackContext) -> None:
         """Sends a help message to the user."""
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=HELP_MESSAGE_TEXT,
-        )
+        await self.sender.send_message(context.bot, update.effective_chat.id, self.config.help_message_text)
 
-    def get_answer(self, message_str) -> None:
+    async def get_answer(self, message_str) -> str:
         """Get answer from assistant using the assistant_id."""
-        thread = client.beta.threads.create()
-        client.beta.threads.messages.create(
-            thread_id=thread.id, role="user", content=message_str
-        )
+        return await self.assistant.get_answer(message_str)
 
-        run = client.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=self.assistant_id,  # Use the assistant_id passed when creating the handler
-            max_prompt_tokens=8192 
-        )
+    async def get_user_answer(self, user_id: int, message_text: str, reply: StreamingReply = None) -> str:
+        """
+        Answer a user's message on their persistent assistant thread.
+        With a `reply` the answer is streamed into it while it is generated.
+        """
+        thread_id = await self.threads.get(self.telegram_id, user_id)
+        if thread_id is not None:
+            try:
+                return await self.ask_thread(message_text, thread_id, reply)
+            except (NotFoundError, BackendUnavailable):
+                # The thread was deleted upstream or its backend is down, start over with a new one
+                self.threads.drop(self.telegram_id, user_id)
 
-        # Poll for the response (this could be improved with async calls)
-        while True:
-            run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-            if run.status == "completed":
-                break
-            time.sleep(1)
+        # A new thread only knows what we tell it, so seed it with the recent dialog once
+        thread_id = await self.assistant.create_thread()
+        self.threads.put(self.telegram_id, user_id, thread_id)
 
-        messages = client.beta.threads.messages.list(thread_id=thread.id)
-        response = messages.dict()["data"][0]["content"][0]["text"]["value"]
-        return response
+        turns = await get_recent_turns(user_id, self.telegram_id)
+        final_promt = self.prompt_builder.build((self.telegram_id, user_id), message_text, turns)
+        logger.debug("Prompt for a new thread: %s", final_promt, extra={"event": "prompt"})
+        return await self.ask_thread(final_promt, thread_id, reply)
+
+    async def ask_thread(self, message_str: str, thread_id: str, reply: StreamingReply = None) -> str:
+        """Send a message to a thread and return the raw answer, streaming it into `reply` if given."""
+        if reply is None:
+            return await self.assistant.get_answer(message_str, thread_id=thread_id)
+        async for chunk in self.assistant.stream_answer(message_str, thread_id):
+            await reply.feed(chunk)
+        return reply.raw
+
+    async def startup(self):
+        """Starts the background services of the handlers."""
+        # Their tasks inherit the context, so what they log names the bot
+        with log_context(bot=bot_label(self.telegram_id)):
+            await self.crm.start()
+            await self.timers.start()
+        self.watch_queues()
+
+    async def shutdown(self):
+        """Stops the background services and releases the persistent stores."""
+        # Updates already taken in are answered first
+        await self.dispatcher.stop()
+        self.watch_queues(stop=True)
+        await self.timers.stop()
+        await self.crm.stop()
+        await self.summaries.stop()
+        self.threads.close()
+        self.sessions.close()
+
+    def watch_queues(self, stop: bool = False):
+        """Report (or stop reporting) the depths of this bot's queues as metrics."""
+        metrics, bot = get_metrics(), bot_label(self.telegram_id)
+        queues = {
+            "updates": self.application.update_queue.qsize,
+            "mailboxes": self.dispatcher.backlog,
+            "crm": self.crm.backlog,
+            "timers": self.timers.__len__,
+        }
+        for queue, depth in queues.items():
+            if stop:
+                metrics.remove_gauge("queue_depth", bot=bot, queue=queue)
+            else:
+                metrics.gauge("queue_depth", depth, bot=bot, queue=queue)
+
+    async def notify_owner(self, text: str):
+        """Adds a message to the next notification digest of the chat owner."""
+        self.sender.notify(self.application.bot, self.config.owner_chat_id, text)
     
-    async def timeout_end(self, update: Update, context: CallbackContext):
+    async def timeout_end(self, user_id: int, chat: tuple):
         # This code will estimate user interes to product and suggest some discount to stir up customer interes
-         dialog_str = get_dialog_history(update.effective_user.id, self.telegram_id)
-         discount_estimation = self.get_answer(CHAT_OWNER_READY_TO_BUY_DIALOG_ESTIMATION_REQUEST + dialog_str)
+         chat_id, username = chat
+         session = self.sessions.get(user_id)
+         if session.discount_offered:
+             return
+         dialog_str = await self.summaries.dialog(user_id)
+         discount_estimation = await self.get_answer(self.config.chat_owner_ready_to_buy_dialog_estimation_request + dialog_str)
          
-         if CHAT_OWNER_READY_TO_BUY_DIALOG_DISKOUNT_MARKER in discount_estimation: 
-             client_msg = USER_DISCOUNT_PROVIDED_NOTIFICATIION + update.effective_user.username
-             chat_owner_msg = CHAT_OWNER_DISCOUNT_PROVIDED_NOTIFICATIION + update.effective_user.username
-             await context.bot.send_message(chat_id=owner_chat_id,text=chat_owner_msg)
-             await context.bot.send_message(chat_id=update.effective_chat.id, text=client_msg)
+         if self.config.chat_owner_ready_to_buy_dialog_diskount_marker in discount_estimation: 
+             session.discount_offered = True
+             self.sessions.save(user_id, session)
+             client_msg = self.config.user_discount_provided_notificatiion + username
+             chat_owner_msg = self.config.chat_owner_discount_provided_notificatiion + username
+             await self.notify_owner(chat_owner_msg)
+             await self.sender.send_message(self.application.bot, chat_id, client_msg, priority=NOTICE)
 
          
-    async def process_message(self, update: Update, context: CallbackContext) -> None:
-        """Processes a message from the user, gets an answer, and sends it back."""
-        job_queue = context.application.job_queue
-        job = job_queue.run_once(self.timeout_end, INACTIVITY_TIMEOUT, chat_id=update.effective_chat.id, name="inactivity_timeout")
-        
-        context.user_data["timeout_job"] = job
+    async def process_message(self, update: Update, context: CallbackContext, text: str = None) -> None:
+        """
+        Processes a message from the user, gets an answer, and sends it back.
+        `text` replaces the message's own text, e.g. when several messages are answered together.
+        """
         if update.message is None:
             return  # Exit if the message is None
-        
-        dialog_promt = "This in the dialog history. Study the history of answers and questions of this user and all details on the product he is interested in. When giving an answer I use all the details of the dialogue history in order to form an answer. At the end of the message you will find a question that needs to be answered. " 
-        dialog_str = get_dialog_history_short(update.effective_user.id, self.telegram_id)
-        message_promt = " Answer this question on the language given in the question: "
-        message_text = update.message.text
-        
+        started = time.monotonic()
 
-        final_promt = dialog_promt + dialog_str + message_promt + message_text
-        print(f"final_promt: {final_promt}")
-        message_data = get_message_count()
-        count = message_data["count"]
-        date = message_data["date"]
-        today = str(datetime.date.today())
+        # One timer per user, pushed back by every message
+        self.timers.touch(update.effective_user.id, (update.effective_chat.id, update.effective_user.username or ""))
+        
+        message_text = text or update.message.text
 
-        if date != today:
-            count = 0
-        if count >= 100:
+        user_id = update.effective_user.id
+        if not await self.quota.acquire(
+            self.telegram_id, user_id, self.config.bot_daily_message_limit, self.config.user_daily_message_limit
+        ):
             return
+        # The writes of this message wait here while the database is behind, not in the event loop
+        await self.writer.throttle()
+
+        session = self.sessions.get(user_id)
+        awaiting_phone = session.agreed_policies and not session.number_sent
+
+        # Only a user's opening question is answered from or into the cache: an answer given on a
+        # thread depends on that user's dialog, and a cache hit leaves no turn on the thread.
+        # The next message seeds the new thread with the saved dialog, the cached exchange included.
+        # Answers that ask for the phone number switch the session and are never cached.
+        cacheable = not awaiting_phone and await self.threads.get(self.telegram_id, user_id) is None
 
-        answerRaw = self.get_answer(final_promt)
-        answer = self.parse_and_clean_response(answerRaw)
+        answer = None
+        source = "cache"
+        answerRaw = self.response_cache.get(self.telegram_id, message_text) if cacheable else None
+        if answerRaw is None:
+            try:
+                if STREAM_REPLIES and not awaiting_phone:
+                    # The answer is shown as it is generated instead of after the run
+                    source = "stream"
+                    async with StreamingReply(context.bot, update.effective_chat.id, self.response_pipeline) as reply:
+                        answerRaw = await self.get_user_answer(user_id, message_text, reply)
+                        answer = await reply.finish()
+                else:
+                    source = "assistant"
+                    answerRaw = await self.get_user_answer(user_id, message_text)
+            except Exception:
+                self.quota.release(self.telegram_id, user_id)
+                raise
+            if cacheable and self.config.user_callback_confirmation_text not in answerRaw:
+                self.response_cache.put(self.telegram_id, message_text, answerRaw)
+        streamed = answer is not None
+        if not streamed:
+            processed = self.response_pipeline.process(answerRaw)
+            answer = processed.text
         
-        if self.user_agreed_policies and not self.user_number_sent:
+        if awaiting_phone:
             
-            if is_phone_number_exists(message_text):
+            if extract_phone(message_text).valid:
                 await self.process_callback_message(message_text, update, context)
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=USER_CALLBACK_SUCCEED_TEXT)
+                await self.sender.send_message(context.bot, update.effective_chat.id, self.config.user_callback_succeed_text)
                 
             else:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=USER_DID_NOT_SEND_PHONE_TEXT)
-                
-            update_message_count(count + 1)     
-        else:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
-            update_message_count(count + 1)
+                await self.sender.send_message(context.bot, update.effective_chat.id, self.config.user_did_not_send_phone_text)
+        elif not streamed:
+            for part in processed.parts:
+                await self.sender.send_message(context.bot, update.effective_chat.id, part.text, entities=part.entities or None)
             
-        if USER_CALLBACK_CONFIRMATION_TEXT in answer: 
-            self.user_agreed_policies = True
+        if self.config.user_callback_confirmation_text in answer and not session.agreed_policies: 
+            session.agreed_policies = True
+            self.sessions.save(user_id, session)
 
         save_qa(
             update.effective_user.id,
@@ -156,84 +230,53 @@ class BotHandlers:
             answer,
             self.telegram_id  # Pass the bot's telegram_id to keep track
         )
-        
+        self.summaries.note_turn(update.effective_user.id)
+        logger.info(
+            "Answered a message", extra={"event": "message", "source": source, "seconds": round(time.monotonic() - started, 3)}
+        )
+
     def parse_and_clean_response(self, response: str) -> str:
         """
-        Parses text, removing content in square brackets if it's not a link.
+        Parses text, removing content in square brackets if it's not a link,
+        and applies the other RESPONSE_FILTERS.
         """
-        import re
-
-        def replacer(match):
-            text = match.group(1)
-            if re.match(r'^(https?://)', text, re.IGNORECASE):
-                return f'[{text}]'
-            return ''  # Remove text if it's not a link
-
-        cleaned_response = re.sub(r'\[(.*?)\]', replacer, response)
-        return cleaned_response  
+        return self.response_pipeline.clean(response)
 
     async def process_callback_message(self, message, update: Update, context: CallbackContext) -> None:
-         self.user_number_sent = True 
+         session = self.sessions.get(update.effective_user.id)
+         session.number_sent = True
+         self.sessions.save(update.effective_user.id, session)
          
-         dialog_str = get_dialog_history(update.effective_user.id, self.telegram_id)
-         dialog_summary = self.get_answer(CHAT_OWNER_DIALOG_SUMMARY_REQUEST + dialog_str)
-         await context.bot.send_message(
-            chat_id=owner_chat_id,
-            text=USER_CALLBACK_REQUEST_TEXT + " " + message + " " + USER_CALLBACK_REQUEST_SUMMARY_TEXT + " " + dialog_summary
+         dialog_str = await self.summaries.dialog(update.effective_user.id)
+         dialog_summary = await self.get_answer(self.config.chat_owner_dialog_summary_request + dialog_str)
+         await self.notify_owner(
+            self.config.user_callback_request_text + " " + message + " " + self.config.user_callback_request_summary_text + " " + dialog_summary
             )
 
+         contact = extract_phone(message)  # cached from the check in process_message
          lead_data = {
             "fields": {
-                "NAME": parse_name(message),
-                "PHONE": [{"VALUE": parse_phone(message), "VALUE_TYPE": "WORK"}],
+                "NAME": contact.name,
+                "PHONE": [{"VALUE": contact.phone, "VALUE_TYPE": "WORK"}],
                 "COMMENTS": dialog_summary 
             },
             "params": {"REGISTER_SONET_EVENT": "Y"}
             }
 
-         result = self.send_message_crm(CRM_WEBHOOK, "crm.lead.add", lead_data)
-    
-         if result:
-            print("Lead added!")
-            print("ID:", result)
-            await context.bot.send_message(
-                chat_id=owner_chat_id,
-                text=message +  " lead added to srm"
+         await self.crm.submit(
+            lead_data,
+            delivered_text=message + " lead added to srm",
+            failed_text=self.config.user_callback_request_text + " " + message + " lead are not added to srm",
             )
-         else:
-            print("error adding lead.")
-            await context.bot.send_message(
-                chat_id=owner_chat_id,
-                text=USER_CALLBACK_REQUEST_TEXT + " " + message + " lead are not added to srm"
-                )
 
     async def error_handler(self, update,  context: ContextTypes.DEFAULT_TYPE):
-
-        logging.error("Error: %s", context.error)
-        """Sends a error message to the user."""
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=ERROR_MESSAGE_TEXT,
+        """Logs the error and sends an error message to the user."""
+        user = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+        logger.error(
+            "Error while handling an update: %s", context.error,
+            exc_info=context.error, extra={"bot": bot_label(self.telegram_id), "user": user},
         )
-        await context.bot.send_message(
-            chat_id=owner_chat_id,
-            text=f"Error: {context.error}"
-        )
-        
-    def send_message_crm(self, webhook_url, method: str, data: dict):
-
-        url = f"{webhook_url}"
-        print(f"Отправляем запрос на URL: {url}")
-        try:
-            response = requests.post(url, json=data)
-            response.raise_for_status()  # exception for 4xx/5xx
-            result = response.json()
-            
-            if "result" in result:
-                return result["result"]
-            else:
-                print(f"Error in response: {result.get('error_description', 'Unknown error')}")
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
-            return None
+        if isinstance(update, Update) and update.effective_chat is not None:
+            await self.sender.send_message(context.bot, update.effective_chat.id, self.config.error_message_text)
+        # Repeated errors are counted in the owner's digest instead of sent one by one
+        await self.notify_owner(f"Error: {context.error}")
@@ -0,0 +1,156 @@
+# history_cache.py
+# Keeps the recent dialog turns of active users in memory
+
+import logging
+from collections import OrderedDict, deque
+from .config import HISTORY_CACHE_TURNS, HISTORY_CACHE_USERS, HISTORY_CACHE_BYTES
+from .dialog_store import DialogStore
+from .metrics import get_metrics, bot_label
+
+logger = logging.getLogger(__name__)
+
+# Rough per-turn overhead of the dict and deque slot, in bytes
+TURN_OVERHEAD = 200
+# Seconds a lookup the cache cannot serve waits for the user's queued turns to be written
+UNWRITTEN_WAIT = 1.0
+
+
+def turn_size(turn: dict) -> int:
+    """Approximate memory footprint of a cached turn."""
+    return TURN_OVERHEAD + len(turn.get("question") or "") + len(turn.get("answer") or "")
+
+
+class CachedDialog:
+    __slots__ = ("turns", "complete", "size")
+
+    def __init__(self, turns, max_turns: int, complete: bool):
+        self.turns = deque(turns, maxlen=max_turns)
+        # True when the deque holds the user's whole history, not just its tail
+        self.complete = complete
+        self.size = sum(turn_size(turn) for turn in self.turns)
+
+
+class DialogHistoryCache:
+    """
+    Bounded LRU cache of recent turns per (bot, user), writing through to a DialogStore.
+    Memory is capped both by the number of users and by an approximate byte budget.
+    With a store that writes behind, a dialog stays cached until its turns are written,
+    so that reads never miss a turn that is still queued.
+    """
+
+    def __init__(
+        self,
+        store: DialogStore,
+        max_turns: int = HISTORY_CACHE_TURNS,
+        max_users: int = HISTORY_CACHE_USERS,
+        max_bytes: int = HISTORY_CACHE_BYTES,
+    ):
+        self.store = store
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._dialogs = OrderedDict()
+        self._unwritten = {}  # key -> number of the last turn queued for the store
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def append(self, bot: str, telegram_id: int, username, question: str, answer: str):
+        """Persist a turn and add it to the user's cached dialog, if any."""
+        key = (bot, telegram_id)
+        if self.store.deferred and key not in self._dialogs:
+            # The store may not show the turn for a moment, so the dialog is loaded before it is queued;
+            # nothing of an uncached dialog is waiting to be written, so this never waits
+            self._load(key, self.max_turns)
+        seq = self.store.append(bot, telegram_id, username, question, answer)
+
+        dialog = self._dialogs.get(key)
+        if dialog is None:
+            # Not cached: the next read loads the history including this turn
+            return
+        if self.store.deferred:
+            self._unwritten[key] = seq
+        turn = {"telegram_id": telegram_id, "username": username, "question": question, "answer": answer}
+        if len(dialog.turns) == dialog.turns.maxlen:
+            dialog.complete = False
+            dropped = turn_size(dialog.turns[0])
+            dialog.size -= dropped
+            self._bytes -= dropped
+        dialog.turns.append(turn)
+        dialog.size += turn_size(turn)
+        self._bytes += turn_size(turn)
+        self._dialogs.move_to_end(key)
+        self._evict()
+
+    async def history(self, bot: str, telegram_id: int, limit: int = None) -> list:
+        """Return the user's turns in chronological order, optionally only the last `limit`."""
+        key = (bot, telegram_id)
+        dialog = self._dialogs.get(key)
+        if dialog is not None and (dialog.complete or (limit is not None and limit <= len(dialog.turns))):
+            self.hits += 1
+            get_metrics().inc("cache_lookups_total", cache="history", bot=bot_label(bot), result="hit")
+            self._dialogs.move_to_end(key)
+            turns = list(dialog.turns)
+            return turns if limit is None else turns[-limit:]
+
+        self.misses += 1
+        get_metrics().inc("cache_lookups_total", cache="history", bot=bot_label(bot), result="miss")
+        # Turns appended while waiting are waited for as well
+        seq = self._unwritten.pop(key, None)
+        while seq is not None:
+            if not await self.store.wait_persisted(seq, timeout=UNWRITTEN_WAIT):
+                logger.warning("Reading a dialog whose last turns are not written yet")
+                break
+            seq = self._unwritten.pop(key, None)
+        return self._load(key, limit)
+
+    def _load(self, key, limit: int = None) -> list:
+        """Read a dialog from the store into the cache and return its last `limit` turns."""
+        bot, telegram_id = key
+        if limit is None or limit > self.max_turns:
+            turns = self.store.history(bot, telegram_id, limit)
+            complete = limit is None or len(turns) < limit
+        else:
+            turns = self.store.history(bot, telegram_id, self.max_turns)
+            complete = len(turns) < self.max_turns
+        self._put(key, CachedDialog(turns[-self.max_turns:], self.max_turns, complete and len(turns) <= self.max_turns))
+        return turns if limit is None else turns[-limit:]
+
+    def invalidate(self, bot: str, telegram_id: int):
+        """Drop a user's cached dialog, e.g. after their stored history was rewritten."""
+        dialog = self._dialogs.pop((bot, telegram_id), None)
+        self._unwritten.pop((bot, telegram_id), None)
+        if dialog is not None:
+            self._bytes -= dialog.size
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters and the current occupancy."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "users": len(self._dialogs),
+            "bytes": self._bytes,
+        }
+
+    def _put(self, key, dialog: CachedDialog):
+        self.invalidate(*key)
+        self._dialogs[key] = dialog
+        self._bytes += dialog.size
+        self._evict()
+
+    def _evict(self):
+        kept = []
+        while self._dialogs and (len(self._dialogs) > self.max_users or self._bytes > self.max_bytes):
+            key, dialog = self._dialogs.popitem(last=False)
+            seq = self._unwritten.pop(key, None)
+            if seq is not None and not self.store.persisted(seq):
+                # Still queued: evicting it now would let a read miss its last turns
+                kept.append((key, dialog, seq))
+                continue
+            self._bytes -= dialog.size
+        for key, dialog, seq in reversed(kept):
+            self._dialogs[key] = dialog
+            self._dialogs.move_to_end(key, last=False)
+            self._unwritten[key] = seq
@@ -0,0 +1,216 @@
+# logs.py
+# Structured logging: records are queued on the event loop and written as JSON by a background thread
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import time
+from contextlib import contextmanager
+from .botconfig import get_bot_config_source
+from .config import (
+    client_api_keys,
+    CRM_WEBHOOK,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_SAMPLING,
+)
+
+# Logger of the package; modules log through its children, logging.getLogger(__name__)
+PACKAGE = __name__.rsplit(".", 1)[0]
+
+TEXT_FORMAT = "%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s"
+
+_traceback_formatter = logging.Formatter()
+
+# Bot tokens (also in their sanitized form with "_") and OpenAI keys, wherever they appear
+_SECRET_PATTERNS = (
+    (re.compile(r"(?<!\d)(\d{5,})[:_][A-Za-z0-9_-]{30,}"), r"\1:***"),
+    (re.compile(r"\bsk-[A-Za-z0-9_-]{8,}"), "sk-***"),
+)
+
+# Context of the update being handled, picked up by every record logged while handling it
+_bot = contextvars.ContextVar("log_bot", default=None)
+_user = contextvars.ContextVar("log_user", default=None)
+
+# Attributes every record has; any other attribute came in through `extra` and is logged as a field
+_STANDARD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+@contextmanager
+def log_context(bot: str = None, user: int = None):
+    """Tag the records logged inside the block (and in tasks started from it) with a bot and a user."""
+    tokens = [(var, var.set(value)) for var, value in ((_bot, bot), (_user, user)) if value is not None]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def redact(text: str, secrets=()) -> str:
+    """Mask configured secrets and anything shaped like a bot token or an API key."""
+    for secret in secrets:
+        text = text.replace(secret, "***")
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class ContextFilter(logging.Filter):
+    """Adds the bot and user of the current context to records that don't name them."""
+
+    def filter(self, record):
+        if getattr(record, "bot", None) is None:
+            record.bot = _bot.get()
+        if getattr(record, "user", None) is None:
+            record.user = _user.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of high-volume events, those logged with
+    extra={"event": name} for a name in `rates`: every 1/rate-th record passes
+    and carries `sample_rate` so that counts can be scaled back. Warnings and
+    errors always pass.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._seen = {}
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        if rate <= 0:
+            return False
+        seen = self._seen[record.event] = self._seen.get(record.event, 0) + 1
+        if (seen - 1) % round(1 / rate):
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class LoopQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for the listener thread, or a supervisor's, with as little work as possible
+    on the event loop: the message is merged with its arguments and a traceback turned into
+    text, the rest of the formatting happens in the listener.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with secrets redacted."""
+
+    converter = time.gmtime
+
+    def __init__(self, secrets=()):
+        super().__init__()
+        self.secrets = secrets
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field, value in vars(record).items():
+            if field not in _STANDARD_FIELDS and value is not None:
+                entry[field] = value
+        if record.processName != "MainProcess":
+            entry["process"] = record.processName
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return redact(json.dumps(entry, ensure_ascii=False, default=str), self.secrets)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format with the bot and user appended, secrets redacted."""
+
+    def __init__(self, secrets=()):
+        super().__init__(TEXT_FORMAT)
+        self.secrets = secrets
+
+    def format(self, record):
+        text = super().format(record)
+        context = " ".join(
+            f"{field}={getattr(record, field)}" for field in ("bot", "user") if getattr(record, field, None) is not None
+        )
+        return redact(f"{text} [{context}]" if context else text, self.secrets)
+
+
+def configured_secrets() -> tuple:
+    """Secret values from the configuration, longest first so that none is left half masked."""
+    secrets = [*(config.token for config in get_bot_config_source().configs()), *client_api_keys, CRM_WEBHOOK or ""]
+    return tuple(sorted({secret for secret in secrets if len(secret) >= 8}, key=len, reverse=True))
+
+
+def output_handler(fmt: str = LOG_FORMAT, stream=None) -> logging.Handler:
+    """The handler that writes the records, in the listener thread."""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    formatter_class = TextFormatter if fmt == "text" else JsonFormatter
+    handler.setFormatter(formatter_class(configured_secrets()))
+    return handler
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, sampling: dict = LOG_SAMPLING, handler: logging.Handler = None):
+    """
+    Route all logging through a queue: loggers only enqueue records and a listener
+    thread formats and writes them with `handler` (JSON to stderr by default), which is returned.
+    The package logs at `level`, other libraries (httpx, telegram) at WARNING and above.
+    """
+    global _listener
+    stop_logging()
+    log_queue = queue.SimpleQueue()
+    queue_handler = LoopQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter(sampling))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.WARNING)
+    logging.getLogger(PACKAGE).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler or output_handler(fmt))
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener.handlers[0]
+
+
+def setup_worker_logging(log_queue, level: str = LOG_LEVEL, sampling: dict = LOG_SAMPLING):
+    """In a supervisor worker: send the records to the supervisor, which writes them."""
+    queue_handler = LoopQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter(sampling))
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.WARNING)
+    logging.getLogger(PACKAGE).setLevel(level)
+
+
+def stop_logging():
+    """Write the queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,281 @@
+# maintenance.py
+# Offline upkeep of the dialog store: legacy imports, retention, compaction into archive segments and exports
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Iterator
+from .config import DB_PATH
+from .dialog_store import SQLiteDialogStore
+from .migrate import default_shared_bot, legacy_files, migrate_file
+
+# Columns of an exported or archived dialog entry
+FIELDS = ("id", "bot", "telegram_id", "username", "question", "answer", "created_at")
+
+# Entries per archive segment, and entries deleted per transaction
+SEGMENT_ROWS = 100000
+DELETE_BATCH = 10000
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+
+
+def connect(db_path=DB_PATH) -> sqlite3.Connection:
+    """A connection that can work next to running bots: WAL, and waiting for their writes instead of failing."""
+    SQLiteDialogStore(db_path).close()  # Creates the tables of a new database
+    conn = sqlite3.connect(str(db_path))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def select_entries(conn: sqlite3.Connection, older_than: float = None, keep_turns: int = None, bot: str = None) -> int:
+    """
+    Mark the entries created before `older_than` (a timestamp) or beyond the last `keep_turns`
+    of their user, optionally of one bot, in the temporary table `selected`; returns how many.
+    The marking happens inside SQLite, so memory use does not grow with the store.
+    """
+    conditions, params = [], []
+    if older_than is not None:
+        conditions.append("created_at < ?")
+        params.append(older_than)
+    if keep_turns is not None:
+        conditions.append(
+            "id IN (SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY bot, telegram_id ORDER BY id DESC) AS turn"
+            " FROM dialogs) WHERE turn > ?)"
+        )
+        params.append(keep_turns)
+    if not conditions:
+        raise ValueError("nothing to select: give an age or a number of turns")
+    where = "(" + " OR ".join(conditions) + ")"
+    if bot is not None:
+        where += " AND bot = ?"
+        params.append(bot)
+
+    conn.execute("DROP TABLE IF EXISTS temp.selected")
+    conn.execute("CREATE TEMP TABLE selected (id INTEGER PRIMARY KEY, bot TEXT, telegram_id INTEGER)")
+    cursor = conn.execute(f"INSERT INTO temp.selected SELECT id, bot, telegram_id FROM dialogs WHERE {where}", params)
+    conn.commit()
+    return cursor.rowcount
+
+
+def archive_entries(conn: sqlite3.Connection, archive: Path, segment_rows: int = SEGMENT_ROWS) -> int:
+    """
+    Append the selected entries to gzipped JSON lines segments below `archive`, one directory
+    per bot and at most `segment_rows` entries per segment, named after their first and last id.
+    A segment appears under its final name only once it is complete.
+    """
+    writers = {}  # bot -> SegmentWriter
+    count = 0
+    rows = conn.execute(
+        "SELECT d.id, d.bot, d.telegram_id, d.username, d.question, d.answer, d.created_at"
+        " FROM dialogs d JOIN temp.selected s ON s.id = d.id ORDER BY d.id"
+    )
+    try:
+        for row in rows:
+            writer = writers.get(row[1])
+            if writer is None:
+                writer = writers[row[1]] = SegmentWriter(archive / row[1])
+            writer.write(dict(zip(FIELDS, row)))
+            count += 1
+            if writer.rows >= segment_rows:
+                writers.pop(row[1]).close()
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return count
+
+
+def forget_entries(conn: sqlite3.Connection, batch: int = DELETE_BATCH) -> int:
+    """
+    Delete the selected entries, a batch per transaction so that running bots are not held up.
+    Dialog summaries count the turns they cover, so those counts are lowered by the turns deleted.
+    """
+    summaries = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dialog_summaries'").fetchone()
+    if summaries:
+        conn.execute(
+            """UPDATE dialog_summaries SET turns_covered = MAX(0, turns_covered - (
+                   SELECT COUNT(*) FROM temp.selected s WHERE s.bot = dialog_summaries.bot AND s.telegram_id = dialog_summaries.user_id
+               )) WHERE EXISTS (
+                   SELECT 1 FROM temp.selected s WHERE s.bot = dialog_summaries.bot AND s.telegram_id = dialog_summaries.user_id
+               )"""
+        )
+        conn.commit()
+
+    deleted = 0
+    last_id = -1
+    while True:
+        ids = conn.execute("SELECT id FROM temp.selected WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch)).fetchall()
+        if not ids:
+            break
+        last_id = ids[-1][0]
+        deleted += conn.execute(
+            "DELETE FROM dialogs WHERE id IN (SELECT id FROM temp.selected WHERE id BETWEEN ? AND ?)", (ids[0][0], last_id)
+        ).rowcount
+        conn.commit()
+    conn.execute("DROP TABLE temp.selected")
+    return deleted
+
+
+class SegmentWriter:
+    """Writes one archive segment, under a temporary name until it is closed."""
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.rows = 0
+        self.first_id = None
+        self.last_id = None
+        self._path = directory / f".segment-{os.getpid()}-{time.time_ns()}.tmp"
+        self._file = gzip.open(self._path, "wt", encoding="utf-8")
+
+    def write(self, entry: dict):
+        if self.first_id is None:
+            self.first_id = entry["id"]
+        self.last_id = entry["id"]
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.rows += 1
+
+    def close(self):
+        self._file.close()
+        if self.rows:
+            os.replace(self._path, self.directory / f"{self.first_id}-{self.last_id}{SEGMENT_SUFFIX}")
+        else:
+            self._path.unlink()
+
+
+def segments(archive: Path, bot: str = None) -> list:
+    """The archive segments, of one bot or of all, oldest first."""
+    directories = [archive / bot] if bot else sorted(path for path in archive.iterdir() if path.is_dir())
+    found = []
+    for directory in directories:
+        if directory.is_dir():
+            found += sorted(directory.glob(f"*{SEGMENT_SUFFIX}"), key=lambda path: int(path.name.split("-", 1)[0]))
+    return found
+
+
+def iter_entries(conn: sqlite3.Connection, bot: str = None, since: float = None, archive: Path = None) -> Iterator[dict]:
+    """
+    Yield the dialog entries as dicts, the archived ones first when an `archive` is given.
+    Both are read as streams, so memory use stays the same however many entries there are.
+    """
+    if archive is not None and archive.is_dir():
+        for segment in segments(archive, bot):
+            with gzip.open(segment, "rt", encoding="utf-8") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    if since is None or entry["created_at"] >= since:
+                        yield entry
+
+    conditions, params = [], []
+    if bot is not None:
+        conditions.append("bot = ?")
+        params.append(bot)
+    if since is not None:
+        conditions.append("created_at >= ?")
+        params.append(since)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    for row in conn.execute(f"SELECT {', '.join(FIELDS)} FROM dialogs{where} ORDER BY id", params):
+        yield dict(zip(FIELDS, row))
+
+
+def export_entries(entries: Iterator[dict], out, fmt: str = "jsonl") -> int:
+    """Write entries to `out` as JSON lines or CSV and return how many were written."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        writer.writeheader()
+        for entry in entries:
+            writer.writerow(entry)
+            count += 1
+    else:
+        for entry in entries:
+            out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def _days_ago(days: float) -> float:
+    return time.time() - days * 24 * 3600
+
+
+def _prune(conn: sqlite3.Connection, args, older_than: float = None, keep_turns: int = None, archive: Path = None):
+    selected = select_entries(conn, older_than=older_than, keep_turns=keep_turns, bot=args.bot)
+    if archive is not None:
+        print(f"Archived {archive_entries(conn, archive)} entries to {archive}")
+    print(f"Deleted {forget_entries(conn)} of {selected} selected entries")
+    if args.vacuum:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        print("Database vacuumed")
+
+
+def main():
+    """Command line entry point of the maintenance tool."""
+    parser = argparse.ArgumentParser(description="Maintain the dialog store: import, retention, compaction and export.")
+    parser.add_argument("--db", default=DB_PATH, help="path of the SQLite database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="import legacy Q&A JSON files (both the per-bot and the shared format)")
+    command.add_argument("files", nargs="*", type=Path, help="files to import (default: the legacy files in the current directory)")
+    command.add_argument("--bot", default=default_shared_bot(), help="bot of the shared questions_answers.json")
+
+    command = commands.add_parser("retain", help="delete entries beyond a number of turns per user or older than an age")
+    command.add_argument("--keep-turns", type=int, help="entries kept per user")
+    command.add_argument("--max-age", type=float, help="days an entry is kept")
+    command.add_argument("--archive", type=Path, help="archive the deleted entries in this directory first")
+
+    command = commands.add_parser("compact", help="move entries older than an age out of the database into archive segments")
+    command.add_argument("--older-than", type=float, required=True, help="age in days")
+    command.add_argument("--archive", type=Path, required=True, help="directory of the segments")
+
+    command = commands.add_parser("export", help="write the entries as JSON lines or CSV")
+    command.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    command.add_argument("--since", type=float, help="only entries of the last N days")
+    command.add_argument("--archive", type=Path, help="also export the entries archived in this directory")
+    command.add_argument("-o", "--output", help="output file (default: standard output)")
+
+    for name in ("retain", "compact", "export"):
+        commands.choices[name].add_argument("--bot", help="only this bot (its sanitized token, as stored)")
+    for name in ("retain", "compact"):
+        commands.choices[name].add_argument("--vacuum", action="store_true", help="give the freed space back to the file system")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = SQLiteDialogStore(args.db)
+        try:
+            total = sum(migrate_file(store, qa_file, args.bot) for qa_file in args.files or legacy_files())
+        finally:
+            store.close()
+        print(f"Imported {total} entries")
+        return
+
+    conn = connect(args.db)
+    try:
+        if args.command == "retain":
+            if args.keep_turns is None and args.max_age is None:
+                parser.error("retain needs --keep-turns or --max-age")
+            older_than = _days_ago(args.max_age) if args.max_age is not None else None
+            _prune(conn, args, older_than=older_than, keep_turns=args.keep_turns, archive=args.archive)
+        elif args.command == "compact":
+            _prune(conn, args, older_than=_days_ago(args.older_than), archive=args.archive)
+        elif args.command == "export":
+            since = _days_ago(args.since) if args.since is not None else None
+            out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+            try:
+                count = export_entries(iter_entries(conn, args.bot, since, args.archive), out, args.format)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            print(f"Exported {count} entries", file=sys.stderr)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
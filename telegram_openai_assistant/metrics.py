@@ -0,0 +1,291 @@
+# metrics.py
+# Process-wide timings, counters and gauges, served in the Prometheus text format
+
+import logging
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable
+from .config import METRICS_LISTEN, METRICS_PORT, PROFILER_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "assistant_phase_seconds": "Duration of the phases of assistant runs (create, poll, list, stream)",
+    "assistant_runs_total": "Assistant runs by final status",
+    "assistant_attempts_total": "Assistant requests per backend by outcome",
+    "assistant_retries_total": "Assistant requests started again on another backend, by reason (retry, hedge)",
+    "assistant_backend_waits_total": "Times an assistant request waited for a backend's rate limit",
+    "assistant_backend_up": "0 while the circuit breaker of an assistant backend is open",
+    "storage_seconds": "Duration of database reads and writes",
+    "write_stalls_total": "Database writes that waited for room in the full write queue",
+    "write_errors_total": "Database writes dropped after failing",
+    "crm_request_seconds": "Duration of CRM webhook requests",
+    "crm_requests_total": "CRM webhook requests by outcome",
+    "telegram_request_seconds": "Duration of Bot API requests",
+    "telegram_requests_total": "Bot API requests by outcome",
+    "update_seconds": "Time to handle an update, by handler",
+    "updates_coalesced_total": "Messages answered together with a later message of the same user",
+    "cache_lookups_total": "Cache lookups by result",
+    "queue_depth": "Items waiting in a queue",
+    "bot_up": "1 while a bot is started and passed its last health check",
+    "cache_entries": "Entries held by a cache",
+}
+
+
+def bot_label(telegram_id: str) -> str:
+    """The public bot id of a token (or of its sanitized form), never the secret part."""
+    return re.split(r"[:_]", str(telegram_id), 1)[0]
+
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters and histograms keyed by name and labels, updated in place, plus gauges
+    whose values are read from callbacks when the metrics are rendered. Background
+    threads (e.g. the database writer) update them too, so updates and reads take a lock.
+    """
+
+    def __init__(self):
+        self._counters = {}    # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: Histogram}
+        self._gauges = {}      # name -> {labels: callback}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._counters.setdefault(name, {})
+            family[key] = family.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._histograms.setdefault(name, {})
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the time spent in the block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator observing the duration of every call of a coroutine function."""
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def gauge(self, name: str, callback: Callable[[], float], **labels):
+        """Report `callback()` as the value of a gauge until `remove_gauge` is called."""
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = callback
+
+    def remove_gauge(self, name: str, **labels):
+        with self._lock:
+            self._gauges.get(name, {}).pop(tuple(sorted(labels.items())), None)
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter, e.g. for the supervisor heartbeat."""
+        with self._lock:
+            return self._counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> str:
+        # A consistent copy; the gauges are read after the lock is released, as they may take locks of their own
+        with self._lock:
+            counters = {name: list(family.items()) for name, family in self._counters.items()}
+            histograms = {
+                name: [(labels, list(histogram.counts), histogram.sum, histogram.count) for labels, histogram in family.items()]
+                for name, family in self._histograms.items()
+            }
+            gauges = {name: list(family.items()) for name, family in self._gauges.items()}
+
+        lines = []
+        for name, family in sorted(counters.items()):
+            lines += self._header(name, "counter")
+            lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in family]
+        for name, family in sorted(histograms.items()):
+            lines += self._header(name, "histogram")
+            for labels, counts, total, count in family:
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    bucket = 'le="%s"' % bound
+                    lines.append(f"{name}_bucket{_format_labels(labels, bucket)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for name, family in sorted(gauges.items()):
+            if not family:
+                continue
+            lines += self._header(name, "gauge")
+            for labels, callback in family:
+                try:
+                    lines.append(f"{name}{_format_labels(labels)} {float(callback())}")
+                except Exception:
+                    logger.exception("Failed to read gauge %s", name)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _header(name: str, kind: str) -> list:
+        help_text = HELP.get(name)
+        return ([f"# HELP {name} {help_text}"] if help_text else []) + [f"# TYPE {name} {kind}"]
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop's) from a background thread every
+    `interval` seconds and counts the stacks, in the collapsed format flame graph tools read.
+    Can be started and stopped at any time; sampling costs nothing while stopped.
+    """
+
+    def __init__(self, interval: float = PROFILER_INTERVAL):
+        self.interval = interval
+        self.samples = {}
+        self._target = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float = None, thread_id: int = None):
+        if self.running:
+            return
+        self.interval = interval or self.interval
+        self._target = thread_id or threading.get_ident()
+        self.samples = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """Stop sampling and return the report."""
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.report()
+
+    def report(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.samples.items(), key=lambda item: -item[1])) + "\n"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+
+class MetricsServer:
+    """
+    Local HTTP server with GET /metrics, and the profiler switches
+    POST /profiler/start (optional ?interval=seconds) and POST /profiler/stop, which returns the samples.
+    """
+
+    def __init__(self, metrics: "Metrics", profiler: SamplingProfiler, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.metrics = metrics
+        self.profiler = profiler
+        self.listen = listen
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        # aiohttp is only needed when the metrics are served
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.router.add_post("/profiler/{action}", self.handle_profiler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info("Metrics served on http://%s:%s/metrics", self.listen, self.port)
+
+    async def stop(self):
+        self.profiler.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(text=self.metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_profiler(self, request):
+        from aiohttp import web
+
+        action = request.match_info["action"]
+        if action == "start":
+            try:
+                interval = float(request.query.get("interval", 0)) or None
+            except ValueError:
+                return web.Response(status=400)
+            self.profiler.start(interval)
+            return web.Response(text=f"profiling every {self.profiler.interval} s\n")
+        if action == "stop":
+            return web.Response(text=self.profiler.stop())
+        return web.Response(status=404)
+
+
+_metrics = None
+_profiler = None
+
+
+def get_metrics() -> Metrics:
+    """Return the process-wide metrics shared by all bots."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def get_profiler() -> SamplingProfiler:
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler()
+    return _profiler
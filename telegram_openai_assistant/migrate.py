@@ -0,0 +1,118 @@
+# migrate.py
+# Imports the legacy Q&A JSON files into the dialog store
+
+import argparse
+import json
+from pathlib import Path
+from typing import Iterator
+from .config import DB_PATH, telegram_token_bots
+from .dialog_store import SQLiteDialogStore
+from .utils import sanitize_filename
+
+LEGACY_SUFFIX = "_questions_answers.json"
+# File of the oldest versions, shared by all bots and without a bot name
+LEGACY_SHARED_FILE = "questions_answers.json"
+
+# Characters read from a legacy file at a time
+READ_CHUNK = 1 << 16
+
+
+def iter_json_array(file, chunk_size: int = READ_CHUNK) -> Iterator:
+    """Yield the items of the JSON array in `file` one by one, never holding more than one item in memory."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace, the opening bracket and the commas between items
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == "," or (buffer[pos] == "[" and not started)):
+            started = started or buffer[pos] == "["
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                if end < len(buffer) or eof:
+                    yield item
+                    pos = end
+                    continue
+        elif eof:
+            if started:
+                raise ValueError("unterminated JSON array")
+            return
+        # The item is cut off at the end of the buffer: read on
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def legacy_bot(qa_file: Path, shared_bot: str = None) -> str:
+    """The bot a legacy file belongs to: from its name, or `shared_bot` for the shared file."""
+    if qa_file.name.endswith(LEGACY_SUFFIX):
+        return qa_file.name[: -len(LEGACY_SUFFIX)]
+    if shared_bot:
+        return shared_bot
+    raise ValueError(f"{qa_file} does not name its bot; pass --bot")
+
+
+def default_shared_bot() -> str:
+    """The bot of the shared file: the first configured one, as the old single-bot versions ran it."""
+    return sanitize_filename(telegram_token_bots[0]) if telegram_token_bots else None
+
+
+def migrate_file(store: SQLiteDialogStore, qa_file: Path, shared_bot: str = None) -> int:
+    """
+    Import one legacy Q&A file and return the number of entries imported.
+    Legacy entries carry no timestamp, so they are dated with the file's modification time.
+    The file is read as a stream, so its size does not matter.
+    """
+    source = str(qa_file.resolve())
+    if store.is_imported(source):
+        print(f"Skipping {qa_file}: already imported")
+        return 0
+
+    bot = legacy_bot(qa_file, shared_bot)
+    with open(qa_file, "r", encoding="utf-8") as file:
+        count = store.import_entries(bot, iter_json_array(file), created_at=qa_file.stat().st_mtime, source=source)
+    print(f"Imported {count} entries for bot '{bot}' from {qa_file}")
+    return count
+
+
+def legacy_files(directory: Path = Path(".")) -> list:
+    """The legacy files of a directory, the shared file first since it is the oldest."""
+    shared = directory / LEGACY_SHARED_FILE
+    return ([shared] if shared.is_file() else []) + sorted(directory.glob(f"*{LEGACY_SUFFIX}"))
+
+
+def main():
+    """Command line entry point of the migration tool."""
+    parser = argparse.ArgumentParser(description="Import legacy Q&A JSON files into the dialog store.")
+    parser.add_argument(
+        "files", nargs="*", type=Path,
+        help=f"legacy files to import (default: {LEGACY_SHARED_FILE} and *{LEGACY_SUFFIX} in the current directory)",
+    )
+    parser.add_argument("--db", default=DB_PATH, help="path of the SQLite database")
+    parser.add_argument(
+        "--bot", default=default_shared_bot(),
+        help=f"bot the entries of {LEGACY_SHARED_FILE} belong to (default: the first configured bot)",
+    )
+    args = parser.parse_args()
+
+    files = args.files or legacy_files()
+    store = SQLiteDialogStore(args.db)
+    try:
+        total = sum(migrate_file(store, qa_file, args.bot) for qa_file in files)
+    finally:
+        store.close()
+    print(f"Migration finished: {total} entries from {len(files)} file(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,82 +1,109 @@
+import re
+from functools import lru_cache
+from typing import Iterable, List
 import phonenumbers
 
 LOCALE = "RU"
 
-def parse_phone(text: str):
+# Shortest phone number worth handing to libphonenumbers, in digits
+MIN_PHONE_DIGITS = 7
+# Extractions of this many distinct texts are kept
+CACHE_SIZE = 1024
+
+# MIN_PHONE_DIGITS digits, each followed by at most a few separators like " ", "-", ")" or "."
+_DIGIT_RUN = re.compile(r"(?:\d\D{0,3}){%d}" % MIN_PHONE_DIGITS)
+
+
+class PhoneExtraction:
     """
-    Searches the text for the first valid phone number (according to libphonenumbers).
-    If found, returns the number in E164 format (e.g., +79991234567).
-    If no phone number is found, returns False.
+    Result of searching a text for a phone number: the number in E164 format
+    (e.g., +79991234567), the remaining text (interpreted as "name part") and
+    whether a valid number was found at all.
     """
+    __slots__ = ("phone", "name", "valid")
 
-    # Get a PhoneNumberMatcher object
-    possible_numbers = phonenumbers.PhoneNumberMatcher(text, LOCALE)
+    def __init__(self, phone: str = None, name: str = None, valid: bool = False):
+        self.phone = phone
+        self.name = name
+        self.valid = valid
 
-    # Use a for-loop to get the first match
-    match = None
-    for candidate in possible_numbers:
-        match = candidate
-        break
+    def __repr__(self):
+        return f"PhoneExtraction(phone={self.phone!r}, name={self.name!r}, valid={self.valid})"
 
-    if not match:
-        return False
 
-    start, end = match.start, match.end
-    phone_str_raw = match.raw_string
+NO_PHONE = PhoneExtraction()
 
-    phone_obj = phonenumbers.parse(phone_str_raw, LOCALE)
-    if not phonenumbers.is_valid_number(phone_obj):
-        return False
 
-    # Convert to a consistent format (for example, E164 like +79991234567)
-    phone_str_formatted = phonenumbers.format_number(
-        phone_obj, 
-        phonenumbers.PhoneNumberFormat.E164
-    )
-    
-    return phone_str_formatted
+def may_contain_phone(text: str) -> bool:
+    """
+    Cheap check before the full search: a text without MIN_PHONE_DIGITS digits
+    close to each other cannot contain a phone number.
+    """
+    return bool(text) and _DIGIT_RUN.search(text) is not None
 
-def parse_name(text: str):
+
+@lru_cache(maxsize=CACHE_SIZE)
+def extract_phone(text: str) -> PhoneExtraction:
     """
-    Searches the text for the first valid phone number and removes it from the text.
-    Returns the remaining text (interpreted as "name part") or False if no valid number found.
+    Searches the text once for the first phone number (according to libphonenumbers).
+    The result is cached, so asking about the same message again costs nothing.
     """
-    possible_numbers = phonenumbers.PhoneNumberMatcher(text, LOCALE)
+    if not may_contain_phone(text):
+        return NO_PHONE
 
+    # Use a for-loop to get the first match
     match = None
-    for candidate in possible_numbers:
+    for candidate in phonenumbers.PhoneNumberMatcher(text, LOCALE):
         match = candidate
         break
 
-    if not match:
-        return False
+    if not match or not phonenumbers.is_valid_number(match.number):
+        return NO_PHONE
 
-    start, end = match.start, match.end
-    phone_str_raw = match.raw_string
+    # Convert to a consistent format and remove the matched phone substring from the text
+    phone = phonenumbers.format_number(match.number, phonenumbers.PhoneNumberFormat.E164)
+    name = (text[:match.start] + text[match.end:]).strip()
+    return PhoneExtraction(phone, name, True)
 
-    phone_obj = phonenumbers.parse(phone_str_raw, LOCALE)
-    if not phonenumbers.is_valid_number(phone_obj):
-        return False
 
-    # Remove the matched phone substring from the text
-    name_part = (text[:start] + text[end:]).strip()
-    return name_part
+def extract_phones(texts: Iterable[str]) -> List[PhoneExtraction]:
+    """
+    Extracts the phone numbers of many texts, e.g. when re-processing stored dialogs.
+    Texts without digits are skipped cheaply and repeated texts are searched only once.
+    """
+    results = {}
+    extracted = []
+    for text in texts:
+        result = results.get(text)
+        if result is None:
+            result = results[text] = _extract_uncached(text)
+        extracted.append(result)
+    return extracted
 
-def is_phone_number_exists(text: str):
+
+# Bulk extraction bypasses the cache so that it does not evict the live messages
+_extract_uncached = extract_phone.__wrapped__
+
+
+def parse_phone(text: str):
     """
-    Returns True if there's at least one valid phone number in the text, otherwise False.
+    Returns the first valid phone number of the text in E164 format,
+    or False if no phone number is found.
     """
-    possible_numbers = phonenumbers.PhoneNumberMatcher(text, LOCALE)
+    return extract_phone(text).phone or False
 
-    match = None
-    for candidate in possible_numbers:
-        match = candidate
-        break
 
-    if not match:
-        return False
+def parse_name(text: str):
+    """
+    Returns the text without its first valid phone number (interpreted as "name part"),
+    or False if no valid number found.
+    """
+    result = extract_phone(text)
+    return result.name if result.valid else False
 
-    phone_str_raw = match.raw_string
-    phone_obj = phonenumbers.parse(phone_str_raw, LOCALE)
 
-    return phonenumbers.is_valid_number(phone_obj)  
+def is_phone_number_exists(text: str):
+    """
+    Returns True if there's at least one valid phone number in the text, otherwise False.
+    """
+    return extract_phone(text).valid
@@ -0,0 +1,209 @@
+# postprocess.py
+# Turns raw assistant answers into Telegram messages in one pass over the text
+
+import re
+from typing import List, Sequence
+from telegram import MessageEntity
+from telegram.constants import MessageLimit
+from .config import RESPONSE_FILTERS
+
+# Filters a pipeline can be built from
+FILTERS = ("markdown", "citations", "split")
+
+# (filter, rule name, pattern); code comes first so that nothing inside it is touched,
+# and markdown links before the bracket rule that would otherwise drop their text
+_RULES = (
+    ("markdown", "pre", r"```(?:[\w+-]*\n)?(?P<pre>(?s:.+?))```"),
+    ("markdown", "code", r"`(?P<code>[^`\n]+)`"),
+    ("markdown", "text_link", r"\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>https?://[^)\s]+)\)"),
+    ("citations", "source", r"【[^】\n]*】"),
+    ("citations", "bracket", r"\[(?P<bracket>[^\]\n]*)\]"),
+    ("markdown", "heading", r"(?m:^)#{1,6}[ \t]+(?P<heading>[^\n]+)"),
+    ("markdown", "bold", r"\*\*(?P<bold>[^*\n]+)\*\*"),
+    # A lone identifier between double underscores is a dunder name like __init__, not bold
+    ("markdown", "underscore_bold", r"(?<!\w)__(?!\w+__(?!\w))(?P<underscore_bold>[^_\s](?:[^_\n]*[^_\s])?)__(?!\w)"),
+    ("markdown", "strikethrough", r"~~(?P<strikethrough>[^~\n]+)~~"),
+    ("markdown", "italic", r"(?<![\w*])\*(?P<italic>[^*\s](?:[^*\n]*[^*\s])?)\*(?![\w*])"),
+)
+
+# First character of the text each rule matches
+_STARTS = {
+    "pre": "`", "code": "`", "text_link": "[", "source": "【", "bracket": "[", "heading": "#",
+    "bold": "*", "underscore_bold": "_", "strikethrough": "~", "italic": "*",
+}
+
+_LINK = re.compile(r"https?://", re.IGNORECASE)
+
+# Entity type of each markdown rule; the text it applies to is in the group named after the rule
+_ENTITIES = {
+    "pre": MessageEntity.PRE,
+    "code": MessageEntity.CODE,
+    "text_link": MessageEntity.TEXT_LINK,
+    "heading": MessageEntity.BOLD,
+    "bold": MessageEntity.BOLD,
+    "underscore_bold": MessageEntity.BOLD,
+    "strikethrough": MessageEntity.STRIKETHROUGH,
+    "italic": MessageEntity.ITALIC,
+}
+
+
+class ReplyPart:
+    """
+    One Telegram message of a processed answer. Its formatting is kept as
+    (type, offset, length, url) spans in UTF-16 code units and only turned into
+    MessageEntity objects when the message is sent.
+    """
+    __slots__ = ("text", "spans")
+
+    def __init__(self, text: str, spans: tuple = ()):
+        self.text = text
+        self.spans = spans
+
+    @property
+    def entities(self) -> tuple:
+        return tuple(
+            MessageEntity(type=entity_type, offset=offset, length=length, url=url)
+            for entity_type, offset, length, url in self.spans
+        )
+
+
+class ProcessedResponse:
+    """A processed answer: its full cleaned text and the messages to send it in."""
+    __slots__ = ("text", "parts")
+
+    def __init__(self, text: str, parts: List[ReplyPart]):
+        self.text = text
+        self.parts = parts
+
+
+class ResponsePipeline:
+    """
+    Applies a chain of filters to an answer:
+    - citations: drops file search citations and bracketed text that is not a link
+    - markdown: turns markdown (bold, italic, code, headings, links) into Telegram entities
+    - split: cuts the text into messages of at most `max_length` characters
+    The rules of all enabled filters are compiled into one pattern, so the text is
+    scanned once however many filters there are. Entities do not nest.
+    """
+
+    def __init__(self, filters: Sequence[str] = RESPONSE_FILTERS, max_length: int = MessageLimit.MAX_TEXT_LENGTH):
+        unknown = set(filters) - set(FILTERS)
+        if unknown:
+            raise ValueError(f"Unknown response filters: {', '.join(sorted(unknown))}")
+        self.filters = tuple(filters)
+        self.max_length = max_length
+        rules = [(name, pattern) for filter_name, name, pattern in _RULES if filter_name in self.filters]
+        self._pattern = None
+        if rules:
+            # The lookahead lets the scan skip characters no rule can start with
+            starts = "".join(sorted({_STARTS[name] for name, _ in rules}))
+            alternatives = "|".join(f"(?P<{name}_>{pattern})" for name, pattern in rules)
+            self._pattern = re.compile(f"(?=[{re.escape(starts)}])(?:{alternatives})")
+            # Index of the group around each rule, which is the match's lastindex
+            self._rules = {self._pattern.groupindex[name + "_"]: name for name, _ in rules}
+
+    def clean(self, text: str) -> str:
+        """The cleaned text of an answer, without entities and unsplit."""
+        return self._render(text, entities=None)
+
+    def process(self, text: str) -> ProcessedResponse:
+        """Clean an answer and cut it into the messages to send."""
+        entities = []
+        cleaned = self._render(text, entities)
+        if "split" in self.filters:
+            parts = split_message(cleaned, entities, self.max_length)
+        else:
+            parts = [ReplyPart(cleaned, utf16_spans(cleaned, entities))]
+        return ProcessedResponse(cleaned, parts)
+
+    def _render(self, text: str, entities) -> str:
+        """Apply the rules in one scan; collect (type, offset, length, url) in `entities` if given."""
+        if self._pattern is None:
+            return text
+        rules = self._rules
+        # Length of the output so far and end of the previous match, to place the entities
+        position = [0, 0]
+
+        def replace(match):
+            rule = rules[match.lastindex]
+            if rule == "source":
+                piece = ""
+            elif rule == "bracket":
+                piece = match.group() if _LINK.match(text, match.start() + 1) else ""
+            else:
+                url = None
+                if rule == "text_link":
+                    piece, url = match.group("link_text", "link_url")
+                else:
+                    piece = match.group(rule)
+                if entities is not None:
+                    offset = position[0] + match.start() - position[1]
+                    entities.append((_ENTITIES[rule], offset, len(piece), url))
+            if entities is not None:
+                position[0] += match.start() - position[1] + len(piece)
+                position[1] = match.end()
+            return piece
+
+        return self._pattern.sub(replace, text)
+
+
+def split_message(text: str, entities: list, max_length: int) -> List[ReplyPart]:
+    """Cut text into parts of at most max_length characters, preferably at a line break or space."""
+    parts, start, index = [], 0, 0
+    while start < len(text):
+        end = start + max_length
+        if end < len(text):
+            cut = text.rfind("\n", start + 1, end + 1)
+            if cut == -1:
+                cut = text.rfind(" ", start + 1, end + 1)
+            end = cut if cut != -1 else end
+        else:
+            end = len(text)
+
+        part = text[start:end]
+        part_entities = []
+        # Entities are in text order; one crossing a cut is split between both parts
+        while index < len(entities) and entities[index][1] < end:
+            entity_type, offset, length, url = entities[index]
+            first, last = max(offset, start), min(offset + length, end)
+            if first < last:
+                part_entities.append((entity_type, first - start, last - first, url))
+            if offset + length > end:
+                break
+            index += 1
+        if part.strip():
+            parts.append(ReplyPart(part, utf16_spans(part, part_entities)))
+        start = end
+        while start < len(text) and text[start] in "\n ":
+            start += 1
+    return parts
+
+
+def utf16_spans(text: str, spans: list) -> tuple:
+    """Spans with offsets in characters converted to Telegram's UTF-16 code units."""
+    if not spans or text.isascii() or max(text) <= "\uffff":
+        return tuple(spans)
+
+    # Characters outside the BMP (e.g. emoji) take two UTF-16 code units
+    result, position, units = [], 0, 0
+    for entity_type, offset, length, url in spans:
+        units += utf16_length(text[position:offset])
+        units_length = utf16_length(text[offset:offset + length])
+        result.append((entity_type, units, units_length, url))
+        position, units = offset + length, units + units_length
+    return tuple(result)
+
+
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+_pipeline = None
+
+
+def get_response_pipeline() -> ResponsePipeline:
+    """Return the process-wide pipeline built from RESPONSE_FILTERS."""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = ResponsePipeline()
+    return _pipeline
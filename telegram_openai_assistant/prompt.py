@@ -0,0 +1,136 @@
+# prompt.py
+# Builds assistant prompts from the dialog history within a token budget
+
+import logging
+from collections import OrderedDict
+from .config import (
+    PROMPT_HISTORY_TOKENS,
+    PROMPT_DIGEST_TOKENS,
+    PROMPT_ANSWER_CHARS,
+    PROMPT_DIGEST_CHARS,
+    PROMPT_CACHE_USERS,
+)
+
+DIALOG_PROMPT = (
+    "This in the dialog history. Study the history of answers and questions of this user and all details "
+    "on the product he is interested in. When giving an answer I use all the details of the dialogue history "
+    "in order to form an answer. At the end of the message you will find a question that needs to be answered. "
+)
+DIGEST_PROMPT = "Earlier the user asked about: "
+MESSAGE_PROMPT = " Answer this question on the language given in the question: "
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+
+
+def _get_encoding():
+    """The tokenizer, loaded on first use; False if tiktoken is missing or cannot load it."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            # May download the encoding on first use
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:  # tiktoken is optional, fall back to an estimate
+            logger.info("Counting prompt tokens by estimate, tiktoken is unavailable: %s", e)
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens of a text, estimated at about four UTF-8 bytes per token without tiktoken."""
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def shorten(text: str, max_chars: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= max_chars else text[: max_chars - 1] + "…"
+
+
+def encode_turn(turn: dict, answer_chars: int = PROMPT_ANSWER_CHARS) -> str:
+    """Compact one question/answer pair as two short lines instead of a JSON object."""
+    return f"Q: {shorten(turn.get('question'), answer_chars)}\nA: {shorten(turn.get('answer'), answer_chars)}"
+
+
+class HistoryDigest:
+    __slots__ = ("lines", "last_turn")
+
+    def __init__(self):
+        self.lines = []
+        # (question, answer) of the newest turn folded into the digest
+        self.last_turn = None
+
+
+class PromptBuilder:
+    """
+    Assembles the preamble, the dialog history and the question into one prompt.
+    The newest turns are kept verbatim as long as they fit `history_tokens`; older ones
+    are folded into a one-line-per-question digest capped at `digest_tokens`. Digests are
+    cached per user and extended incrementally with the turns that fell out of the window.
+    """
+
+    def __init__(
+        self,
+        history_tokens: int = PROMPT_HISTORY_TOKENS,
+        digest_tokens: int = PROMPT_DIGEST_TOKENS,
+        max_users: int = PROMPT_CACHE_USERS,
+    ):
+        self.history_tokens = history_tokens
+        self.digest_tokens = digest_tokens
+        self.max_users = max_users
+        self._digests = OrderedDict()
+
+    def build(self, key, question: str, turns: list) -> str:
+        """Build the prompt for `question` given the user's turns in chronological order."""
+        recent, budget = [], self.history_tokens
+        for turn in reversed(turns):
+            encoded = encode_turn(turn)
+            cost = count_tokens(encoded)
+            if cost > budget:
+                break
+            recent.append(encoded)
+            budget -= cost
+        recent.reverse()
+
+        older = turns[: len(turns) - len(recent)]
+        digest = self.digest(key, older) if older else ""
+        history = "\n".join(recent)
+        if digest:
+            history = DIGEST_PROMPT + digest + "\n" + history
+        return DIALOG_PROMPT + history + MESSAGE_PROMPT + question
+
+    def digest(self, key, older: list) -> str:
+        """Return the digest of the `older` turns, folding in only those not digested yet."""
+        digest = self._digests.get(key)
+        start = 0
+        if digest is not None:
+            start = self._find_new_turns(digest, older)
+        if digest is None or start is None:
+            digest, start = HistoryDigest(), 0
+
+        for turn in older[start:]:
+            digest.lines.append(shorten(turn.get("question"), PROMPT_DIGEST_CHARS))
+            digest.last_turn = (turn.get("question"), turn.get("answer"))
+        while len(digest.lines) > 1 and count_tokens("; ".join(digest.lines)) > self.digest_tokens:
+            digest.lines.pop(0)
+
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while len(self._digests) > self.max_users:
+            self._digests.popitem(last=False)
+        return "; ".join(digest.lines)
+
+    @staticmethod
+    def _find_new_turns(digest: HistoryDigest, older: list):
+        """Index of the first turn after the digested ones, or None if the digest is unrelated."""
+        if digest.last_turn is None:
+            return 0
+        for index in range(len(older) - 1, -1, -1):
+            if (older[index].get("question"), older[index].get("answer")) == digest.last_turn:
+                return index + 1
+        return None
@@ -0,0 +1,322 @@
+# quota.py
+# Daily message quotas and per-user rate limiting, counted in memory and flushed in batches
+
+import asyncio
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from .config import (
+    DB_PATH,
+    DAILY_MESSAGE_LIMIT,
+    BOT_DAILY_MESSAGE_LIMIT,
+    USER_DAILY_MESSAGE_LIMIT,
+    USER_RATE_LIMIT,
+    USER_RATE_BURST,
+    QUOTA_FLUSH_EVERY,
+    QUOTA_FLUSH_INTERVAL,
+)
+from .utils import sanitize_filename
+from .writebehind import get_write_behind
+
+logger = logging.getLogger(__name__)
+
+# Counter file of older versions, used to seed today's global count once
+LEGACY_COUNT_FILE = Path("message_count.json")
+
+GLOBAL_SCOPE = ("global", "")
+
+# Number of rate-limit buckets after which idle ones are pruned
+MAX_BUCKETS = 100000
+
+# Pause of the periodic flush of counters flushed on every message, which only rolls the day over
+ROLLOVER_CHECK_INTERVAL = 60
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class QuotaCounter:
+    """
+    Atomic message counters for the global, per-bot and per-user daily limits.
+    Counts live in memory; increments are flushed to SQLite every `flush_every`
+    messages or `flush_interval` seconds, whichever comes first. The interval is kept
+    by a task started with `start`, which also drops the counts of a past day when no
+    messages arrive. A limit of 0 disables it.
+
+    A `shared` counter is one of several processes counting in the same database, which
+    no process can see the in-memory counts of. Its limited scopes are then checked and
+    counted in the database, one transaction per message, so that together the processes
+    never let more messages through than a limit allows; unlimited scopes stay batched.
+    """
+
+    def __init__(
+        self,
+        db_path=DB_PATH,
+        daily_limit: int = DAILY_MESSAGE_LIMIT,
+        bot_daily_limit: int = BOT_DAILY_MESSAGE_LIMIT,
+        user_daily_limit: int = USER_DAILY_MESSAGE_LIMIT,
+        user_rate: float = USER_RATE_LIMIT,
+        user_burst: int = USER_RATE_BURST,
+        flush_every: int = QUOTA_FLUSH_EVERY,
+        flush_interval: float = QUOTA_FLUSH_INTERVAL,
+        shared: bool = False,
+    ):
+        self.daily_limit = daily_limit
+        self.bot_daily_limit = bot_daily_limit
+        self.user_daily_limit = user_daily_limit
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.shared = shared
+
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()  # the connection's transactions, for shared counters
+        self._day = None
+        self._counts = {}    # (scope, key) -> count for the current day
+        self._pending = {}   # (scope, key) -> increments not yet flushed
+        self._buckets = {}   # (bot, user_id) -> TokenBucket
+        self._last_flush = time.monotonic()
+        self._task = None
+        self._writer = get_write_behind(db_path)
+
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS message_counts (
+                day TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, scope, key)
+            )"""
+        )
+        self._conn.commit()
+        self._seed_from_legacy_file()
+
+    def try_acquire(self, telegram_id: str, user_id: int, bot_daily_limit: int = None, user_daily_limit: int = None) -> bool:
+        """
+        Count one message if no limit is exceeded; return False when it must be rejected.
+        A bot can bring its own per-bot and per-user limits instead of the counter's.
+        """
+        bot = sanitize_filename(telegram_id)
+        scopes = (
+            (GLOBAL_SCOPE, self.daily_limit),
+            (("bot", bot), self.bot_daily_limit if bot_daily_limit is None else bot_daily_limit),
+            (("user", f"{bot}:{user_id}"), self.user_daily_limit if user_daily_limit is None else user_daily_limit),
+        )
+        if self.shared:
+            return self._try_acquire_shared(bot, user_id, scopes)
+        with self._lock:
+            self._rollover()
+            for scope, limit in scopes:
+                if limit and self._count(scope) >= limit:
+                    return False
+            if self.user_rate and not self._take_token((bot, user_id)):
+                return False
+            for scope, _ in scopes:
+                self._add(scope, 1)
+            self._maybe_flush()
+        return True
+
+    async def acquire(self, telegram_id: str, user_id: int, bot_daily_limit: int = None, user_daily_limit: int = None) -> bool:
+        """try_acquire for the event loop: a shared counter waits for the database in a thread."""
+        if self.shared:
+            return await asyncio.to_thread(self.try_acquire, telegram_id, user_id, bot_daily_limit, user_daily_limit)
+        return self.try_acquire(telegram_id, user_id, bot_daily_limit, user_daily_limit)
+
+    def release(self, telegram_id: str, user_id: int):
+        """Give back a message counted by try_acquire, e.g. when no answer could be produced."""
+        bot = sanitize_filename(telegram_id)
+        with self._lock:
+            for scope in (GLOBAL_SCOPE, ("bot", bot), ("user", f"{bot}:{user_id}")):
+                if self.shared:
+                    # Counted in the database or pending alike, the next flush gives it back
+                    self._pending[scope] = self._pending.get(scope, 0) - 1
+                elif self._counts.get(scope, 0) > 0:
+                    self._add(scope, -1)
+
+    def count(self, scope: str = "global", key: str = "") -> int:
+        """Return today's count of a scope; a shared counter's includes what the other processes flushed."""
+        with self._lock:
+            self._rollover()
+            if not self.shared:
+                return self._count((scope, key))
+            day, pending = self._day, self._pending.get((scope, key), 0)
+        return self._stored(day, (scope, key)) + pending
+
+    def pending(self, scope: str = "global", key: str = "") -> int:
+        """Return the increments of a scope not yet written to the database."""
+        with self._lock:
+            return self._pending.get((scope, key), 0)
+
+    def flush(self):
+        """Write the pending increments to the database."""
+        with self._lock:
+            self._flush()
+
+    def start(self):
+        """Flush the pending increments every `flush_interval` seconds, even without messages."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_flusher())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+    async def _run_flusher(self):
+        while True:
+            last_flush = self._last_flush
+            if self.flush_interval:
+                await asyncio.sleep(max(last_flush + self.flush_interval - time.monotonic(), 0))
+            else:
+                await asyncio.sleep(ROLLOVER_CHECK_INTERVAL)
+            try:
+                with self._lock:
+                    self._rollover()
+                    # Unless a message flushed them meanwhile, the increments are due now
+                    if self._last_flush == last_flush:
+                        self._flush()
+            except Exception:
+                logger.exception("Failed to flush message counts")
+
+    def _rollover(self):
+        today = str(datetime.date.today())
+        if today != self._day:
+            self._flush()
+            self._day = today
+            self._counts.clear()
+
+    def _count(self, scope) -> int:
+        count = self._counts.get(scope)
+        if count is None:
+            # First use of this scope today: pick up what was already counted
+            count = self._counts[scope] = self._stored(self._day, scope)
+        return count
+
+    def _stored(self, day: str, scope) -> int:
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT count FROM message_counts WHERE day = ? AND scope = ? AND key = ?",
+                (day, *scope),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def _try_acquire_shared(self, bot: str, user_id: int, scopes) -> bool:
+        with self._lock:
+            self._rollover()
+            day = self._day
+            # Once a limit is reached the user is turned away for the rest of the day anyway,
+            # so the token is taken before the limits are known
+            if self.user_rate and not self._take_token((bot, user_id)):
+                return False
+        if not self._claim(day, [(scope, limit) for scope, limit in scopes if limit]):
+            return False
+        with self._lock:
+            for scope, limit in scopes:
+                if not limit:
+                    self._pending[scope] = self._pending.get(scope, 0) + 1
+            self._maybe_flush()
+        return True
+
+    def _claim(self, day: str, limited) -> bool:
+        """Count a message in the database for every limited scope, or for none if one is at its limit."""
+        if not limited:
+            return True
+        with self._db_lock:
+            try:
+                for (scope, key), limit in limited:
+                    cursor = self._conn.execute(
+                        """INSERT INTO message_counts (day, scope, key, count) VALUES (?, ?, ?, 1)
+                           ON CONFLICT (day, scope, key) DO UPDATE SET count = count + 1 WHERE count < ?""",
+                        (day, scope, key, limit),
+                    )
+                    if cursor.rowcount == 0:
+                        self._conn.rollback()
+                        return False
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return True
+
+    def _add(self, scope, delta: int):
+        self._counts[scope] = self._count(scope) + delta
+        self._pending[scope] = self._pending.get(scope, 0) + delta
+
+    def _take_token(self, key) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.user_burst, now)
+        bucket.tokens = min(self.user_burst, bucket.tokens + (now - bucket.updated) * self.user_rate)
+        bucket.updated = now
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        if len(self._buckets) > MAX_BUCKETS:
+            self._prune_buckets(now)
+        return True
+
+    def _prune_buckets(self, now: float):
+        # Buckets that refilled completely carry no state and can be dropped
+        for key in [key for key, bucket in self._buckets.items()
+                    if bucket.tokens + (now - bucket.updated) * self.user_rate >= self.user_burst]:
+            del self._buckets[key]
+
+    def _maybe_flush(self):
+        pending = sum(abs(delta) for delta in self._pending.values())
+        if pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        self._writer.executemany(
+            """INSERT INTO message_counts (day, scope, key, count) VALUES (?, ?, ?, ?)
+               ON CONFLICT (day, scope, key) DO UPDATE SET count = count + excluded.count""",
+            [(self._day, scope, key, delta) for (scope, key), delta in self._pending.items() if delta],
+        )
+        self._pending.clear()
+
+    def _seed_from_legacy_file(self):
+        if not LEGACY_COUNT_FILE.exists():
+            return
+        try:
+            with open(LEGACY_COUNT_FILE) as file:
+                data = json.load(file)
+            self._conn.execute(
+                "INSERT OR IGNORE INTO message_counts (day, scope, key, count) VALUES (?, ?, ?, ?)",
+                (data["date"], *GLOBAL_SCOPE, data["count"]),
+            )
+            self._conn.commit()
+        except Exception as e:
+            logger.warning("Failed to read legacy message count: %s", e)
+
+
+_quota_counter = None
+
+
+def get_quota_counter() -> QuotaCounter:
+    """Return the process-wide quota counter shared by all bots."""
+    global _quota_counter
+    if _quota_counter is None:
+        _quota_counter = QuotaCounter()
+    return _quota_counter
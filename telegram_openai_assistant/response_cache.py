@@ -0,0 +1,195 @@
+# response_cache.py
+# Caches assistant answers to repeated questions, per bot
+
+import math
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+from .config import RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_SIMILARITY
+from .metrics import get_metrics, bot_label
+from .utils import sanitize_filename
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+# Shorter questions ("yes", "how much?") depend on the dialog and are never cached
+MIN_QUESTION_TERMS = 3
+# Near-duplicate candidates are looked up through this many of the query's rarest terms
+CANDIDATE_TERMS = 3
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase a question and strip punctuation and redundant whitespace."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _PUNCTUATION.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+class TfidfIndex:
+    """Inverted index over the cached questions of one bot, for cosine similarity lookups."""
+
+    def __init__(self):
+        self.vectors = {}   # question -> {term: count}
+        self.postings = {}  # term -> set of questions
+
+    def add(self, question: str):
+        counts = {}
+        for term in question.split():
+            counts[term] = counts.get(term, 0) + 1
+        self.vectors[question] = counts
+        for term in counts:
+            self.postings.setdefault(term, set()).add(question)
+
+    def remove(self, question: str):
+        for term in self.vectors.pop(question, ()):
+            keys = self.postings[term]
+            keys.discard(question)
+            if not keys:
+                del self.postings[term]
+
+    def nearest(self, question: str):
+        """Return (cached question, cosine similarity) of the closest match, or (None, 0.0)."""
+        query = {}
+        for term in question.split():
+            query[term] = query.get(term, 0) + 1
+        known = [term for term in query if term in self.postings]
+        if not known:
+            return None, 0.0
+
+        total = len(self.vectors)
+
+        def idf(term):
+            return math.log((total + 1) / (len(self.postings.get(term, ())) + 1)) + 1
+
+        def weigh(counts):
+            weights = {term: count * idf(term) for term, count in counts.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            return weights, norm
+
+        query_weights, query_norm = weigh(query)
+        candidates = set()
+        for term in sorted(known, key=lambda term: len(self.postings[term]))[:CANDIDATE_TERMS]:
+            candidates |= self.postings[term]
+
+        best, best_score = None, 0.0
+        for candidate in candidates:
+            weights, norm = weigh(self.vectors[candidate])
+            dot = sum(weight * weights.get(term, 0.0) for term, weight in query_weights.items())
+            score = dot / (query_norm * norm) if query_norm and norm else 0.0
+            if score > best_score:
+                best, best_score = candidate, score
+        return best, best_score
+
+
+class ResponseCache:
+    """
+    LRU cache of answers keyed by (bot, normalized question), with a TTL.
+    With a `similarity` threshold above 0, a question that has no exact match is
+    answered from the most similar cached question of the same bot if their TF-IDF
+    cosine similarity reaches the threshold.
+    Cached answers must not depend on a user's dialog, so the handlers only cache the answers
+    to users' opening questions; FAQ-style bots benefit most. Disabled unless a TTL is set.
+    """
+
+    def __init__(
+        self,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._entries = OrderedDict()  # (bot, question) -> (answer, expires_at)
+        self._indexes = {}             # bot -> TfidfIndex
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, telegram_id: str, question: str) -> Optional[str]:
+        """Return a cached answer to the question, or None."""
+        if not self.enabled:
+            return None
+        bot = sanitize_filename(telegram_id)
+        normalized = normalize_question(question)
+        if len(normalized.split()) < MIN_QUESTION_TERMS:
+            return None
+        metrics = get_metrics()
+        answer = self._lookup((bot, normalized))
+        if answer is not None:
+            self.hits += 1
+            metrics.inc("cache_lookups_total", cache="response", bot=bot_label(bot), result="hit")
+            return answer
+
+        if self.similarity > 0 and bot in self._indexes:
+            match, score = self._indexes[bot].nearest(normalized)
+            if match is not None and score >= self.similarity:
+                answer = self._lookup((bot, match))
+                if answer is not None:
+                    self.near_hits += 1
+                    metrics.inc("cache_lookups_total", cache="response", bot=bot_label(bot), result="near_hit")
+                    return answer
+        self.misses += 1
+        metrics.inc("cache_lookups_total", cache="response", bot=bot_label(bot), result="miss")
+        return None
+
+    def put(self, telegram_id: str, question: str, answer: str):
+        """Cache the answer to a question."""
+        if not self.enabled:
+            return
+        bot = sanitize_filename(telegram_id)
+        key = (bot, normalize_question(question))
+        if len(key[1].split()) < MIN_QUESTION_TERMS:
+            return
+        if key not in self._entries:
+            self._indexes.setdefault(bot, TfidfIndex()).add(key[1])
+        self._entries[key] = (answer, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._unindex(old_key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _lookup(self, key) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._entries[key]
+            self._unindex(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _unindex(self, key):
+        index = self._indexes.get(key[0])
+        if index is not None:
+            index.remove(key[1])
+            if not index.vectors:
+                del self._indexes[key[0]]
+
+
+_response_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide response cache shared by all bots."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
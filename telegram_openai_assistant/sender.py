@@ -0,0 +1,291 @@
+# sender.py
+# Outbound Telegram messages of all bots, sent within Telegram's rate limits
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter
+from .config import (
+    SEND_CHAT_RATE,
+    SEND_CHAT_BURST,
+    SEND_BOT_RATE,
+    SEND_CONCURRENCY,
+    SEND_DRAIN_TIMEOUT,
+    OWNER_DIGEST_INTERVAL,
+)
+from .metrics import get_metrics, bot_label
+from .postprocess import split_message
+from .quota import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, most urgent first
+REPLY = 0   # answers to a user who is waiting for them
+NOTICE = 1  # other messages to users, e.g. the discount offer
+OWNER = 2   # notifications of the chat owner
+
+# Idle chat lanes are forgotten at most this often (seconds)
+SWEEP_INTERVAL = 60
+
+
+class SendJob:
+    __slots__ = ("priority", "seq", "bot", "method", "kwargs", "future")
+
+    def __init__(self, priority: int, seq: int, bot: Bot, method: str, kwargs: dict, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.bot = bot
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+
+
+class ChatLane:
+    """The pending requests of one chat of one bot, sent one at a time in order."""
+    __slots__ = ("jobs", "bucket", "busy", "not_before")
+
+    def __init__(self, burst: int, now: float):
+        self.jobs = []  # heap of (priority, seq, job)
+        self.bucket = TokenBucket(burst, now)
+        self.busy = False
+        # Set from RetryAfter; nothing is sent to the chat before that time
+        self.not_before = 0.0
+
+
+def refill(bucket: TokenBucket, rate: float, burst: float, now: float) -> float:
+    """Refill a bucket and return the seconds until it holds a token; a rate of 0 means no limit."""
+    if rate <= 0:
+        return 0.0
+    bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+    bucket.updated = now
+    return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / rate
+
+
+class MessageScheduler:
+    """
+    Sends Bot API requests of all bots through one queue. Each chat gets at most
+    `chat_rate` requests per second (bursts of `chat_burst`), each bot token at most
+    `bot_rate`, with up to `concurrency` requests in flight. A chat's requests go out
+    one at a time in priority order, user replies before owner notifications, and a
+    RetryAfter holds back that chat only. Owner notifications are collected for
+    `digest_interval` seconds and sent as one digest, repeated lines counted once.
+    """
+
+    def __init__(
+        self,
+        chat_rate: float = SEND_CHAT_RATE,
+        chat_burst: int = SEND_CHAT_BURST,
+        bot_rate: float = SEND_BOT_RATE,
+        concurrency: int = SEND_CONCURRENCY,
+        digest_interval: float = OWNER_DIGEST_INTERVAL,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.bot_rate = bot_rate
+        # A second's worth of requests, but at least one, or a rate below 1/s would never send
+        self.bot_burst = max(1, bot_rate)
+        self.concurrency = concurrency
+        self.digest_interval = digest_interval
+        self._seq = itertools.count()
+        self._lanes = {}    # (bot token, chat_id) -> ChatLane
+        self._bots = {}     # bot token -> TokenBucket
+        self._ready = []    # heap of (priority, seq, lane key); stale entries are skipped
+        self._waiting = []  # heap of (not before, seq, lane key)
+        self._digests = {}  # (bot token, chat_id) -> (bot, {line: count})
+        self._in_flight = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_sweep = time.monotonic()
+
+    async def call(self, bot: Bot, chat_id: int, method: str, priority: int = REPLY, **kwargs):
+        """Queue the Bot API call `bot.<method>(chat_id=chat_id, **kwargs)` and return its result."""
+        return await self.submit(bot, chat_id, method, priority, **kwargs)
+
+    async def send_message(self, bot: Bot, chat_id: int, text: str, priority: int = REPLY, **kwargs):
+        return await self.submit(bot, chat_id, "send_message", priority, text=text, **kwargs)
+
+    def submit(self, bot: Bot, chat_id: int, method: str, priority: int = REPLY, **kwargs) -> asyncio.Future:
+        """Queue a Bot API call without waiting for it."""
+        job = SendJob(priority, next(self._seq), bot, method, dict(kwargs, chat_id=chat_id), asyncio.get_running_loop().create_future())
+        key = (bot.token, chat_id)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = ChatLane(self.chat_burst, time.monotonic())
+        heapq.heappush(lane.jobs, (priority, job.seq, job))
+        self._schedule(key, lane)
+        if self._task is None:
+            # In a context of its own, not that of the update that happened to start it
+            self._task = asyncio.create_task(self._dispatch(), context=contextvars.Context())
+        return job.future
+
+    def notify(self, bot: Bot, chat_id: int, text: str):
+        """Add a line to the next owner digest of a chat."""
+        key = (bot.token, chat_id)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = self._digests[key] = (bot, {})
+            if self.digest_interval > 0:
+                asyncio.get_running_loop().call_later(self.digest_interval, self._flush_digest, key)
+        lines = digest[1]
+        lines[text] = lines.get(text, 0) + 1
+        if self.digest_interval <= 0:
+            self._flush_digest(key)
+
+    def stats(self) -> dict:
+        return {
+            "queued": sum(len(lane.jobs) for lane in self._lanes.values()),
+            "in_flight": len(self._in_flight),
+            "chats": len(self._lanes),
+            "digests": len(self._digests),
+        }
+
+    async def drain(self, bot: Bot = None, timeout: float = SEND_DRAIN_TIMEOUT):
+        """Send the pending digests and wait until the queued requests of `bot` (or all bots) are sent."""
+        for key in [key for key in self._digests if bot is None or key[0] == bot.token]:
+            self._flush_digest(key)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not any(
+                lane.jobs or lane.busy for key, lane in self._lanes.items() if bot is None or key[0] == bot.token
+            ):
+                return
+            await asyncio.sleep(0.05)
+        logger.warning("Gave up waiting for %s queued Telegram requests", self.stats()["queued"])
+
+    async def stop(self):
+        """Stop the dispatcher; requests still queued fail with CancelledError."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._in_flight, return_exceptions=True)
+            self._task = None
+        for lane in self._lanes.values():
+            for _, _, job in lane.jobs:
+                job.future.cancel()
+        self._lanes.clear()
+
+    def _schedule(self, key, lane: ChatLane):
+        """Put a lane that has requests and none in flight among the ready or waiting ones."""
+        if lane.busy or not lane.jobs:
+            return
+        now = time.monotonic()
+        ready_at = max(now + refill(lane.bucket, self.chat_rate, self.chat_burst, now), lane.not_before)
+        if ready_at <= now:
+            priority, seq, _ = lane.jobs[0]
+            heapq.heappush(self._ready, (priority, seq, key))
+        else:
+            heapq.heappush(self._waiting, (ready_at, next(self._seq), key))
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, _, key = heapq.heappop(self._waiting)
+                lane = self._lanes.get(key)
+                if lane is not None:
+                    self._schedule(key, lane)
+            if now - self._last_sweep > SWEEP_INTERVAL:
+                self._sweep(now)
+
+            if not self._ready or len(self._in_flight) >= self.concurrency:
+                self._wakeup.clear()
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key = heapq.heappop(self._ready)
+            lane = self._lanes.get(key)
+            if lane is None or lane.busy or not lane.jobs:
+                continue  # A stale entry
+            bucket = self._bots.get(key[0])
+            if bucket is None:
+                bucket = self._bots[key[0]] = TokenBucket(self.bot_burst, now)
+            # A lane may have been queued twice, so its own limit is checked again
+            wait = max(
+                refill(lane.bucket, self.chat_rate, self.chat_burst, now),
+                lane.not_before - now,
+                refill(bucket, self.bot_rate, self.bot_burst, now),
+            )
+            if wait > 0:
+                heapq.heappush(self._waiting, (now + wait, next(self._seq), key))
+                continue
+
+            _, _, job = heapq.heappop(lane.jobs)
+            if job.future.done():
+                # The caller gave up on it
+                self._schedule(key, lane)
+                continue
+            bucket.tokens -= 1
+            lane.bucket.tokens -= 1
+            lane.busy = True
+            task = asyncio.create_task(self._send(key, lane, job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, key, lane: ChatLane, job: SendJob):
+        metrics = get_metrics()
+        labels = {"bot": bot_label(job.bot.token), "method": job.method}
+        try:
+            with metrics.timer("telegram_request_seconds", **labels):
+                result = await getattr(job.bot, job.method)(**job.kwargs)
+        except RetryAfter as e:
+            metrics.inc("telegram_requests_total", outcome="retry_after", **labels)
+            # Flood control of this chat: hold it back and try the request again first
+            lane.not_before = time.monotonic() + float(e.retry_after)
+            heapq.heappush(lane.jobs, (job.priority, job.seq, job))
+        except Exception as e:
+            metrics.inc("telegram_requests_total", outcome="error", **labels)
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            metrics.inc("telegram_requests_total", outcome="ok", **labels)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            lane.busy = False
+            self._schedule(key, lane)
+            self._wakeup.set()
+
+    def _flush_digest(self, key):
+        digest = self._digests.pop(key, None)
+        if digest is None:
+            return
+        bot, lines = digest
+        text = "\n\n".join(line if count == 1 else f"{line} (x{count})" for line, count in lines.items())
+        for part in split_message(text, [], MessageLimit.MAX_TEXT_LENGTH):
+            future = self.submit(bot, key[1], "send_message", OWNER, text=part.text)
+            future.add_done_callback(_report_failure)
+
+    def _sweep(self, now: float):
+        """Forget lanes that are idle with a full bucket; they would start over the same."""
+        self._last_sweep = now
+        idle_after = self.chat_burst / self.chat_rate if self.chat_rate > 0 else 0
+        for key in [
+            key for key, lane in self._lanes.items()
+            if not lane.jobs and not lane.busy and now - lane.bucket.updated > idle_after and now > lane.not_before
+        ]:
+            del self._lanes[key]
+
+
+def _report_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Failed to send an owner notification: %s", future.exception())
+
+
+_scheduler = None
+
+
+def get_message_scheduler() -> MessageScheduler:
+    """Return the process-wide scheduler shared by all bots."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = MessageScheduler()
+    return _scheduler
@@ -0,0 +1,128 @@
+# session.py
+# Per-user conversation state of a bot, e.g. where the user is in the lead-capture flow
+
+import sqlite3
+import time
+from .config import DB_PATH, SESSION_TTL, SESSION_PERSIST
+from .metrics import get_metrics, bot_label
+from .writebehind import get_write_behind
+from .utils import sanitize_filename
+
+# Expired sessions are swept from memory at most this often (seconds)
+PURGE_INTERVAL = 60
+
+# Persist an active session's last-seen time at most this often (seconds), so the purge keeps its row
+TOUCH_PERSIST_INTERVAL = 60
+
+
+class UserSession:
+    __slots__ = ("agreed_policies", "number_sent", "discount_offered", "last_seen", "persisted_seen")
+
+    def __init__(
+        self,
+        agreed_policies: bool = False,
+        number_sent: bool = False,
+        discount_offered: bool = False,
+        last_seen: float = 0.0,
+    ):
+        self.agreed_policies = agreed_policies
+        self.number_sent = number_sent
+        self.discount_offered = discount_offered
+        self.last_seen = last_seen
+        # last_seen as stored in the database; None while the session has no row there
+        self.persisted_seen = None
+
+
+class SessionStore:
+    """
+    Sessions of one bot keyed by user id. A session idle for longer than `ttl`
+    seconds starts over; with `persist` the sessions survive restarts in SQLite.
+    Live sessions are served from memory, so their writes can lag behind.
+    """
+
+    def __init__(self, telegram_id: str, db_path=DB_PATH, ttl: float = SESSION_TTL, persist: bool = SESSION_PERSIST):
+        self.bot = sanitize_filename(telegram_id)
+        self.ttl = ttl
+        self._sessions = {}
+        self._last_purge = time.time()
+        self._conn = None
+        self._metrics = get_metrics()
+        self._label = bot_label(telegram_id)
+        self._writer = get_write_behind(db_path)
+        if persist:
+            self._conn = sqlite3.connect(str(db_path))
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS user_sessions (
+                    bot TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    agreed_policies INTEGER NOT NULL,
+                    number_sent INTEGER NOT NULL,
+                    discount_offered INTEGER NOT NULL DEFAULT 0,
+                    last_seen REAL NOT NULL,
+                    PRIMARY KEY (bot, user_id)
+                )"""
+            )
+            self._conn.commit()
+
+    def get(self, user_id: int) -> UserSession:
+        """Return the live session of a user, starting a new one if needed."""
+        now = time.time()
+        if now - self._last_purge > PURGE_INTERVAL:
+            self.purge_expired()
+
+        session = self._sessions.get(user_id)
+        if session is None and self._conn is not None:
+            with self._metrics.timer("storage_seconds", store="sessions", op="load", bot=self._label):
+                row = self._conn.execute(
+                    "SELECT agreed_policies, number_sent, discount_offered, last_seen FROM user_sessions WHERE bot = ? AND user_id = ?",
+                    (self.bot, user_id),
+                ).fetchone()
+            if row is not None:
+                session = UserSession(bool(row[0]), bool(row[1]), bool(row[2]), row[3])
+                session.persisted_seen = row[3]
+        if session is None or now - session.last_seen > self.ttl:
+            session = UserSession()
+        session.last_seen = now
+        self._sessions[user_id] = session
+        if session.persisted_seen is not None and now - session.persisted_seen > TOUCH_PERSIST_INTERVAL:
+            session.persisted_seen = now
+            self._writer.execute(
+                "UPDATE user_sessions SET last_seen = ? WHERE bot = ? AND user_id = ?", (now, self.bot, user_id)
+            )
+        return session
+
+    def save(self, user_id: int, session: UserSession):
+        """Persist a session after its flags changed."""
+        self._sessions[user_id] = session
+        if self._conn is not None:
+            session.persisted_seen = session.last_seen
+            self._writer.execute(
+                "INSERT OR REPLACE INTO user_sessions"
+                " (bot, user_id, agreed_policies, number_sent, discount_offered, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.bot, user_id, int(session.agreed_policies), int(session.number_sent),
+                    int(session.discount_offered), session.last_seen,
+                ),
+            )
+
+    def reset(self, user_id: int):
+        """Start the session of a user over."""
+        # Kept in memory: until the queued DELETE is committed the database still has the old session
+        self._sessions[user_id] = UserSession(last_seen=time.time())
+        if self._conn is not None:
+            self._writer.execute("DELETE FROM user_sessions WHERE bot = ? AND user_id = ?", (self.bot, user_id))
+
+    def purge_expired(self):
+        """Forget expired sessions, in memory and in the database."""
+        now = time.time()
+        self._last_purge = now
+        cutoff = now - self.ttl
+        for user_id in [user_id for user_id, session in self._sessions.items() if session.last_seen < cutoff]:
+            del self._sessions[user_id]
+        if self._conn is not None:
+            self._writer.execute("DELETE FROM user_sessions WHERE bot = ? AND last_seen < ?", (self.bot, cutoff))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
@@ -0,0 +1,114 @@
+# streaming.py
+# Shows an assistant answer in Telegram while it is being generated
+
+import asyncio
+import logging
+import time
+from typing import List
+from telegram import Bot
+from telegram.constants import ChatAction
+from telegram.error import BadRequest
+from .config import STREAM_EDIT_INTERVAL
+from .postprocess import ReplyPart, ResponsePipeline
+from .sender import get_message_scheduler, NOTICE
+
+logger = logging.getLogger(__name__)
+
+# Telegram shows a chat action for about five seconds
+TYPING_REFRESH = 4.5
+
+
+def stable_length(text: str, start: int = 0) -> int:
+    """
+    Length of the prefix of `text` that can be cleaned already: everything before a
+    bracket that is still open on the last line, whose content may turn out to be a citation.
+    """
+    tail = max(text.rfind("\n", start) + 1, text.rfind("]", start) + 1, text.rfind("】", start) + 1, start)
+    openings = [index for index in (text.find("[", tail), text.find("【", tail)) if index != -1]
+    return min(openings) if openings else len(text)
+
+
+class StreamingReply:
+    """
+    Collects the chunks of an answer and mirrors the cleaned text into one Telegram
+    message, edited at most every `edit_interval` seconds. Text past Telegram's message
+    length continues in a new message. The chat shows "typing" until the first text arrives.
+    Partial text is cleaned chunk by chunk; the complete answer is processed as a whole,
+    so its formatting shows once it is finished. Requests go through the shared message
+    scheduler, which also waits out Telegram's flood control.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, pipeline: ResponsePipeline, edit_interval: float = STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.pipeline = pipeline
+        self.sender = get_message_scheduler()
+        self.edit_interval = edit_interval
+        self.raw = ""
+        self._cleaned = ""   # cleaned text of raw[:self._offset]
+        self._offset = 0
+        self._messages = []  # [message, shown (text, spans)] per sent message
+        self._next_edit = 0.0
+        self._typing = None
+
+    async def __aenter__(self):
+        self._typing = asyncio.create_task(self._keep_typing())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._stop_typing()
+
+    async def feed(self, chunk: str):
+        """Add the next chunk of the answer, updating the message if it is due."""
+        self.raw += chunk
+        end = stable_length(self.raw, self._offset)
+        if end > self._offset:
+            self._cleaned += self.pipeline.clean(self.raw[self._offset:end])
+            self._offset = end
+        if time.monotonic() >= self._next_edit:
+            limit = self.pipeline.max_length
+            await self._show([ReplyPart(self._cleaned[i:i + limit]) for i in range(0, len(self._cleaned), limit)])
+
+    async def finish(self) -> str:
+        """Show the complete answer and return its cleaned text."""
+        processed = self.pipeline.process(self.raw)
+        await self._show(processed.parts)
+        return processed.text
+
+    async def _show(self, parts: List[ReplyPart]):
+        """Bring the sent messages up to date with `parts`."""
+        for index, part in enumerate(parts):
+            if not part.text.strip():
+                break
+            shown = (part.text, part.spans)
+            if index < len(self._messages):
+                message, previous = self._messages[index]
+                if shown != previous:
+                    try:
+                        await self.sender.call(
+                            self.bot, self.chat_id, "edit_message_text",
+                            text=part.text, message_id=message.message_id, entities=part.entities or None,
+                        )
+                    except BadRequest as e:
+                        # Cleaned differently but rendered the same; the following parts still need updating
+                        if "not modified" not in str(e):
+                            raise
+                    self._messages[index][1] = shown
+            else:
+                message = await self.sender.send_message(self.bot, self.chat_id, part.text, entities=part.entities or None)
+                self._messages.append([message, shown])
+                self._stop_typing()
+        self._next_edit = time.monotonic() + self.edit_interval
+
+    async def _keep_typing(self):
+        while True:
+            try:
+                await self.sender.call(self.bot, self.chat_id, "send_chat_action", priority=NOTICE, action=ChatAction.TYPING)
+            except Exception as e:
+                logger.warning("Failed to send the typing action to %s: %s", self.chat_id, e)
+            await asyncio.sleep(TYPING_REFRESH)
+
+    def _stop_typing(self):
+        if self._typing is not None:
+            self._typing.cancel()
+            self._typing = None
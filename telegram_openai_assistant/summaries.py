@@ -0,0 +1,122 @@
+# summaries.py
+# Rolling per-user dialog summaries, refreshed in the background as the dialog grows
+
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Awaitable, Callable
+from .config import DB_PATH, SUMMARY_EVERY_TURNS, SUMMARY_REQUEST
+from .dialog_store import DialogStore
+from .prompt import encode_turn
+from .utils import sanitize_filename, get_dialog_store, get_recent_turns
+from .writebehind import get_write_behind
+
+logger = logging.getLogger(__name__)
+
+# A refresh reads at most this many new turns, e.g. for a long dialog summarized the first time
+MAX_REFRESH_TURNS = 50
+
+# Longest wait (seconds) for a refreshed summary to be committed
+MAX_REFRESH_WAIT = 5.0
+
+
+class RollingSummaries:
+    """
+    Keeps one summary per user of a bot together with the number of turns it covers.
+    After every `every` new turns the summary is refreshed in the background from the
+    previous summary plus the new turns only, so each refresh costs the same however
+    long the dialog is. Readers get the summary plus the few turns it does not cover yet.
+    """
+
+    def __init__(
+        self,
+        telegram_id: str,
+        summarize: Callable[[str], Awaitable[str]],
+        store: DialogStore = None,
+        db_path=DB_PATH,
+        every: int = SUMMARY_EVERY_TURNS,
+    ):
+        self.telegram_id = telegram_id
+        self.bot = sanitize_filename(telegram_id)
+        self.summarize = summarize
+        self.store = store or get_dialog_store()
+        self.every = every
+        self._pending = {}     # user_id -> turns added since the last refresh was scheduled
+        self._refreshing = {}  # user_id -> refresh task
+        self._writer = get_write_behind(db_path)
+        self._conn = sqlite3.connect(str(db_path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS dialog_summaries (
+                bot TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                summary TEXT NOT NULL,
+                turns_covered INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (bot, user_id)
+            )"""
+        )
+        self._conn.commit()
+
+    def note_turn(self, user_id: int):
+        """Record a new turn of a user and schedule a refresh once enough turns piled up."""
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        if self._pending[user_id] >= self.every:
+            self.schedule_refresh(user_id)
+
+    def schedule_refresh(self, user_id: int):
+        """Start a background refresh of a user's summary unless one is already running."""
+        self._pending.pop(user_id, None)
+        if user_id in self._refreshing:
+            return
+        task = asyncio.create_task(self.refresh(user_id))
+        self._refreshing[user_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(user_id, None))
+
+    async def refresh(self, user_id: int):
+        """Fold the turns not covered yet into the user's summary."""
+        summary, covered = self.load(user_id)
+        total = await self.store.count(self.bot, user_id)
+        new_turns = total - covered
+        if new_turns <= 0:
+            return
+        turns = await get_recent_turns(user_id, self.telegram_id, limit=min(new_turns, MAX_REFRESH_TURNS))
+        request = SUMMARY_REQUEST + "\n" + (summary or "-") + "\n" + "\n".join(encode_turn(turn) for turn in turns)
+        try:
+            summary = await self.summarize(request)
+        except Exception as e:
+            logger.warning("Failed to refresh the dialog summary: %s", e, extra={"user": user_id})
+            return
+        seq = self._writer.execute(
+            "INSERT OR REPLACE INTO dialog_summaries (bot, user_id, summary, turns_covered, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (self.bot, user_id, summary, total, time.time()),
+        )
+        # Rare and read on the next message, so wait for it here rather than there
+        await self._writer.wait_persisted(seq, MAX_REFRESH_WAIT)
+
+    def load(self, user_id: int) -> tuple:
+        """Return (summary, turns covered) of a user; ("", 0) if there is none yet."""
+        row = self._conn.execute(
+            "SELECT summary, turns_covered FROM dialog_summaries WHERE bot = ? AND user_id = ?",
+            (self.bot, user_id),
+        ).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    async def dialog(self, user_id: int) -> str:
+        """The user's dialog as the cached summary followed by the turns it does not cover yet."""
+        summary, covered = self.load(user_id)
+        uncovered = await self.store.count(self.bot, user_id) - covered
+        if uncovered >= self.every:
+            # E.g. a dialog from before a restart; have it summarized for next time
+            self.schedule_refresh(user_id)
+        # A refresh that failed or is still running leaves more turns uncovered; cap them
+        turns = await get_recent_turns(user_id, self.telegram_id, limit=min(uncovered, 2 * self.every)) if uncovered > 0 else []
+        parts = [summary] if summary else []
+        parts += [encode_turn(turn) for turn in turns]
+        return "\n".join(parts)
+
+    async def stop(self):
+        """Wait for running refreshes and close the store."""
+        await asyncio.gather(*self._refreshing.values(), return_exceptions=True)
+        self._conn.close()
@@ -0,0 +1,213 @@
+# supervisor.py
+# Spreads the configured bots over worker processes and keeps the workers running
+
+import asyncio
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from .config import (
+    SUPERVISOR_HEARTBEAT_INTERVAL,
+    SUPERVISOR_SHUTDOWN_TIMEOUT,
+)
+from .logs import setup_logging, setup_worker_logging
+
+# Restart delay of a crashing worker doubles per crash up to this many seconds
+MAX_RESTART_DELAY = 60
+# A worker that stayed up this long is considered healthy again
+STABLE_UPTIME = 60
+
+logger = logging.getLogger(__name__)
+
+
+def worker_main(index: int, workers: int, log_queue, status_queue):
+    """
+    Entry point of a worker process: runs its shard of the configured bots in its own event loop.
+    Each worker reads the configuration itself and picks its bots by `shard_of`, so a reload
+    moves every bot to the same worker without asking the supervisor.
+    """
+    # Forked workers inherit the supervisor's handlers; start_bots installs its own
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    setup_worker_logging(log_queue)
+    asyncio.run(run_worker(index, workers, status_queue))
+
+
+async def run_worker(index: int, workers: int, status_queue):
+    from .bot import start_bots
+
+    heartbeat = asyncio.create_task(send_heartbeats(index, status_queue))
+    try:
+        await start_bots(worker=index, workers=workers)
+    finally:
+        heartbeat.cancel()
+
+
+async def send_heartbeats(index: int, status_queue):
+    """Periodically report the worker's vital statistics to the supervisor."""
+    from .bot import get_bot_manager
+    from .quota import get_quota_counter
+    from .utils import get_history_cache
+
+    started = time.time()
+    quota = get_quota_counter()
+    while True:
+        status_queue.put({
+            "worker": index,
+            "pid": os.getpid(),
+            "bots": len(get_bot_manager().running()),
+            "uptime": time.time() - started,
+            "messages_today": await asyncio.to_thread(quota.count),
+            "messages_pending": quota.pending(),
+            "history_cache": get_history_cache().stats(),
+        })
+        await asyncio.sleep(SUPERVISOR_HEARTBEAT_INTERVAL)
+
+
+class WorkerSlot:
+    __slots__ = ("index", "process", "started", "crashes", "restart_at", "status")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.started = 0.0
+        self.crashes = 0
+        self.restart_at = 0.0
+        self.status = {}
+
+
+class Supervisor:
+    """
+    Runs `workers` worker processes, each with its shard of the bots, restarts the workers
+    that die, merges their log records into this process and collects their heartbeats.
+    SIGHUP is passed on to the workers, which then reload the bot configuration.
+    """
+
+    def __init__(self, workers: int, log_handler: logging.Handler = None):
+        self._context = multiprocessing.get_context()
+        self.log_queue = self._context.Queue()
+        self.status_queue = self._context.Queue()
+        self.workers = workers
+        self.slots = [WorkerSlot(index) for index in range(workers)]
+        self._stopping = False
+        # Worker records were filtered and sampled in the worker, so they go straight to the output
+        handlers = [log_handler] if log_handler is not None else logging.getLogger().handlers
+        self._listener = logging.handlers.QueueListener(self.log_queue, *handlers, respect_handler_level=True)
+
+    def run(self):
+        """Start the workers and supervise them until SIGINT or SIGTERM."""
+        self._listener.start()
+        for slot in self.slots:
+            self._spawn(slot)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._forward_reload)
+
+        last_report = time.time()
+        try:
+            while not self._stopping:
+                self._collect_status(timeout=1)
+                self._restart_dead_workers()
+                if time.time() - last_report >= SUPERVISOR_HEARTBEAT_INTERVAL:
+                    self.report()
+                    last_report = time.time()
+        finally:
+            self.shutdown()
+
+    def totals(self) -> dict:
+        """Aggregate the latest heartbeats of all workers."""
+        statuses = [slot.status for slot in self.slots if slot.status]
+        hits = sum(status["history_cache"]["hits"] for status in statuses)
+        misses = sum(status["history_cache"]["misses"] for status in statuses)
+        return {
+            "workers_alive": sum(1 for slot in self.slots if slot.process and slot.process.is_alive()),
+            "bots": sum(status["bots"] for status in statuses),
+            "restarts": sum(slot.crashes for slot in self.slots),
+            # A worker's count is the shared table's plus the increments it has not flushed yet;
+            # the latest table count is the highest one reported, then every worker adds its own
+            "messages_today": max((status["messages_today"] - status["messages_pending"] for status in statuses), default=0)
+            + sum(status["messages_pending"] for status in statuses),
+            "history_cache_hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def report(self):
+        logger.info("Supervisor status: %s", self.totals())
+
+    def shutdown(self):
+        """Ask every worker to stop, then kill the ones that do not exit in time."""
+        self._stopping = True
+        for slot in self.slots:
+            if slot.process and slot.process.is_alive():
+                slot.process.terminate()  # SIGTERM: the worker stops its bots cleanly
+        deadline = time.time() + SUPERVISOR_SHUTDOWN_TIMEOUT
+        for slot in self.slots:
+            if slot.process:
+                slot.process.join(max(0, deadline - time.time()))
+                if slot.process.is_alive():
+                    logger.warning("Worker %s did not stop in time, killing it", slot.index)
+                    slot.process.kill()
+                    slot.process.join()
+        self._listener.stop()
+
+    def _request_stop(self, signum, frame):
+        logger.info("Supervisor received signal %s, shutting down", signum)
+        self._stopping = True
+
+    def _forward_reload(self, signum, frame):
+        logger.info("Supervisor received signal %s, reloading the workers' bots", signum)
+        for slot in self.slots:
+            if slot.process and slot.process.is_alive():
+                os.kill(slot.process.pid, signum)
+
+    def _spawn(self, slot: WorkerSlot):
+        slot.process = self._context.Process(
+            target=worker_main,
+            args=(slot.index, self.workers, self.log_queue, self.status_queue),
+            name=f"chatbot-worker-{slot.index}",
+        )
+        slot.process.start()
+        slot.started = time.time()
+        logger.info("Started worker %s (pid %s)", slot.index, slot.process.pid)
+
+    def _restart_dead_workers(self):
+        now = time.time()
+        for slot in self.slots:
+            if slot.process is None or slot.process.is_alive() or self._stopping:
+                continue
+            if slot.restart_at == 0.0:
+                if now - slot.started >= STABLE_UPTIME:
+                    slot.crashes = 0
+                slot.crashes += 1
+                delay = min(2 ** (slot.crashes - 1), MAX_RESTART_DELAY)
+                slot.restart_at = now + delay
+                logger.error(
+                    "Worker %s exited with code %s, restarting in %ss",
+                    slot.index, slot.process.exitcode, delay,
+                )
+            elif now >= slot.restart_at:
+                slot.restart_at = 0.0
+                self._spawn(slot)
+
+    def _collect_status(self, timeout: float):
+        try:
+            status = self.status_queue.get(timeout=timeout)
+            while True:
+                self.slots[status["worker"]].status = status
+                status = self.status_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+def run_supervisor(workers: int):
+    """
+    Run all configured bots sharded across `workers` processes. Workers whose shard is empty
+    stay idle until a reload brings them bots, so the shards do not change when bots are added.
+    """
+    log_handler = setup_logging()
+    Supervisor(max(1, workers), log_handler).run()
@@ -0,0 +1,138 @@
+# threads.py
+# Keeps one assistant thread per (bot, user) so a dialog continues on the same thread
+
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+from .config import DB_PATH, THREAD_TTL, THREAD_CACHE_SIZE
+from .metrics import get_metrics, bot_label
+from .utils import sanitize_filename
+from .writebehind import get_write_behind
+
+logger = logging.getLogger(__name__)
+
+# Persist a touched thread's last-use time at most this often (seconds)
+TOUCH_PERSIST_INTERVAL = 60
+
+# Longest wait (seconds) for a queued write of a thread that left the cache and is needed again
+UNWRITTEN_WAIT = 1.0
+
+# Users with queued thread writes remembered before the committed ones are forgotten
+MAX_TRACKED_WRITES = 10000
+
+
+class ThreadRegistry:
+    """LRU cache of user threads with TTL expiry, backed by SQLite."""
+
+    def __init__(self, db_path=DB_PATH, ttl: float = THREAD_TTL, max_cached: int = THREAD_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_cached = max_cached
+        # (bot, user_id) -> [thread_id, last_used, persisted_last_used]
+        self._cache = OrderedDict()
+        # (bot, user_id) -> number of the last write queued for it, until the cache hits the store again
+        self._unwritten = {}
+        self._metrics = get_metrics()
+        self._writer = get_write_behind(db_path)
+        self._conn = sqlite3.connect(str(db_path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS assistant_threads (
+                bot TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                thread_id TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (bot, user_id)
+            )"""
+        )
+        self._conn.commit()
+
+    async def get(self, telegram_id: str, user_id: int) -> Optional[str]:
+        """Return the live thread of a user, or None if there is none or it expired."""
+        key = (sanitize_filename(telegram_id), user_id)
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is None:
+            # Writes queued while waiting are waited for as well
+            seq = self._unwritten.pop(key, None)
+            while seq is not None:
+                if not await self._writer.wait_persisted(seq, timeout=UNWRITTEN_WAIT):
+                    logger.warning("Reading the thread of user %s before its last write was committed", user_id)
+                    break
+                seq = self._unwritten.pop(key, None)
+            # A thread put while waiting is the live one
+            entry = self._cache.get(key)
+        if entry is None:
+            with self._metrics.timer("storage_seconds", store="threads", op="load", bot=bot_label(key[0])):
+                row = self._conn.execute(
+                    "SELECT thread_id, last_used FROM assistant_threads WHERE bot = ? AND user_id = ?",
+                    key,
+                ).fetchone()
+            self._metrics.inc("cache_lookups_total", cache="threads", bot=bot_label(key[0]), result="miss" if row is None else "stored")
+            if row is None:
+                return None
+            entry = [row[0], row[1], row[1]]
+            self._remember(key, entry)
+        else:
+            self._metrics.inc("cache_lookups_total", cache="threads", bot=bot_label(key[0]), result="hit")
+
+        if now - entry[1] > self.ttl:
+            self.drop(telegram_id, user_id)
+            return None
+
+        entry[1] = now
+        self._cache.move_to_end(key)
+        if now - entry[2] > TOUCH_PERSIST_INTERVAL:
+            self._save(key, entry)
+        return entry[0]
+
+    def put(self, telegram_id: str, user_id: int, thread_id: str):
+        """Register a new thread for a user."""
+        key = (sanitize_filename(telegram_id), user_id)
+        now = time.time()
+        entry = [thread_id, now, now]
+        self._remember(key, entry)
+        self._save(key, entry)
+
+    def drop(self, telegram_id: str, user_id: int):
+        """Forget the thread of a user."""
+        key = (sanitize_filename(telegram_id), user_id)
+        self._cache.pop(key, None)
+        self._track(key, self._writer.execute("DELETE FROM assistant_threads WHERE bot = ? AND user_id = ?", key))
+
+    def purge_expired(self) -> int:
+        """Delete expired threads from the store and return how many were removed."""
+        cutoff = time.time() - self.ttl
+        for key in [key for key, entry in self._cache.items() if entry[1] < cutoff]:
+            del self._cache[key]
+        cursor = self._conn.execute("DELETE FROM assistant_threads WHERE last_used < ?", (cutoff,))
+        self._conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        """Queue the pending last-use times and close the store."""
+        rows = [(entry[1], *key) for key, entry in self._cache.items() if entry[1] != entry[2]]
+        if rows:
+            self._writer.executemany("UPDATE assistant_threads SET last_used = ? WHERE bot = ? AND user_id = ?", rows)
+        self._conn.close()
+
+    def _remember(self, key, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            old_key, old_entry = self._cache.popitem(last=False)
+            if old_entry[1] != old_entry[2]:
+                self._save(old_key, old_entry)
+
+    def _save(self, key, entry):
+        self._track(key, self._writer.execute(
+            "INSERT OR REPLACE INTO assistant_threads (bot, user_id, thread_id, last_used) VALUES (?, ?, ?, ?)",
+            (*key, entry[0], entry[1]),
+        ))
+        entry[2] = entry[1]
+
+    def _track(self, key, seq: int):
+        if len(self._unwritten) >= MAX_TRACKED_WRITES:
+            self._unwritten = {key: last for key, last in self._unwritten.items() if not self._writer.persisted(last)}
+        self._unwritten[key] = seq
@@ -0,0 +1,92 @@
+# timers.py
+# One inactivity timer per user, rescheduled on activity instead of piling up jobs
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+from .config import INACTIVITY_TIMEOUT, TIMER_WORKERS, TIMER_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class InactivityTimers:
+    """
+    Keeps a single deadline per key in a heap. Touching a key moves its deadline;
+    stale heap entries are skipped when they surface. Keys that expired together are
+    queued in one go and handled by a bounded pool of workers calling `callback(key, payload)`.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[Hashable, object], Awaitable],
+        timeout: float = INACTIVITY_TIMEOUT,
+        workers: int = TIMER_WORKERS,
+        queue_size: int = TIMER_QUEUE_SIZE,
+    ):
+        self.callback = callback
+        self.timeout = timeout
+        self.workers = workers
+        self._deadlines = {}  # key -> (deadline, payload)
+        self._heap = []       # (deadline, seq, key), may hold stale entries
+        self._seq = itertools.count()
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def touch(self, key: Hashable, payload=None):
+        """(Re)start the timer of a key."""
+        deadline = time.monotonic() + self.timeout
+        self._deadlines[key] = (deadline, payload)
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._compact()
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._schedule())]
+        self._tasks += [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the scheduler and workers; pending timers are dropped."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _schedule(self):
+        while True:
+            now = time.monotonic()
+            expired = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                entry = self._deadlines.get(key)
+                if entry is not None and entry[0] == deadline:
+                    del self._deadlines[key]
+                    expired.append((key, entry[1]))
+            for item in expired:
+                await self._queue.put(item)
+
+            # All timers share one timeout, so a new deadline is never earlier than the heap head
+            delay = self._heap[0][0] - now if self._heap else self.timeout
+            await asyncio.sleep(max(delay, 0.01))
+
+    async def _work(self):
+        while True:
+            key, payload = await self._queue.get()
+            try:
+                await self.callback(key, payload)
+            except Exception:
+                logger.exception("Inactivity timer callback failed for %s", key)
+            finally:
+                self._queue.task_done()
+
+    def _compact(self):
+        self._heap = [(deadline, next(self._seq), key) for key, (deadline, _) in self._deadlines.items()]
+        heapq.heapify(self._heap)
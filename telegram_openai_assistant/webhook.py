@@ -0,0 +1,87 @@
+# webhook.py
+# One local HTTP server receiving the webhook updates of every bot
+
+import hashlib
+import hmac
+import logging
+import secrets
+from telegram import Update
+from .config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_path(token: str) -> str:
+    """URL path of a bot's webhook; derived from the token without exposing it."""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def webhook_secret(token: str) -> str:
+    """
+    Secret token Telegram sends along with every update of a bot.
+    Stable across restarts when WEBHOOK_SECRET is set, random per process otherwise.
+    """
+    if WEBHOOK_SECRET:
+        return hmac.new(WEBHOOK_SECRET.encode(), token.encode(), hashlib.sha256).hexdigest()
+    return secrets.token_urlsafe(32)
+
+
+class WebhookServer:
+    """
+    Routes webhook updates to the Application of the right bot by URL path and
+    checks their secret token. When a bot already has `max_pending` updates it did not
+    handle yet, queued or in its dispatcher, new ones are refused with 503 so that
+    Telegram retries them later.
+    """
+
+    def __init__(self, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, max_pending: int = WEBHOOK_MAX_PENDING):
+        self.listen = listen
+        self.port = port
+        self.max_pending = max_pending
+        self._routes = {}  # path -> (application, secret, number of updates being handled)
+        self._runner = None
+
+    def add_bot(self, application, path: str, secret: str, pending=lambda: 0):
+        """Route `path` to a bot; `pending` tells how many updates it took from its queue and did not handle yet."""
+        self._routes[path] = (application, secret, pending)
+
+    def remove_bot(self, path: str):
+        self._routes.pop(path, None)
+
+    async def start(self):
+        # aiohttp is only needed in webhook mode
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/{path}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info("Webhook server listening on %s:%s", self.listen, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        route = self._routes.get(request.match_info["path"])
+        if route is None:
+            return web.Response(status=404)
+        application, secret, pending = route
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=403)
+        # The application moves queued updates into tasks right away, so the queue alone stays short
+        if application.update_queue.qsize() + pending() >= self.max_pending:
+            return web.Response(status=503)
+
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
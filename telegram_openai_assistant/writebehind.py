@@ -0,0 +1,281 @@
+# writebehind.py
+# Database writes taken off the reply path: queued, batched into transactions and committed by a background thread
+
+import asyncio
+import itertools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from .config import DB_PATH, WRITE_QUEUE_SIZE, WRITE_BATCH_SIZE, WRITE_FLUSH_TIMEOUT
+from .metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# A batch the database refused because another connection held the lock is tried this often,
+# then its statements are tried one by one
+MAX_ATTEMPTS = 5
+
+# SQLite result codes of a database another connection holds the lock of
+BUSY_CODES = (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+# Writers waiting for room in the queue check this often (seconds) that the thread still runs
+RESTART_INTERVAL = 1.0
+
+
+class WriteJob:
+    __slots__ = ("seq", "sql", "params", "many")
+
+    def __init__(self, seq: int, sql: str, params, many: bool):
+        self.seq = seq
+        self.sql = sql
+        self.params = params
+        self.many = many
+
+
+class WriteBehind:
+    """
+    Commits the statements queued by the stores in order, from a background thread with
+    a connection of its own: as many as are waiting (up to `batch_size`) go into one
+    transaction. The stores keep reading through their own connections, so a write is
+    visible to them only once `persisted(seq)` is true for the number `execute` returned;
+    code on the event loop awaits `wait_persisted` instead. At most `queue_size` statements
+    wait; beyond that a writer in another thread blocks until the thread caught up, while the
+    event loop, which must not block, queues anyway and waits in `throttle` before its next
+    writes. With a queue size of 0 every statement is committed right away instead.
+    """
+
+    def __init__(self, db_path=DB_PATH, queue_size: int = WRITE_QUEUE_SIZE, batch_size: int = WRITE_BATCH_SIZE):
+        self.db_path = db_path
+        self.queue_size = queue_size
+        self.batch_size = max(1, batch_size)
+        self._seq = itertools.count(1)
+        self._queued = 0    # Number of the last queued statement
+        self._done = 0      # Number of the last statement committed (or given up on)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._conn = None   # Only used when writing synchronously
+        self._lock = threading.Lock()
+        self._written = threading.Condition()
+        self._waiters = []  # (seq, loop, future) of the coroutines in wait_persisted
+
+    @property
+    def deferred(self) -> bool:
+        """Whether writes reach the database some time after `execute` returned."""
+        return self.queue_size > 0
+
+    def execute(self, sql: str, params=()) -> int:
+        """Queue a statement; returns its number for `persisted`."""
+        return self._submit(sql, params, many=False)
+
+    def executemany(self, sql: str, rows) -> int:
+        return self._submit(sql, list(rows), many=True)
+
+    def persisted(self, seq: int, timeout: float = 0) -> bool:
+        """Tell whether statement `seq` is committed, waiting up to `timeout` seconds for it."""
+        if seq <= self._done or timeout <= 0:
+            return seq <= self._done
+        with self._written:
+            return self._written.wait_for(lambda: seq <= self._done, timeout)
+
+    async def wait_persisted(self, seq: int, timeout: float = None) -> bool:
+        """`persisted` for the event loop: waits for statement `seq` without blocking the loop."""
+        if seq <= self._done or (timeout is not None and timeout <= 0):
+            return seq <= self._done
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._written:
+            if seq <= self._done:
+                return True
+            self._waiters.append((seq, loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        return seq <= self._done
+
+    async def throttle(self):
+        """Wait while the queue is full: the backpressure on writers running on the event loop."""
+        if self.deferred and self.pending() >= self.queue_size:
+            get_metrics().inc("write_stalls_total")
+            while self.pending() >= self.queue_size:
+                with self._lock:
+                    # A thread that died would never make room
+                    self._start_thread()
+                await self.wait_persisted(self._queued - self.queue_size + 1, RESTART_INTERVAL)
+
+    def pending(self) -> int:
+        """Statements queued and not committed yet."""
+        return self._queued - self._done
+
+    async def flush(self, timeout: float = WRITE_FLUSH_TIMEOUT) -> bool:
+        """Wait until everything queued so far is committed; False if that took longer than `timeout`."""
+        target = self._queued
+        deadline = time.monotonic() + timeout
+        while self._done < target:
+            if time.monotonic() >= deadline:
+                logger.warning("Gave up waiting for %s queued database writes", self.pending())
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    def close(self):
+        """Commit what is queued and stop the thread; a later write starts it again."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _submit(self, sql: str, params, many: bool) -> int:
+        if not self.deferred:
+            with self._lock:
+                job = WriteJob(next(self._seq), sql, params, many)
+                if self._conn is None:
+                    self._conn = _connect(self.db_path, check_same_thread=False)
+                self._write(self._conn, [job])
+            self._queued = self._done = job.seq
+            return job.seq
+
+        if self.pending() >= self.queue_size and not _on_event_loop():
+            # Backpressure: the database cannot keep up, so the writers have to wait
+            get_metrics().inc("write_stalls_total")
+            while self.pending() >= self.queue_size:
+                with self._lock:
+                    self._start_thread()
+                with self._written:
+                    self._written.wait_for(lambda: self.pending() < self.queue_size, RESTART_INTERVAL)
+        with self._lock:
+            self._start_thread()
+            # Numbered under the lock, so the statements are queued in the order of their numbers
+            job = WriteJob(next(self._seq), sql, params, many)
+            self._queued = job.seq
+            self._queue.put(job)
+        return job.seq
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        jobs = []
+        try:
+            conn = _connect(self.db_path)
+            try:
+                while True:
+                    jobs = [self._queue.get()]
+                    while len(jobs) < self.batch_size:
+                        try:
+                            jobs.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    stop = jobs[-1] is None
+                    jobs = [job for job in jobs if job is not None]
+                    if jobs:
+                        self._write(conn, jobs)
+                    if stop:
+                        return
+            finally:
+                conn.close()
+        except Exception:
+            # The statements still queued wait for the thread the next write starts
+            jobs = [job for job in jobs if job is not None]
+            logger.exception("The database writer stopped, dropping %s writes", len(jobs))
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+            if jobs:
+                get_metrics().inc("write_errors_total", len(jobs))
+                self._mark_done(jobs[-1].seq)
+
+    def _write(self, conn: sqlite3.Connection, jobs: list):
+        metrics = get_metrics()
+        with metrics.timer("storage_seconds", store="write_behind", op="commit"):
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    with conn:  # One transaction, rolled back if a statement fails
+                        for job in jobs:
+                            (conn.executemany if job.many else conn.execute)(job.sql, job.params)
+                    break
+                except sqlite3.Error as e:
+                    if not _is_busy(e):
+                        # A broken statement: commit the others one by one so that only it is lost
+                        self._write_each(conn, jobs)
+                        break
+                    # Locked by another connection; wait for it
+                    logger.warning("Database write attempt %s failed: %s", attempt, e)
+                    time.sleep(0.05 * 2 ** attempt)
+            else:
+                # Still locked: what can be written on its own is, the rest is lost
+                logger.error("Database writes still failing after %s attempts, writing them one by one", MAX_ATTEMPTS)
+                self._write_each(conn, jobs)
+        self._mark_done(jobs[-1].seq)
+
+    def _mark_done(self, seq: int):
+        with self._written:
+            self._done = max(self._done, seq)
+            self._written.notify_all()
+            woken = [waiter for waiter in self._waiters if waiter[0] <= self._done]
+            self._waiters = [waiter for waiter in self._waiters if waiter[0] > self._done]
+        for _, loop, future in woken:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # The loop is closed, nobody waits anymore
+
+    def _write_each(self, conn: sqlite3.Connection, jobs: list):
+        for job in jobs:
+            try:
+                with conn:
+                    (conn.executemany if job.many else conn.execute)(job.sql, job.params)
+            except sqlite3.Error:
+                get_metrics().inc("write_errors_total")
+                logger.exception("Dropped a database write: %s", job.sql)
+
+
+def _is_busy(e: sqlite3.Error) -> bool:
+    # Extended result codes keep the primary code in the low byte
+    return (getattr(e, "sqlite_errorcode", 0) & 0xFF) in BUSY_CODES
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _connect(db_path, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(db_path), check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+_writers = {}
+
+
+def get_write_behind(db_path=DB_PATH) -> WriteBehind:
+    """Return the process-wide writer of a database."""
+    writer = _writers.get(str(db_path))
+    if writer is None:
+        writer = _writers[str(db_path)] = WriteBehind(db_path)
+    return writer
+
+
+def close_writers():
+    """Commit the queued writes of all databases and stop their threads."""
+    for writer in _writers.values():
+        writer.close()